@@ -0,0 +1,119 @@
+"""
+Import time of the entry points, measured in fresh interpreters, and the
+time to first batch of inference (interpreter start to the first prediction):
+
+    python -m benchmarks.imports --output imports.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MODULES = ["model", "inference", "export", "main_train", "train", "quantize", "datasets.kitti", "preprocess.kitti"]
+
+# Modules that an entry point should not pay for unless it uses them
+HEAVY_MODULES = ["skorch", "seaborn", "pandas", "matplotlib", "networkx", "h5py", "sklearn.model_selection"]
+
+REPEATS = 5
+
+IMPORT_SCRIPT = """
+import sys, time, json
+start_time = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start_time
+print(json.dumps({{"seconds": elapsed, "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+FIRST_BATCH_SCRIPT = """
+import time, json
+start_time = time.perf_counter()
+from inference import load_predictor, predict
+import_time = time.perf_counter()
+predictor = load_predictor({path!r}, "eager")
+load_time = time.perf_counter()
+import torch
+predict(predictor, torch.load({data_path!r}, weights_only=False), batch_size=64)
+end_time = time.perf_counter()
+print(json.dumps({{"import": import_time - start_time, "load": load_time - import_time, "first_batch": end_time - load_time}}))
+"""
+
+
+def _run(script):
+    """
+    Run a script in a fresh interpreter from the repository root
+    :return: (wall time of the whole process, last line of its output as JSON)
+    """
+    start_time = time.perf_counter()
+    output = subprocess.run([sys.executable, "-c", script], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    elapsed = time.perf_counter() - start_time
+
+    return elapsed, json.loads(output.strip().splitlines()[-1])
+
+
+def import_times(modules=MODULES, repeats=REPEATS):
+    """
+    Median import time of every module, and the heavy modules it drags in
+    """
+    results = {}
+    for module in modules:
+        runs = [_run(IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES))[1] for _ in range(repeats)]
+        results[module] = {"seconds": float(np.median([run["seconds"] for run in runs])), "heavy": runs[0]["heavy"]}
+
+        print(f"{module:20s} {results[module]['seconds']:7.3f} s | heavy: {', '.join(results[module]['heavy']) or '-'}")
+
+    return results
+
+
+def time_to_first_batch(repeats=REPEATS, num_graphs=64, num_nodes=3000):
+    """
+    Wall time from interpreter start to the first batch predicted by a saved
+    GraphSage, with its breakdown measured inside the process
+    """
+    sys.path.insert(0, ROOT)
+    import torch
+    import export
+    from model import GraphSage
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        example = export.make_example_batch(num_graphs, num_nodes)
+        model = export.materialize(GraphSage(hidden_dim=64, output_dim=3), example)
+
+        path = os.path.join(tmp_dir, "model.pt")
+        data_path = os.path.join(tmp_dir, "data.pt")
+        torch.save(model.state_dict(), path)
+        torch.save(example.to_data_list(), data_path)
+
+        runs = [_run(FIRST_BATCH_SCRIPT.format(path=path, data_path=data_path)) for _ in range(repeats)]
+
+    result = {"wall": float(np.median([wall for wall, _ in runs]))}
+    for name in ["import", "load", "first_batch"]:
+        result[name] = float(np.median([run[name] for _, run in runs]))
+
+    print(f"Time to first batch {result['wall']:7.3f} s | import {result['import']:.3f} s | "
+          f"load {result['load']:.3f} s | first batch {result['first_batch']:.3f} s")
+
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure import times and inference time to first batch")
+    parser.add_argument("--modules", nargs="*", default=MODULES)
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--output", default=None, help="JSON file for the results")
+    args = parser.parse_args()
+
+    results = {
+        "imports": import_times(args.modules, args.repeats),
+        "time_to_first_batch": time_to_first_batch(args.repeats),
+    }
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Saved results to", args.output)
@@ -0,0 +1,82 @@
+import os
+import time
+import tempfile
+import numpy as np
+import torch
+
+import export
+from inference import load_predictor
+from model import *
+
+CLASSES = ["Car", "Pedestrian", "Cyclist"]
+HIDDEN_DIM = 64
+BATCH_SIZE = 64
+WARMUP = 3
+REPEATS = 20
+
+
+def benchmark_latency(predictor, batch, warmup=WARMUP, repeats=REPEATS):
+    """
+    Measure the latency of a predictor on a single batch
+    :return: (median, min) latency in seconds
+    """
+    for _ in range(warmup):
+        predictor(batch)
+
+    times = []
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        predictor(batch)
+        times.append(time.perf_counter() - start_time)
+
+    return np.median(times), np.min(times)
+
+
+def run(model_class, batch_size=BATCH_SIZE, num_nodes=export.NUM_NODES, backends=("eager", "torchscript", "compile", "onnx")):
+    """
+    Compare the inference latency and throughput of the backends on the same
+    weights. The ONNX backend only supports GraphSage.
+    """
+    if model_class is not GraphSage:
+        backends = [backend for backend in backends if backend != "onnx"]
+
+    example = export.make_example_batch(batch_size, num_nodes)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Materialise and save a model so that every backend loads the same weights
+        model = export.materialize(model_class(hidden_dim=HIDDEN_DIM, output_dim=len(CLASSES)), example)
+        state_dict_path = os.path.join(tmp_dir, "model.pt")
+        torch.save(model.state_dict(), state_dict_path)
+
+        paths = {
+            "eager": state_dict_path,
+            "compile": state_dict_path,
+            "torchscript": os.path.join(tmp_dir, "model.torchscript.pt"),
+            "onnx": os.path.join(tmp_dir, "model.onnx"),
+        }
+        export.export_torchscript(model, paths["torchscript"], batch_size, num_nodes)
+        if "onnx" in backends:
+            max_diff = export.export_onnx(model, paths["onnx"], batch_size, num_nodes)
+            print(f"ONNX parity: max abs difference {max_diff:.2e}")
+
+        results = {}
+        for backend in backends:
+            predictor = load_predictor(paths[backend], backend, model_class, HIDDEN_DIM, len(CLASSES))
+            results[backend] = benchmark_latency(predictor, example)
+
+    print(f"{model_class.__name__}, batch size {batch_size}, {num_nodes} nodes per graph")
+    eager_latency = results["eager"][0] if "eager" in results else None
+    for backend, (median, best) in results.items():
+        speedup = f" | speed-up {eager_latency / median:.2f}x" if eager_latency is not None else ""
+        print(f"  {backend:12s} median {median * 1000:8.2f} ms | min {best * 1000:8.2f} ms | "
+              f"{batch_size / median:8.1f} graphs/sec{speedup}")
+
+    return results
+
+
+if __name__ == "__main__":
+    torch.manual_seed(42)
+    np.random.seed(42)
+
+    for model_class in [GraphSage, GraphClassifier]:
+        run(model_class)
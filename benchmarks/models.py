@@ -0,0 +1,69 @@
+import resource
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import torch
+
+import export
+from model import *
+
+CLASSES = ["Car", "Pedestrian", "Cyclist"]
+HIDDEN_DIM = 64
+BATCH_SIZE = 32
+NUM_NODES = [500, 3000]
+WARMUP = 2
+REPEATS = 10
+
+
+def _measure(model_name, batch_size, num_nodes, warmup, repeats):
+    """
+    Time the forward pass of a model in a fresh process, so that the peak
+    resident memory is that of this configuration only
+    """
+    torch.manual_seed(42)
+    np.random.seed(42)
+
+    example = export.make_example_batch(batch_size, num_nodes)
+
+    # ru_maxrss is in kilobytes on Linux
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    model = export.materialize(globals()[model_name](hidden_dim=HIDDEN_DIM, output_dim=len(CLASSES)), example)
+
+    times = []
+    with torch.no_grad():
+        for i in range(warmup + repeats):
+            start_time = time.perf_counter()
+            model(example)
+            if i >= warmup:
+                times.append(time.perf_counter() - start_time)
+
+    rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return np.median(times), (rss_peak - rss_before) / 1024
+
+
+def run(model_classes=(GraphSage, DGCNN), batch_size=BATCH_SIZE, num_nodes=NUM_NODES, warmup=WARMUP, repeats=REPEATS):
+    """
+    Compare the time and the additional peak memory of a forward pass per
+    batch of the models, for each graph size
+    """
+    context = multiprocessing.get_context("spawn")
+
+    results = {}
+    for n in num_nodes:
+        print(f"Batch size {batch_size}, {n} nodes per graph")
+        for model_class in model_classes:
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                latency, memory = executor.submit(_measure, model_class.__name__, batch_size, n, warmup, repeats).result()
+            results[(model_class.__name__, n)] = (latency, memory)
+
+            print(f"  {model_class.__name__:24s} {latency * 1000:9.2f} ms/batch | "
+                  f"{batch_size / latency:8.1f} graphs/sec | peak memory +{memory:8.1f} MB")
+
+    return results
+
+
+if __name__ == "__main__":
+    run()
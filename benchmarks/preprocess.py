@@ -0,0 +1,207 @@
+"""
+Preprocessing benchmark on synthetic KITTI frames: time per frame of every
+stage of preprocess_sample (its tracing spans), end-to-end frames/sec and peak RSS for 1..N
+worker processes, compared against a stored baseline:
+
+    python -m benchmarks.preprocess --save-baseline baseline.json
+    python -m benchmarks.preprocess --baseline baseline.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import tracing
+from benchmarks import synthetic_kitti
+from preprocess import kitti as preprocess_kitti
+
+NUM_FRAMES = 32
+
+# Relative slowdown reported as a regression
+TOLERANCE = 0.1
+
+
+def time_stages(path_dataset, save_path, num_frames, rgb=False, radius=None):
+    """
+    Run preprocess_kitti.preprocess_sample on every frame, in this process,
+    and break its time down with the preprocess.* tracing spans
+    :param rgb: colour the points with image_2, the frames must have images
+    :param radius: build radius graphs instead of kNN graphs, as preprocess()
+    :return: mean seconds per frame of every stage, and of the whole sample
+    """
+    os.makedirs(os.path.join(save_path, "X"), exist_ok=True)
+    os.makedirs(os.path.join(save_path, "y"), exist_ok=True)
+
+    was_enabled = tracing.is_enabled()
+    tracing.enable()
+    tracing.collect()
+
+    total = 0.0
+    try:
+        for frame in range(num_frames):
+            name = "{0:06d}".format(frame)
+            image_file = os.path.join(path_dataset, "image_2", name + ".png") if rgb else None
+
+            start_time = time.perf_counter()
+            preprocess_kitti.preprocess_sample(os.path.join(path_dataset, "velodyne", name + ".bin"),
+                                               os.path.join(path_dataset, "label_2", name + ".txt"),
+                                               os.path.join(path_dataset, "calib", name + ".txt"),
+                                               save_path, frame, image_file=image_file, radius=radius)
+            total += time.perf_counter() - start_time
+
+        stages = tracing.summary()["stages"]
+    finally:
+        tracing.collect()
+        if not was_enabled:
+            tracing.disable()
+
+    times = {name[len("preprocess."):]: stage["total"] / num_frames
+             for name, stage in stages.items() if name.startswith("preprocess.")}
+    times["total"] = total / num_frames
+
+    return times
+
+
+def _run_preprocess(path_dataset, save_path, num_workers, rgb=False, radius=None):
+    """
+    End-to-end preprocessing in a fresh process, so that the peak RSS of this
+    process and of its pool workers belongs to this run only
+    """
+    # ru_maxrss is in kilobytes on Linux, the imports (torch) alone take most of it
+    rss_imports = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    start_time = time.perf_counter()
+    preprocess_kitti.preprocess(path_dataset, save_path, rgb=rgb, num_workers=num_workers, radius=radius)
+    elapsed = time.perf_counter() - start_time
+
+    # The children are the pool workers, forked after the imports
+    peak_rss_main = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    peak_rss_worker = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+    return elapsed, rss_imports, peak_rss_main, peak_rss_worker
+
+
+def time_end_to_end(path_dataset, save_root, num_frames, workers, rgb=False, radius=None):
+    """
+    Frames/sec and peak RSS of preprocess() for every number of workers
+    """
+    context = multiprocessing.get_context("spawn")
+
+    results = {}
+    for num_workers in workers:
+        save_path = os.path.join(save_root, f"processed_{num_workers}")
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            elapsed, rss_imports, peak_rss_main, peak_rss_worker = executor.submit(_run_preprocess, path_dataset, save_path, num_workers,
+                                                                                          rgb, radius).result()
+
+        results[str(num_workers)] = {
+            "frames_per_sec": num_frames / elapsed,
+            "rss_imports_mb": rss_imports,
+            "peak_rss_main_mb": peak_rss_main,
+            "peak_rss_worker_mb": peak_rss_worker,
+        }
+
+    return results
+
+
+def run(num_frames=NUM_FRAMES, workers=None, seed=42, rgb=False, radius=None):
+    """
+    Generate the synthetic frames in a temporary directory and benchmark them
+    :param rgb: generate camera images and colour the points with them
+    :param radius: benchmark radius graphs instead of kNN graphs
+    """
+    if workers is None:
+        workers = sorted({1, 2, 4, os.cpu_count()} & set(range(1, os.cpu_count() + 1)))
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path_dataset = synthetic_kitti.generate(os.path.join(tmp_dir, "training"), num_frames, seed, images=rgb)
+
+        results = {
+            "num_frames": num_frames,
+            "rgb": rgb,
+            "radius": radius,
+            "stages": time_stages(path_dataset, os.path.join(tmp_dir, "stages"), num_frames, rgb, radius),
+            "workers": time_end_to_end(path_dataset, tmp_dir, num_frames, workers, rgb, radius),
+        }
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    return results
+
+
+def report(results, baseline=None, tolerance=TOLERANCE):
+    """
+    Print the results, with the change with respect to the baseline
+    :return: list of the metrics slower than the baseline by more than tolerance
+    """
+    regressions = []
+
+    def compare(name, value, baseline_value, higher_is_better):
+        if baseline_value is None:
+            return ""
+
+        ratio = value / baseline_value if baseline_value > 0 else float("inf")
+        slower = ratio < 1 - tolerance if higher_is_better else ratio > 1 + tolerance
+        if slower:
+            regressions.append(name)
+
+        return f" | baseline {baseline_value:.4g} ({ratio:.2f}x){' REGRESSION' if slower else ''}"
+
+    if baseline is not None and baseline["num_frames"] != results["num_frames"]:
+        print(f"Warning: the baseline was measured on {baseline['num_frames']} frames, not {results['num_frames']}")
+    for option in ["rgb", "radius"]:
+        if baseline is not None and baseline.get(option) != results[option]:
+            print(f"Warning: the baseline was measured with {option}={baseline.get(option)}, not {results[option]}")
+
+    baseline_stages = baseline["stages"] if baseline is not None else {}
+    baseline_workers = baseline["workers"] if baseline is not None else {}
+
+    print(f"Stages, ms per frame ({results['num_frames']} frames)")
+    for stage, value in results["stages"].items():
+        baseline_value = baseline_stages.get(stage)
+        print(f"  {stage:10s} {value * 1000:9.2f}" +
+              compare(f"stage {stage}", value * 1000, baseline_value * 1000 if baseline_value is not None else None, False))
+
+    print("End to end")
+    for num_workers, values in results["workers"].items():
+        baseline_value = baseline_workers.get(num_workers, {}).get("frames_per_sec")
+        print(f"  {num_workers:>3s} workers {values['frames_per_sec']:8.2f} frames/sec | "
+              f"peak RSS {values['peak_rss_main_mb']:7.1f} MB main, {values['peak_rss_worker_mb']:7.1f} MB worker "
+              f"({values['rss_imports_mb']:.1f} MB after imports)" +
+              compare(f"{num_workers} workers", values["frames_per_sec"], baseline_value, True))
+
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the KITTI preprocessing on synthetic frames")
+    parser.add_argument("--frames", type=int, default=NUM_FRAMES)
+    parser.add_argument("--workers", type=int, nargs="*", default=None)
+    parser.add_argument("--rgb", action="store_true", help="Colour the points with generated camera images")
+    parser.add_argument("--radius", type=float, default=None, help="Radius graphs instead of kNN graphs")
+    parser.add_argument("--baseline", default=None, help="JSON results to compare against")
+    parser.add_argument("--save-baseline", default=None, help="Save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    results = run(args.frames, args.workers, rgb=args.rgb, radius=args.radius)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = report(results, baseline, args.tolerance)
+    if regressions:
+        print("Regressions:", ", ".join(regressions))
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Saved baseline to", args.save_baseline)
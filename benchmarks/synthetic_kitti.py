@@ -0,0 +1,170 @@
+"""
+Synthetic KITTI frames (velodyne, label_2, calib and optionally image_2) with
+realistic point counts and box layouts, to benchmark the preprocessing without
+the real dataset:
+
+    python -m benchmarks.synthetic_kitti /tmp/synthetic_kitti --frames 100
+"""
+import argparse
+import os
+import numpy as np
+import matplotlib.pyplot as plt
+
+import utils
+
+# Calibration of KITTI training frame 000000
+P2 = np.array([[721.5377, 0, 609.5593, 44.85728],
+               [0, 721.5377, 172.854, 0.2163791],
+               [0, 0, 1, 0.002745884]])
+R0_RECT = np.array([[0.9999239, 0.00983776, -0.007445048],
+                    [-0.009869795, 0.9999421, -0.004278459],
+                    [0.007402527, 0.004351614, 0.9999631]])
+TR_VELO_TO_CAM = np.array([[0.007533745, -0.9999714, -0.000616602, -0.004069766],
+                           [0.01480249, 0.0007280733, -0.9998902, -0.07631618],
+                           [0.9998621, 0.00752379, 0.01480755, -0.2717806]])
+TR_IMU_TO_VELO = np.array([[0.9999976, 0.0007553071, -0.002035826, -0.8086759],
+                           [-0.0007854027, 0.9998898, -0.01482298, 0.3195559],
+                           [0.002024406, 0.01482454, 0.9998881, -0.7997231]])
+
+IMAGE_SHAPE = (375, 1242, 3)
+NUM_POINTS = 120000
+GROUND_Z = -1.73
+
+# Class: (height, width, length, points at 10 meters, objects per frame)
+CLASSES = {
+    "Car": (1.5, 1.6, 3.9, 2500, 4),
+    "Pedestrian": (1.75, 0.6, 0.8, 600, 2),
+    "Cyclist": (1.7, 0.6, 1.8, 800, 1),
+    "DontCare": (1.5, 1.0, 1.0, 0, 2),
+}
+
+
+def velo_to_cam():
+    """
+    4x4 velodyne to rectified camera transform
+    """
+    r_rect = np.eye(4)
+    r_rect[:3, :3] = R0_RECT
+
+    return r_rect @ np.vstack([TR_VELO_TO_CAM, [0, 0, 0, 1]])
+
+
+def write_calib(path):
+    with open(path, "w") as f:
+        for name in ["P0", "P1", "P2", "P3"]:
+            f.write(f"{name}: " + " ".join("%.12e" % v for v in P2.flatten()) + "\n")
+        f.write("R0_rect: " + " ".join("%.12e" % v for v in R0_RECT.flatten()) + "\n")
+        f.write("Tr_velo_to_cam: " + " ".join("%.12e" % v for v in TR_VELO_TO_CAM.flatten()) + "\n")
+        f.write("Tr_imu_to_velo: " + " ".join("%.12e" % v for v in TR_IMU_TO_VELO.flatten()) + "\n")
+
+
+def object_points(rng, center, dimensions, rz, num_points):
+    """
+    Points on the sides and the top of a box standing on the ground, as seen
+    by the lidar. The box frame is the one of utils.get_point_cloud_in_bbox3d.
+    """
+    height, width, length = dimensions
+    local = rng.uniform([-length / 2, -width / 2, 0], [length / 2, width / 2, height], size=(num_points, 3))
+
+    # Push every point to the closest vertical side or to the top
+    side = rng.integers(0, 3, num_points)
+    local[side == 0, 0] = np.sign(local[side == 0, 0]) * length / 2 * 0.98
+    local[side == 1, 1] = np.sign(local[side == 1, 1]) * width / 2 * 0.98
+    local[side == 2, 2] = height * 0.98
+
+    rotation_matrix = np.array([[np.cos(rz), -np.sin(rz), 0],
+                                [np.sin(rz), np.cos(rz), 0],
+                                [0, 0, 1]])
+
+    return local @ rotation_matrix + center
+
+
+def background_points(rng, num_points):
+    """
+    Ground rings getting sparser with the range, and vertical clutter
+    """
+    num_ground = int(num_points * 0.7)
+    distance = 3 + rng.exponential(12, num_ground).clip(0, 70)
+    angle = rng.uniform(-np.pi, np.pi, num_ground)
+    ground = np.column_stack([distance * np.cos(angle), distance * np.sin(angle), GROUND_Z + rng.normal(0, 0.03, num_ground)])
+
+    num_clutter = num_points - num_ground
+    distance = rng.uniform(8, 40, num_clutter)
+    angle = rng.uniform(-np.pi, np.pi, num_clutter)
+    clutter = np.column_stack([distance * np.cos(angle), distance * np.sin(angle), rng.uniform(GROUND_Z, 3, num_clutter)])
+
+    return np.vstack([ground, clutter])
+
+
+def generate_frame(save_path, frame, rng, num_points=NUM_POINTS, images=False):
+    """
+    Write the velodyne points, labels, calibration (and image) of one frame
+    """
+    transform = velo_to_cam()
+
+    points = []
+    labels = []
+    for class_name, (height, width, length, points_at_10m, num_objects) in CLASSES.items():
+        for _ in range(rng.poisson(num_objects)):
+            # In the field of view of the camera, in front of the car
+            distance = rng.uniform(5, 35)
+            angle = rng.uniform(-0.6, 0.6)
+            center = np.array([distance * np.cos(angle), distance * np.sin(angle), GROUND_Z])
+            ry = rng.uniform(-np.pi, np.pi)
+            rz = utils.ry_to_rz(ry)
+
+            # Fewer points on farther objects
+            num_object_points = int(points_at_10m * min(1, (10 / distance) ** 2))
+            if num_object_points > 0:
+                points.append(object_points(rng, center, (height, width, length), rz, num_object_points))
+
+            # Label in camera coordinates, with the 2D box of the projected centre
+            center_cam = transform @ np.append(center, 1)
+            u, v, w = P2 @ center_cam
+            box_2d = [u / w - 50, v / w - 50, u / w + 50, v / w + 50]
+            labels.append(f"{class_name} 0.00 {rng.integers(0, 3)} {ry:.2f} " +
+                          " ".join("%.2f" % v for v in box_2d) + " " +
+                          f"{height:.2f} {width:.2f} {length:.2f} " +
+                          " ".join("%.2f" % v for v in center_cam[:3]) + f" {ry:.2f}")
+
+    num_objects_points = sum(p.shape[0] for p in points)
+    points.append(background_points(rng, max(0, num_points - num_objects_points)))
+
+    point_cloud = np.vstack(points)
+    point_cloud = np.column_stack([point_cloud, rng.uniform(0, 1, point_cloud.shape[0])]).astype(np.float32)
+
+    name = "{0:06d}".format(frame)
+    point_cloud.tofile(os.path.join(save_path, "velodyne", name + ".bin"))
+    with open(os.path.join(save_path, "label_2", name + ".txt"), "w") as f:
+        f.write("\n".join(labels) + "\n")
+    write_calib(os.path.join(save_path, "calib", name + ".txt"))
+
+    if images:
+        plt.imsave(os.path.join(save_path, "image_2", name + ".png"), rng.uniform(0, 1, IMAGE_SHAPE))
+
+
+def generate(save_path, num_frames, seed=42, num_points=NUM_POINTS, images=False):
+    """
+    Write num_frames synthetic frames in the KITTI training layout
+    """
+    folders = ["velodyne", "label_2", "calib"] + (["image_2"] if images else [])
+    for folder in folders:
+        os.makedirs(os.path.join(save_path, folder), exist_ok=True)
+
+    rng = np.random.default_rng(seed)
+    for frame in range(num_frames):
+        generate_frame(save_path, frame, rng, num_points, images)
+
+    return save_path
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic KITTI frames")
+    parser.add_argument("output")
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--points", type=int, default=NUM_POINTS)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--images", action="store_true")
+    args = parser.parse_args()
+
+    generate(args.output, args.frames, args.seed, args.points, args.images)
@@ -0,0 +1,167 @@
+"""
+Training microbenchmarks: forward, backward and optimizer step time of the
+models over a grid of batch sizes, hidden sizes, node counts and thread
+counts, and the collate throughput of the torch_geometric DataLoader. The
+results are written as CSV and JSON rows:
+
+    python -m benchmarks.training --output results/training
+"""
+import argparse
+import csv
+import json
+import os
+import time
+import numpy as np
+import torch
+from torch import optim
+from torch_geometric.data import Batch
+from torch_geometric.loader import DataLoader
+
+import export
+import utils
+from model import *
+
+CLASSES = ["Car", "Pedestrian", "Cyclist"]
+MODELS = ["GraphSage", "GraphClassifier"]
+BATCH_SIZES = [32, 64, 128]
+HIDDEN_DIMS = [64, 128, 256]
+NUM_NODES = [500, 3000]
+WARMUP = 2
+REPEATS = 10
+
+
+def time_train_step(model_name, batch_size, hidden_dim, num_nodes, num_threads, warmup=WARMUP, repeats=REPEATS):
+    """
+    Median forward, backward and optimizer step time of a training step
+    """
+    torch.set_num_threads(num_threads)
+
+    example = export.make_example_batch(batch_size, num_nodes)
+    model = export.materialize(globals()[model_name](hidden_dim=hidden_dim, output_dim=len(CLASSES)), example)
+    model.train()
+
+    loss_fn = nn.CrossEntropyLoss()
+    optimizer = optim.AdamW(model.parameters(), weight_decay=1e-2)
+
+    times = {"forward": [], "backward": [], "step": []}
+    for i in range(warmup + repeats):
+        start_time = time.perf_counter()
+        loss = loss_fn(model(example), example.y)
+        forward_time = time.perf_counter()
+
+        optimizer.zero_grad()
+        loss.backward()
+        backward_time = time.perf_counter()
+
+        optimizer.step()
+        step_time = time.perf_counter()
+
+        if i >= warmup:
+            times["forward"].append(forward_time - start_time)
+            times["backward"].append(backward_time - forward_time)
+            times["step"].append(step_time - backward_time)
+
+    result = {name: float(np.median(values)) for name, values in times.items()}
+    result["total"] = result["forward"] + result["backward"] + result["step"]
+    result["graphs_per_sec"] = batch_size / result["total"]
+
+    return result
+
+
+def time_collate(batch_size, num_nodes, num_graphs=512, num_workers=0):
+    """
+    Graphs per second collated by the DataLoader alone, no model involved
+    """
+    point_cloud = np.random.rand(num_nodes, 3).astype(np.float32)
+    data = utils.knn_graph(point_cloud, 0, export.NUM_EDGES_PER_VERTEX)
+
+    # Distinct objects, as a dataset would return them
+    dataset = [data.clone() for _ in range(num_graphs)]
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers)
+
+    # First pass starts the workers
+    for _ in loader:
+        pass
+
+    start_time = time.perf_counter()
+    for _ in loader:
+        pass
+    elapsed = time.perf_counter() - start_time
+
+    # Batch.from_data_list alone
+    start_time = time.perf_counter()
+    for i in range(0, num_graphs, batch_size):
+        Batch.from_data_list(dataset[i:i + batch_size])
+    elapsed_batch = time.perf_counter() - start_time
+
+    return {"loader_graphs_per_sec": num_graphs / elapsed, "from_data_list_graphs_per_sec": num_graphs / elapsed_batch}
+
+
+def run(models=MODELS, batch_sizes=BATCH_SIZES, hidden_dims=HIDDEN_DIMS, num_nodes=NUM_NODES, threads=None):
+    """
+    Benchmark the whole grid
+    :return: (training rows, collate rows)
+    """
+    if threads is None:
+        threads = sorted({1, os.cpu_count()})
+
+    torch.manual_seed(42)
+    np.random.seed(42)
+
+    train_rows = []
+    for model_name in models:
+        for n in num_nodes:
+            for batch_size in batch_sizes:
+                for hidden_dim in hidden_dims:
+                    for num_threads in threads:
+                        config = {"model": model_name, "num_nodes": n, "batch_size": batch_size,
+                                  "hidden_dim": hidden_dim, "num_threads": num_threads}
+                        row = {**config, **time_train_step(model_name, batch_size, hidden_dim, n, num_threads)}
+                        train_rows.append(row)
+
+                        print(f"{model_name:16s} nodes {n:5d} | batch {batch_size:4d} | hidden {hidden_dim:4d} | threads {num_threads:3d} | "
+                              f"fwd {row['forward'] * 1000:8.2f} ms | bwd {row['backward'] * 1000:8.2f} ms | "
+                              f"step {row['step'] * 1000:6.2f} ms | {row['graphs_per_sec']:8.1f} graphs/sec")
+
+    collate_rows = []
+    for n in num_nodes:
+        for batch_size in batch_sizes:
+            row = {"num_nodes": n, "batch_size": batch_size, **time_collate(batch_size, n)}
+            collate_rows.append(row)
+
+            print(f"Collate nodes {n:5d} | batch {batch_size:4d} | DataLoader {row['loader_graphs_per_sec']:9.1f} graphs/sec | "
+                  f"from_data_list {row['from_data_list_graphs_per_sec']:9.1f} graphs/sec")
+
+    return train_rows, collate_rows
+
+
+def save(rows, path):
+    """
+    Write result rows to path.csv and path.json
+    """
+    with open(path + ".csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    with open(path + ".json", "w") as f:
+        json.dump(rows, f, indent=2)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark training steps and collate throughput")
+    parser.add_argument("--models", nargs="*", default=MODELS)
+    parser.add_argument("--batch-sizes", type=int, nargs="*", default=BATCH_SIZES)
+    parser.add_argument("--hidden", type=int, nargs="*", default=HIDDEN_DIMS)
+    parser.add_argument("--nodes", type=int, nargs="*", default=NUM_NODES)
+    parser.add_argument("--threads", type=int, nargs="*", default=None)
+    parser.add_argument("--output", default="benchmark_training", help="prefix of the result files")
+    args = parser.parse_args()
+
+    train_rows, collate_rows = run(args.models, args.batch_sizes, args.hidden, args.nodes, args.threads)
+
+    if os.path.dirname(args.output):
+        os.makedirs(os.path.dirname(args.output), exist_ok=True)
+    save(train_rows, args.output + "_steps")
+    save(collate_rows, args.output + "_collate")
+    print("Saved results to", args.output + "_steps.{csv,json} and", args.output + "_collate.{csv,json}")
@@ -0,0 +1,129 @@
+"""
+Columnar catalog of the labelled objects of the KITTI training set, one row
+per object with its frame, class, box, truncation, occlusion, distance and
+number of points in the box. It is built once by reading every frame, then
+queried without touching the label files or the point clouds:
+
+    catalog = load_catalog(CATALOG_PATH)
+    selected = select(catalog, lambda c: np.isin(c["class"], ["Car", "Pedestrian", "Cyclist"]) & (c["num_points"] >= 300))
+
+The frame of a row is the index of the frame in the sorted file lists, the
+same sample_idx used by the preprocessing to name the graphs.
+"""
+import os
+import multiprocessing
+import numpy as np
+from tqdm import tqdm
+
+import resources
+import utils
+from preprocess.kitti import load_velodyne, load_labels, parse_calib, filter_point_cloud
+
+COLUMNS = {
+    "frame": np.int32,
+    "object": np.int16,
+    "class": str,
+    "box": np.float32,
+    "truncated": np.float32,
+    "occluded": np.int8,
+    "distance": np.float32,
+    "num_points": np.int32,
+}
+
+
+def catalog_frame(point_cloud_file, label_file, calib_file, frame):
+    """
+    Catalog rows of the objects of a frame, the points are counted on the
+    point cloud filtered as in the preprocessing
+    """
+    _, matrix_tr_velo_to_cam, R_cam_to_rect = parse_calib(calib_file)
+    objects = load_labels(label_file, matrix_tr_velo_to_cam, R_cam_to_rect)
+    point_cloud = filter_point_cloud(load_velodyne(point_cloud_file))
+
+    rows = {name: [] for name in COLUMNS}
+    for j, bbox_3d in enumerate(objects["box_3d"]):
+        rows["frame"].append(frame)
+        rows["object"].append(j)
+        rows["class"].append(objects["classes"][j])
+        rows["box"].append(bbox_3d)
+        rows["truncated"].append(objects["obj_truncated"][j])
+        rows["occluded"].append(objects["obj_occluded"][j])
+        rows["distance"].append(np.linalg.norm(bbox_3d[:3]))
+        rows["num_points"].append(utils.get_point_cloud_in_bbox3d(point_cloud, bbox_3d).shape[0])
+
+    return rows
+
+
+def build_catalog(path_dataset, catalog_path, num_workers=None):
+    """
+    Catalog all the objects of a KITTI split (velodyne, label_2 and calib
+    folders) and save the columns in a .npz file
+    """
+    print("Building the catalog of", path_dataset)
+
+    point_cloud_files = sorted(os.path.join(path_dataset, "velodyne", x) for x in os.listdir(os.path.join(path_dataset, "velodyne")))
+    label_files = sorted(os.path.join(path_dataset, "label_2", x) for x in os.listdir(os.path.join(path_dataset, "label_2")))
+    calib_files = sorted(os.path.join(path_dataset, "calib", x) for x in os.listdir(os.path.join(path_dataset, "calib")))
+
+    assert len(point_cloud_files) == len(label_files) == len(calib_files)
+
+    columns = {name: [] for name in COLUMNS}
+    resources_plan = resources.plan("preprocess", num_workers)
+    with multiprocessing.Pool(processes=resources_plan["processes"], initializer=resources.limit_threads,
+                              initargs=(resources_plan["threads"],)) as pool:
+        results = [pool.apply_async(catalog_frame, (point_cloud_file, label_file, calib_file, i))
+                   for i, (point_cloud_file, label_file, calib_file) in enumerate(zip(point_cloud_files, label_files, calib_files))]
+
+        for result in tqdm(results, desc="Progress", total=len(results)):
+            for name, values in result.get().items():
+                columns[name].extend(values)
+
+    catalog = {name: np.array(values, dtype=COLUMNS[name]) for name, values in columns.items()}
+    catalog["box"] = catalog["box"].reshape(-1, 7)
+
+    np.savez(catalog_path, **catalog)
+    print("Catalog of %d objects saved to %s" % (len(catalog["frame"]), catalog_path))
+
+    return catalog
+
+
+def load_catalog(catalog_path):
+    """
+    Load all the columns of a catalog
+    """
+    with np.load(catalog_path) as columns:
+        return {name: columns[name] for name in columns.files}
+
+
+def select(catalog, predicate):
+    """
+    Rows of the catalog for which the predicate, a function of the columns
+    returning a boolean mask, holds
+    """
+    mask = predicate(catalog)
+
+    return {name: column[mask] for name, column in catalog.items()}
+
+
+def class_counts(catalog):
+    """
+    Number of objects per class, most frequent first
+    """
+    classes, counts = np.unique(catalog["class"], return_counts=True)
+    order = np.argsort(-counts, kind="stable")
+
+    return [(str(classes[i]), int(counts[i])) for i in order]
+
+
+if __name__ == "__main__":
+    DATASET_PATH = "/tmp_workspace/KITTI/training"
+    CATALOG_PATH = "/tmp_workspace/KITTI/processed/catalog.npz"
+
+    if not os.path.exists(CATALOG_PATH):
+        build_catalog(DATASET_PATH, CATALOG_PATH)
+
+    catalog = load_catalog(CATALOG_PATH)
+    print(class_counts(catalog))
+
+    selected = select(catalog, lambda c: np.isin(c["class"], ["Car", "Pedestrian", "Cyclist"]) & (c["num_points"] >= 300))
+    print("%d of %d objects are Car, Pedestrian or Cyclist with at least 300 points" % (len(selected["frame"]), len(catalog["frame"])))
@@ -7,15 +7,61 @@ import torch_geometric.utils as utils
 from ordered_set import OrderedSet
 import numpy as np
 import pickle
+import json
 from tqdm import tqdm
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor
 import os
-import networkx as nx
 import torch_geometric.data as pyg
-import concurrent.futures
+from utils import nx_to_arrays, arrays_to_torch_geometric, cache_path, GRAPH_FORMAT
+import resources
+import tracing
+
+# Number of samples decoded per task of the process pool
+CHUNK_SIZE = 64
+
+
+def decode_graph(graph_file):
+    """
+    Load a graph saved by the preprocessing, either as numpy arrays (.npz) or
+    as a pickled NetworkX graph (.pkl, legacy). The .npz graphs of an older
+    GRAPH_FORMAT have another topology and are refused.
+    Returns
+    -------
+    tuple of np.ndarray
+        The node features, the edges and the edge weights
+    """
+    if graph_file.endswith(".npz"):
+        with np.load(graph_file) as arrays:
+            graph_format = int(arrays['format']) if 'format' in arrays else 1
+            if graph_format != GRAPH_FORMAT:
+                raise ValueError(f"{graph_file} has graph format {graph_format}, expected {GRAPH_FORMAT}, "
+                                 f"preprocess the dataset again")
+
+            return arrays['x'], arrays['edge_index'], arrays['edge_attr']
+
+    with open(graph_file, "rb") as f:
+        G = pickle.load(f)
+
+    return nx_to_arrays(G)
+
+
+def decode_chunk(files):
+    """
+    Decode a chunk of (graph_file, label_file) pairs in a worker process. Only
+    numpy arrays and strings cross the process boundary.
+    """
+    samples = []
+    for graph_file, label_file in files:
+        with open(label_file, 'r') as f:
+            label = f.read().strip()
+
+        samples.append((decode_graph(graph_file), label))
+
+    return samples
+
 
 class Dataset(GeometricDataset):
-    def __init__(self, path=None):
+    def __init__(self, path=None, num_workers=None, pre_transform=None):
         """
         Initializes the dataset
         Parameters
@@ -24,13 +70,18 @@ class Dataset(GeometricDataset):
             The data of the dataset
         target : torch.Tensor
             The target of the dataset
+        num_workers : int
+            Number of processes decoding the graphs, defaults to the number of cores (see resources.py)
+        pre_transform : callable
+            Applied once to every graph after loading, e.g. transforms.GCNNorm()
         """
         self.path = path
+        self.num_workers = num_workers
         self.data = []
         self.label = []
         self.classes = OrderedSet()
         
-        super(Dataset, self).__init__(path)
+        super(Dataset, self).__init__(path, pre_transform=pre_transform)
     
     def processed_file_names(self) -> str | List[str] | Tuple:
         return ['data.pt', 'label.pt']
@@ -55,88 +106,76 @@ class Dataset(GeometricDataset):
 
         return weights
     
-    def process_sample(self, graph_file, label_file):
-        # Load the graph
-        with open(graph_file, "rb") as f:
-            G = pickle.load(f)
-            # Load the label
-        with open(label_file, 'r') as f:
-            label = f.read()
-            label = label.strip()
-            
-        label_id = self.classes.add(label)
-
-        # Node features
-        x = torch.tensor([features['x'] for _, features in G.nodes(data=True)], dtype=torch.float32)
-
-        # Edge features
-        edge_attr = torch.tensor([features['weight'] for _, _, features in G.edges(data=True)], dtype=torch.float32)
-
-        # Edges
-        edge_index = torch.tensor(list(G.edges), dtype=torch.long).t().contiguous().view(2, -1)
-
-        # Label
-        y = torch.tensor([label_id], dtype=torch.long)
-
-        # Create a PyTorch Geometric data object.
-        data = pyg.Data(x=x, edge_index=edge_index, edge_attr=edge_attr, y=y)
-
-        return data, label
-
     def process(self):
         print("Processing dataset")
         if self.path is None:
             return
 
-        if os.path.exists(self.path + ".cache"):
+        if os.path.exists(cache_path(self.path)):
             # Load from cache
             print("Cache found!, loading from cache")
-            with open(self.path + '.cache', 'rb') as f:
+            with open(cache_path(self.path), 'rb') as f:
                 self.data, self.label = pickle.load(f)
 
         else:
             print("Cache not found")
 
-            # List all files in the directory
-            graph_files = [os.path.join(self.path, 'X', x) for x in os.listdir(os.path.join(self.path, 'X'))]
-            label_files = [os.path.join(self.path, 'y', x) for x in os.listdir(os.path.join(self.path, 'y'))]
-
-            # Sort the files
-            graph_files.sort()
-            label_files.sort()
-
-            # Create a ThreadPoolExecutor with the desired number of threads
-            with ThreadPoolExecutor(max_workers=5) as executor:
-                # Create a list to store the futures
-                futures = []
-
-                # Submit tasks to the executor for each pair of graph_file and label_file
-                for graph_file, label_file in zip(graph_files, label_files):
-                    future = executor.submit(self.process_sample, graph_file, label_file)
-                    futures.append(future)
-
-                for future in tqdm(as_completed(futures), desc="Progress", total=len(futures)):
-                    A, label = future.result()
-                    self.data.append(A)
-                    self.label.append(label)
+            if os.path.exists(os.path.join(self.path, 'manifest.json')):
+                # Merged shards (see preprocess/shards.py), the samples in the order of their ids
+                with open(os.path.join(self.path, 'manifest.json'), 'r') as f:
+                    samples = sorted(json.load(f)['samples'], key=lambda sample: sample['id'])
+
+                graph_files = [os.path.join(self.path, sample['graph']) for sample in samples]
+                label_files = [os.path.join(self.path, sample['label']) for sample in samples]
+            else:
+                # List all files in the directory
+                graph_files = [os.path.join(self.path, 'X', x) for x in os.listdir(os.path.join(self.path, 'X'))]
+                label_files = [os.path.join(self.path, 'y', x) for x in os.listdir(os.path.join(self.path, 'y'))]
+
+                # Sort the files
+                graph_files.sort()
+                label_files.sort()
+
+            # Decode the graphs in chunks on a process pool, map keeps the order of the files
+            files = list(zip(graph_files, label_files))
+            chunks = [files[i:i + CHUNK_SIZE] for i in range(0, len(files), CHUNK_SIZE)]
+
+            resources_plan = resources.plan("decode", self.num_workers)
+            with tracing.span("dataset.decode", num_files=len(files)), \
+                    ProcessPoolExecutor(max_workers=resources_plan["processes"], initializer=resources.limit_threads,
+                                        initargs=(resources_plan["threads"],)) as executor:
+                for samples in tqdm(executor.map(decode_chunk, chunks), desc="Progress", total=len(chunks)):
+                    for (x, edge_index, edge_attr), label in samples:
+                        # Kept in their storage dtypes, utils.cast_batch casts the batches
+                        data = arrays_to_torch_geometric(x, edge_index, edge_attr)
+                        self.data.append(data)
+                        self.label.append(label)
 
             # Save to cache
-            with open(self.path + '.cache', 'wb') as f:
+            with open(cache_path(self.path), 'wb') as f:
                 pickle.dump((self.data, self.label), f)
 
         # Create classes set
         for l in self.label:
             self.classes.add(l)
 
-        # Convert labels to one-hot
+        # Convert labels to one-hot, the class ids follow the order of the files
         new_labels = []
-        for l in self.label:
+        for data, l in zip(self.data, self.label):
             new_label = np.zeros(len(self.classes))
             new_label[self.classes.get_loc(l)] = 1
+            data.y = torch.tensor([self.classes.get_loc(l)], dtype=torch.long)
 
             new_labels.append(new_label)
         self.label = new_labels
 
+        # Precompute per graph attributes once, instead of at every access
+        if self.pre_transform is not None:
+            with tracing.span("dataset.pre_transform"):
+                self.data = [self.pre_transform(data) for data in self.data]
+
+        tracing.count("dataset.items", len(self.data))
+
         # Print the number of items
         print('Number of items:', len(self.data))
 
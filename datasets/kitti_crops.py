@@ -0,0 +1,102 @@
+from typing import List, Tuple, Union
+
+from torch_geometric.data import Dataset as GeometricDataset, Data
+import torch
+
+from ordered_set import OrderedSet
+import numpy as np
+import os
+
+import transforms
+
+
+class Dataset(GeometricDataset):
+    def __init__(self, path=None, transform=None, eval_transform=None):
+        """
+        Initializes the dataset of the object crops stored by the preprocessing
+        (save_crops=True). The graphs are built on access, so the resampling
+        and augmentation change every epoch and run in the DataLoader workers.
+        Parameters
+        ----------
+        path : str
+            The directory with the crops/ and y/ folders
+        transform : callable
+            Applied to the train split, defaults to transforms.train_transform()
+        eval_transform : callable
+            Applied to the validation and test splits, defaults to transforms.eval_transform()
+        """
+        self.path = path
+        self.crop_files = []
+        self.label = []
+        self.classes = OrderedSet()
+        self.eval_transform = eval_transform if eval_transform is not None else transforms.eval_transform()
+
+        super(Dataset, self).__init__(path, transform if transform is not None else transforms.train_transform())
+
+    def processed_file_names(self) -> str | List[str] | Tuple:
+        return []
+
+    def get_class_weights(self):
+        """
+        Get the weights for each class
+        Returns
+        -------
+        torch.Tensor
+            The weights for each class
+        """
+
+        # Compute the weights
+        weights = 1 / np.sum(self.label, axis=0)
+
+        # Normalize the weights
+        weights = weights / np.sum(weights)
+
+        # Convert to tensor
+        weights = torch.Tensor(weights)
+
+        return weights
+
+    def process(self):
+        print("Processing dataset")
+        if self.path is None:
+            return
+
+        # Only the labels are read here, the crops are loaded on access
+        crop_names = sorted(os.listdir(os.path.join(self.path, 'crops')))
+
+        labels = []
+        for crop_name in crop_names:
+            self.crop_files.append(os.path.join(self.path, 'crops', crop_name))
+
+            label_name = crop_name.replace('crop_', 'label_').replace('.npy', '.txt')
+            with open(os.path.join(self.path, 'y', label_name), 'r') as f:
+                labels.append(f.read().strip())
+
+        # Create classes set
+        for l in labels:
+            self.classes.add(l)
+
+        # Convert labels to one-hot
+        for l in labels:
+            new_label = np.zeros(len(self.classes))
+            new_label[self.classes.get_loc(l)] = 1
+            self.label.append(new_label)
+
+        # Print the number of items
+        print('Number of items:', len(self.crop_files))
+
+        # Print the class distribution
+        print('Class distribution:', np.sum(self.label, axis=0))
+
+    def len(self):
+        return len(self.crop_files)
+
+    def get(self, idx):
+        points = np.load(self.crop_files[idx]).astype(np.float32)
+        y = torch.tensor([int(np.argmax(self.label[idx]))], dtype=torch.long)
+
+        # The columns after the coordinates (intensity, RGB) are point features
+        if points.shape[1] > 3:
+            return Data(pos=torch.from_numpy(points[:, :3]), x=torch.from_numpy(points[:, 3:]), y=y)
+
+        return Data(pos=torch.from_numpy(points), y=y)
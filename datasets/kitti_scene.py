@@ -0,0 +1,270 @@
+from typing import List, Tuple, Union
+
+from torch_geometric.data import Dataset as GeometricDataset
+import torch
+
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import json
+import os
+
+import utils
+from preprocess import kitti as preprocess_kitti
+import resources
+import tracing
+
+# Classes of the points, the points outside the boxes of these classes are background
+CLASSES = ["Car", "Pedestrian", "Cyclist"]
+BACKGROUND = "Background"
+
+# Radius graph of the scene, as in the preprocessing (see utils.radius_neighbors)
+RADIUS = 0.5
+MAX_NEIGHBORS = 16
+
+# Bird's eye view grid of the partition, in meters, and the size of the largest cluster
+CELL_SIZE = 8.0
+MAX_POINTS = 4096
+
+INDEX = "scenes.json"
+
+
+def build_scene(point_cloud_file, label_file, calib_file, save_path, frame, class_names, radius, max_neighbors,
+                cell_size, max_points, feature_dtype):
+    """
+    Build the graph of a whole frame and save it partitioned in clusters. The
+    nodes are the filtered velodyne points (x, y, z, intensity) labelled with
+    the class of the box they fall in, the edges their radius graph. The
+    frame is split on a bird's eye view grid (see utils.bev_partition) and
+    only the edges inside a cluster are kept, every cluster is saved as
+    X/scene_{frame}_{cluster}.npz with node ids local to the cluster.
+    :param class_names: classes of the points after the background, None
+                        for objectness (every labelled object is class 1)
+    :return: list of (file name, number of points), and the points per class
+    """
+    # Load calibration
+    calib, matrix_tr_velo_to_cam, R_cam_to_rect = preprocess_kitti.parse_calib(calib_file)
+
+    # Load the point cloud, filter ouliers and far away points
+    point_cloud = preprocess_kitti.load_velodyne(point_cloud_file, intensity=True)
+    point_cloud = preprocess_kitti.filter_point_cloud(point_cloud)
+
+    # Label the points with the class of their box
+    objects = preprocess_kitti.load_labels(label_file, matrix_tr_velo_to_cam, R_cam_to_rect)
+    y = np.zeros(len(point_cloud), dtype=np.uint8)
+    for class_name, bbox in zip(objects["classes"], objects["box_3d"]):
+        if class_names is None:
+            if class_name == "DontCare":
+                continue
+            label = 1
+        elif class_name in class_names:
+            label = class_names.index(class_name) + 1
+        else:
+            continue
+
+        mask, _ = utils.points_in_bbox3d(point_cloud, bbox)
+        y[mask] = label
+
+    # Graph of the whole frame
+    with tracing.span("scene.graph"):
+        centers, neighbors, distances = utils.radius_neighbors(point_cloud[:, :3], radius, max_neighbors)
+
+    # Partition it, the edges between clusters are dropped
+    with tracing.span("scene.partition"):
+        cluster = utils.bev_partition(point_cloud, cell_size, max_points)
+        num_clusters = cluster.max() + 1 if len(cluster) else 0
+
+        intra = cluster[centers] == cluster[neighbors]
+        centers, neighbors, distances = centers[intra], neighbors[intra], distances[intra]
+
+        # Points and edges grouped by cluster, with the node ids local to their cluster
+        node_order = np.argsort(cluster, kind="stable")
+        node_counts = np.bincount(cluster, minlength=num_clusters)
+        node_starts = np.cumsum(node_counts) - node_counts
+        local = np.empty(len(cluster), dtype=np.int64)
+        local[node_order] = np.arange(len(cluster)) - np.repeat(node_starts, node_counts)
+
+        edge_order = np.argsort(cluster[centers], kind="stable")
+        edge_counts = np.bincount(cluster[centers], minlength=num_clusters)
+        edge_starts = np.cumsum(edge_counts) - edge_counts
+
+    clusters = []
+    for c in range(num_clusters):
+        nodes = node_order[node_starts[c]:node_starts[c] + node_counts[c]]
+        edges = edge_order[edge_starts[c]:edge_starts[c] + edge_counts[c]]
+
+        # Edges [neighbour, centre], as utils.radius_graph_arrays
+        edge_index = np.stack([local[neighbors[edges]], local[centers[edges]]])
+        edge_attr = 1 / (1 + distances[edges])
+        x, edge_index, edge_attr = utils.compact_graph(point_cloud[nodes], edge_index, edge_attr, feature_dtype)
+
+        file_name = os.path.join("X", f"scene_{frame}_{c}.npz")
+        np.savez(os.path.join(save_path, file_name), x=x, edge_index=edge_index, edge_attr=edge_attr, y=y[nodes])
+        clusters.append((file_name, len(nodes)))
+
+    num_classes = 2 if class_names is None else len(class_names) + 1
+
+    return clusters, np.bincount(y, minlength=num_classes)
+
+
+def build_scenes(args):
+    """
+    build_scene on a tuple of arguments, for the process pool
+    """
+    return build_scene(*args)
+
+
+class Dataset(GeometricDataset):
+    def __init__(self, path_dataset=None, path=None, classes=CLASSES, radius=RADIUS, max_neighbors=MAX_NEIGHBORS,
+                 cell_size=CELL_SIZE, max_points=MAX_POINTS, feature_dtype=np.float32, num_workers=None, transform=None):
+        """
+        Initializes the dataset of the scene graphs: one graph per frame of
+        the KITTI training set, partitioned in spatially coherent clusters of
+        at most max_points points. The items are the clusters, so a batch of
+        batch_size items holds at most batch_size * max_points points however
+        large the frames are, and the targets are per point (data.y is [N]).
+        The clusters are built once and loaded on access.
+        Parameters
+        ----------
+        path_dataset : str
+            The KITTI training folder (velodyne/, label_2/, calib/)
+        path : str
+            The directory where the clusters are saved
+        classes : list of str
+            Classes of the points after the background, None for objectness
+            (background or any labelled object)
+        radius : float
+            Radius of the graph in meters, capped to max_neighbors neighbours per point
+        cell_size : float
+            Side of the bird's eye view cells, split until they hold max_points points
+        feature_dtype : type
+            Storage dtype of the node and edge features
+        num_workers : int
+            Number of processes building the frames, defaults to the number of cores (see resources.py)
+        """
+        self.path_dataset = path_dataset
+        self.path = path
+        self.params = {"classes": classes, "radius": radius, "max_neighbors": max_neighbors, "cell_size": cell_size,
+                       "max_points": max_points, "feature_dtype": np.dtype(feature_dtype).name,
+                       "format": utils.GRAPH_FORMAT}
+        self.num_workers = num_workers
+        self.cluster_files = []
+        self.groups = []
+        self.label_counts = None
+        self.classes = [BACKGROUND] + (list(classes) if classes is not None else ["Object"])
+        self.eval_transform = None
+
+        super(Dataset, self).__init__(path, transform)
+
+    def processed_file_names(self) -> str | List[str] | Tuple:
+        return []
+
+    def get_class_weights(self):
+        """
+        Get the weights for each class, from the number of points of the class
+        Returns
+        -------
+        torch.Tensor
+            The weights for each class
+        """
+
+        # Compute the weights, the classes without points get the weight of a single point
+        weights = 1 / np.maximum(self.label_counts, 1)
+
+        # Normalize the weights
+        weights = weights / np.sum(weights)
+
+        # Convert to tensor
+        weights = torch.Tensor(weights)
+
+        return weights
+
+    def build(self):
+        """
+        Build the clusters of every frame on a process pool and write the index
+        """
+        POINT_CLOUDS_PATH = os.path.join(self.path_dataset, "velodyne")
+        LABELS_PATH = os.path.join(self.path_dataset, "label_2")
+        CALIB_PATH = os.path.join(self.path_dataset, "calib")
+
+        # Create the save path
+        os.makedirs(os.path.join(self.path, "X"), exist_ok=True)
+
+        # List and sort all the files, the frame is the index in the sorted lists as in the preprocessing
+        point_cloud_files = sorted(os.path.join(POINT_CLOUDS_PATH, x) for x in os.listdir(POINT_CLOUDS_PATH))
+        label_files = sorted(os.path.join(LABELS_PATH, x) for x in os.listdir(LABELS_PATH))
+        calib_files = sorted(os.path.join(CALIB_PATH, x) for x in os.listdir(CALIB_PATH))
+
+        # Check if the number of files is the same
+        assert len(point_cloud_files) == len(label_files) == len(calib_files)
+
+        params = self.params
+        class_names = params["classes"]
+        tasks = [(point_cloud_file, label_file, calib_file, self.path, frame, class_names, params["radius"],
+                  params["max_neighbors"], params["cell_size"], params["max_points"], params["feature_dtype"])
+                 for frame, (point_cloud_file, label_file, calib_file) in enumerate(zip(point_cloud_files, label_files, calib_files))]
+
+        clusters = []
+        label_counts = np.zeros(len(self.classes), dtype=np.int64)
+
+        resources_plan = resources.plan("decode", self.num_workers)
+        with tracing.span("dataset.build_scenes", num_frames=len(tasks)), \
+                ProcessPoolExecutor(max_workers=resources_plan["processes"], initializer=resources.limit_threads,
+                                    initargs=(resources_plan["threads"],)) as executor:
+            for frame, (frame_clusters, frame_counts) in enumerate(tqdm(executor.map(build_scenes, tasks), desc="Progress", total=len(tasks))):
+                for file_name, num_points in frame_clusters:
+                    clusters.append({"file": file_name, "frame": frame, "num_points": int(num_points)})
+                label_counts += frame_counts
+
+        index = {"params": params, "classes": self.classes, "label_counts": label_counts.tolist(), "clusters": clusters}
+
+        # Written last, its presence marks the dataset as complete
+        with open(os.path.join(self.path, INDEX + ".tmp"), "w") as f:
+            json.dump(index, f, indent=1)
+        os.replace(os.path.join(self.path, INDEX + ".tmp"), os.path.join(self.path, INDEX))
+
+        return index
+
+    def process(self):
+        print("Processing dataset")
+        if self.path is None:
+            return
+
+        index = None
+        if os.path.exists(os.path.join(self.path, INDEX)):
+            with open(os.path.join(self.path, INDEX)) as f:
+                index = json.load(f)
+
+            # Built with other parameters, build again
+            if index["params"] != json.loads(json.dumps(self.params)):
+                print("Scenes built with", index["params"], "building them again")
+                index = None
+            else:
+                print("Scenes found!, loading the index")
+
+        if index is None:
+            print("Building the scenes")
+            index = self.build()
+
+        self.cluster_files = [os.path.join(self.path, cluster["file"]) for cluster in index["clusters"]]
+        self.groups = np.array([cluster["frame"] for cluster in index["clusters"]])
+        self.label_counts = np.array(index["label_counts"])
+
+        num_points = np.array([cluster["num_points"] for cluster in index["clusters"]])
+
+        # Print the number of items
+        print('Number of items: %d clusters of %d frames, %d points (max %d per cluster)' %
+              (len(self.cluster_files), len(np.unique(self.groups)), num_points.sum(), num_points.max(initial=0)))
+
+        # Print the class distribution
+        print('Class distribution (points):', dict(zip(self.classes, self.label_counts.tolist())))
+
+    def len(self):
+        return len(self.cluster_files)
+
+    def get(self, idx):
+        with np.load(self.cluster_files[idx]) as arrays:
+            data = utils.arrays_to_torch_geometric(arrays['x'], arrays['edge_index'], arrays['edge_attr'])
+            data.y = torch.from_numpy(arrays['y'].astype(np.int64))
+
+        return data
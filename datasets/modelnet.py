@@ -10,10 +10,59 @@ from ordered_set import OrderedSet
 import networkx as nx
 import numpy as np
 from scipy.spatial.distance import pdist, squareform
-from utils import knn_graph, resample_point_cloud
+from utils import knn_graph, resample_point_cloud, compact_graph, arrays_to_torch_geometric, cache_path
+import resources
 import torch_geometric.data as pyg
 
 from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor
+
+SEED = 42
+
+# Number of samples per block read from the HDF5 file, rounded up to whole chunks
+BLOCK_SIZE = 256
+
+
+def block_ranges(dataset, block_size=BLOCK_SIZE):
+    """
+    Split the rows of an HDF5 dataset in blocks aligned with its chunks
+    Returns
+    -------
+    list of tuple
+        The (start, stop) rows of every block
+    """
+    num_rows = dataset.shape[0]
+
+    # Contiguous datasets have no chunks, any block size is aligned
+    chunk_rows = dataset.chunks[0] if dataset.chunks is not None else 1
+    block_rows = max(1, -(-block_size // chunk_rows)) * chunk_rows
+
+    return [(start, min(start + block_rows, num_rows)) for start in range(0, num_rows, block_rows)]
+
+
+def build_block(path, start, stop):
+    """
+    Read a block of samples with one HDF5 read per dataset and build their
+    graphs in a worker process. Only numpy arrays cross the process boundary.
+    """
+    with h5py.File(path, 'r') as f:
+        items = f['data'][start:stop]
+        label_ids = f['label'][start:stop, 0]
+
+    # Seed per block, so that the resampling does not depend on the number of workers
+    np.random.seed(SEED + start)
+
+    samples = []
+    for item, label_id in zip(items, label_ids):
+        # Resample the point cloud to 500 points
+        item = resample_point_cloud(item, 500)
+
+        # Convert to graph with degree 5
+        A = knn_graph(item, label_id, k=5)
+
+        samples.append((*compact_graph(A.x.numpy(), A.edge_index.numpy(), A.edge_attr.numpy()), int(label_id)))
+
+    return samples
 
 CLASS_NAME_TO_ID = {
     'bathtub': 0,
@@ -42,7 +91,7 @@ ID_TO_CLASS_NAME = {
 }
 
 class Dataset(GeometricDataset):
-    def __init__(self, path=None):
+    def __init__(self, path=None, num_workers=None, pre_transform=None):
         """
         Initializes the dataset
         Parameters
@@ -51,13 +100,18 @@ class Dataset(GeometricDataset):
             The data of the dataset
         target : torch.Tensor
             The target of the dataset
+        num_workers : int
+            Number of processes building the graphs, defaults to the number of cores
+        pre_transform : callable
+            Applied once to every graph after loading, e.g. transforms.GCNNorm()
         """
         self.path = path
+        self.num_workers = num_workers
         self.data = []
         self.label = []
         self.classes = OrderedSet()
         
-        super(Dataset, self).__init__(path)
+        super(Dataset, self).__init__(path, pre_transform=pre_transform)
     
     def processed_file_names(self) -> str | List[str] | Tuple:
         return ['data.pt', 'label.pt']
@@ -90,38 +144,35 @@ class Dataset(GeometricDataset):
         path = self.path + '/train.h5'
         
         import os
-        if os.path.exists(path + '.cache'):
+        if os.path.exists(cache_path(path)):
             # Load from cache
             print("Cache found!, loading from cache")
             import pickle
-            with open(path + '.cache', 'rb') as f:
+            with open(cache_path(path), 'rb') as f:
                 self.data, self.label = pickle.load(f)
         
         else:
             print("Cache not found")
 
-            # Load from file
-            f = h5py.File(path, 'r')
+            # Split the file in chunk aligned blocks, the file is closed before the workers start
+            with h5py.File(path, 'r') as f:
+                blocks = block_ranges(f['data'])
 
-            # convert to adjacency matrix
-            for i in tqdm(range(len(f['data'])), desc='Progress'):
-                item = f['data'][i]
-                label_id = f['label'][i][0]
+            # Build the graphs block by block on a process pool, map keeps the order of the blocks
+            resources_plan = resources.plan("decode", self.num_workers)
+            with ProcessPoolExecutor(max_workers=resources_plan["processes"], initializer=resources.limit_threads,
+                                     initargs=(resources_plan["threads"],)) as executor:
+                starts, stops = zip(*blocks) if blocks else ((), ())
+                for samples in tqdm(executor.map(build_block, [path] * len(blocks), starts, stops), desc='Progress', total=len(blocks)):
+                    for x, edge_index, edge_attr, label_id in samples:
+                        A = arrays_to_torch_geometric(x, edge_index, edge_attr, label_id)
 
-                # Resample the point cloud to 500 points
-                item = resample_point_cloud(item, 500)
-
-                # Convert to graph with degree 5
-                A = knn_graph(item, label_id, k=5)
-
-                self.label.append(ID_TO_CLASS_NAME[label_id])
-                self.data.append(A)
-
-            f.close()
+                        self.label.append(ID_TO_CLASS_NAME[label_id])
+                        self.data.append(A)
 
             # Save to cache
             import pickle
-            with open(path + '.cache', 'wb') as f:
+            with open(cache_path(path), 'wb') as f:
                 pickle.dump((self.data, self.label), f)
 
         # Create classes set
@@ -137,6 +188,10 @@ class Dataset(GeometricDataset):
             new_labels.append(new_label)
         self.label = new_labels
 
+        # Precompute per graph attributes once, instead of at every access
+        if self.pre_transform is not None:
+            self.data = [self.pre_transform(data) for data in self.data]
+
         # Print the number of items
         print('Number of items:', len(self.data))
 
@@ -0,0 +1,107 @@
+"""
+CPU data-parallel training with DistributedDataParallel on the gloo backend.
+
+Single machine, spawning the processes locally:
+    python distributed.py
+
+Across nodes, started with torchrun on every node:
+    torchrun --nnodes=2 --nproc_per_node=4 --node_rank=<0|1> \
+        --master_addr=<node 0 address> --master_port=29500 distributed.py
+"""
+import os
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+import resources
+
+BACKEND = "gloo"
+MASTER_ADDR = "127.0.0.1"
+MASTER_PORT = "29500"
+
+
+def setup(backend=BACKEND):
+    """
+    Join the process group described by the torchrun environment variables
+    (RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT) and split the cores of the
+    machine between its local processes
+    :return: (rank, world_size)
+    """
+    dist.init_process_group(backend=backend)
+
+    # One model replica per process, do not let every replica use every core.
+    # train() plans its threads and DataLoader workers within this share.
+    local_world_size = int(os.environ.get("LOCAL_WORLD_SIZE", dist.get_world_size()))
+    resources.limit_threads(resources.share_cpus(local_world_size))
+
+    return dist.get_rank(), dist.get_world_size()
+
+
+def cleanup():
+    dist.destroy_process_group()
+
+
+def all_reduce_mean(value):
+    """
+    Average a python number over all the processes
+    """
+    tensor = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+
+    return tensor.item() / dist.get_world_size()
+
+
+def _local_worker(rank, world_size, fn, args):
+    # Same environment as torchrun on a single node
+    os.environ["RANK"] = str(rank)
+    os.environ["LOCAL_RANK"] = str(rank)
+    os.environ["WORLD_SIZE"] = str(world_size)
+    os.environ["LOCAL_WORLD_SIZE"] = str(world_size)
+    os.environ.setdefault("MASTER_ADDR", MASTER_ADDR)
+    os.environ.setdefault("MASTER_PORT", MASTER_PORT)
+
+    setup()
+    try:
+        fn(*args)
+    finally:
+        cleanup()
+
+
+def launch_local(fn, world_size, *args):
+    """
+    Run fn(*args) in world_size local processes joined in one process group
+    """
+    mp.spawn(_local_worker, args=(world_size, fn, args), nprocs=world_size, join=True)
+
+
+def run_training(dataset_path, model_class_name, hidden_dim, num_epochs, scheduler, batch_size, weight_decay, checkpoint_path):
+    from datasets.kitti import Dataset as KittiDataset
+    from main_train import SEED, train
+    import model
+
+    torch.manual_seed(SEED)
+
+    dataset = KittiDataset(dataset_path)
+    model_class = getattr(model, model_class_name)
+    net = model_class(hidden_dim=hidden_dim, output_dim=len(dataset.classes))
+
+    return train(net, num_epochs, dataset, "cpu", scheduler=scheduler, batch_size=batch_size,
+                 weight_decay=weight_decay, checkpoint_path=checkpoint_path)
+
+
+if __name__ == "__main__":
+    DATASET_PATH = '/Users/mattiaevangelisti/Documents/KITTI/processed'
+    CHECKPOINT_PATH = './last.pt'
+
+    # The batch size is per process, the effective batch size is batch_size * world_size
+    args = (DATASET_PATH, "GraphSage", 64, 100, None, 32, 1e-2, CHECKPOINT_PATH)
+
+    if "RANK" in os.environ:
+        # Started by torchrun
+        setup()
+        try:
+            run_training(*args)
+        finally:
+            cleanup()
+    else:
+        launch_local(run_training, int(os.environ.get("WORLD_SIZE", 4)), *args)
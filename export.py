@@ -0,0 +1,235 @@
+import json
+import numpy as np
+import torch
+from torch import nn
+from torch_geometric.data import Batch, Data
+
+import utils
+from model import *
+from transforms import GCNNorm
+
+# Every KITTI sample is resampled to 3000 points with 5 edges per vertex
+NUM_NODES = 3000
+NUM_EDGES_PER_VERTEX = 5
+NUM_FEATURES = 3
+BATCH_SIZE = 64
+
+
+class TensorInputWrapper(nn.Module):
+    """
+    Wraps a model whose forward takes a torch_geometric batch so that it can be
+    traced with plain tensors (x, edge_index, batch), followed by the other
+    batch attributes the model reads, in the order of input_names
+    """
+    def __init__(self, model, input_names=()):
+        super(TensorInputWrapper, self).__init__()
+        self.model = model
+        self.input_names = list(input_names)
+
+    def forward(self, x, edge_index, batch, *inputs):
+        data = Data(x=x, edge_index=edge_index, batch=batch)
+        for name, value in zip(self.input_names, inputs):
+            data[name] = value
+
+        return self.model(data)
+
+
+def graph_inputs(model):
+    """
+    Batch attributes read by the forward pass of a model besides x,
+    edge_index and batch, and the transform that computes them
+    :return: (list of attribute names, transform or None)
+    """
+    # The normalized adjacency is precomputed, see transforms.GCNNorm
+    if isinstance(model, GraphClassifier) and not model.normalize:
+        return ["gcn_edge_index", "gcn_edge_weight"], GCNNorm()
+
+    return [], None
+
+
+class OnnxGraphSage(nn.Module):
+    """
+    Re-implementation of a trained GraphSage forward pass with plain torch
+    operations that export to ONNX: BatchNorm, two mean-aggregating SAGEConv
+    layers and a global max pool over graphs of num_nodes nodes each
+    """
+    def __init__(self, model, batch_size, num_nodes):
+        super(OnnxGraphSage, self).__init__()
+        self.model = model
+        self.batch_size = batch_size
+        self.num_nodes = num_nodes
+
+    def mean_aggregate(self, x, edge_index, degree):
+        # Mean of the neighbour features, aggregated at the target nodes
+        src, dst = edge_index[0], edge_index[1]
+        index = dst.unsqueeze(-1).expand(-1, x.size(1))
+        aggr = torch.zeros_like(x).scatter_add(0, index, x[src])
+
+        return aggr / degree
+
+    def sage_conv(self, conv, x, edge_index, degree):
+        # The aggregation is linear, so it runs on the smaller side of lin_l
+        if conv.lin_l.weight.size(0) < x.size(1):
+            aggr = self.mean_aggregate(F.linear(x, conv.lin_l.weight), edge_index, degree) + conv.lin_l.bias
+        else:
+            aggr = conv.lin_l(self.mean_aggregate(x, edge_index, degree))
+
+        return aggr + conv.lin_r(x)
+
+    def forward(self, x, edge_index):
+        # In-degree of every node, shared by both layers
+        dst = edge_index[1].unsqueeze(-1)
+        ones = torch.ones_like(dst, dtype=x.dtype)
+        degree = torch.zeros_like(x[:, :1]).scatter_add(0, dst, ones).clamp(min=1)
+
+        # Normalization
+        x = self.model.norm.module(x)
+
+        # Embedding
+        x = F.leaky_relu(self.sage_conv(self.model.conv1, x, edge_index, degree))
+        x = F.leaky_relu(self.sage_conv(self.model.conv2, x, edge_index, degree))
+
+        # Pooling, the graphs of the batch are contiguous and have the same size
+        x = x.view(self.batch_size, self.num_nodes, -1).amax(dim=1)
+
+        return self.model.classifier(x)
+
+
+def make_example_batch(batch_size=BATCH_SIZE, num_nodes=NUM_NODES, k=NUM_EDGES_PER_VERTEX, num_features=NUM_FEATURES,
+                       transform=None):
+    """
+    Create a batch of random fixed size kNN graphs, used to materialise the
+    lazy modules and as example input for tracing
+    :param transform: applied to the graph before batching, see graph_inputs
+    """
+    point_cloud = np.random.rand(num_nodes, num_features).astype(np.float32)
+    data = utils.knn_graph(point_cloud, 0, k)
+    if transform is not None:
+        data = transform(data)
+
+    # All the graphs of the batch share the same topology, only the size matters
+    return Batch.from_data_list([data] * batch_size)
+
+
+def materialize(model, example):
+    """
+    Run a single forward pass so that the lazy (in_channels=-1) modules get
+    their shapes, then switch the model to evaluation mode
+    """
+    model.eval()
+    with torch.no_grad():
+        model(example)
+
+    return model
+
+
+def export_torchscript(model, path, batch_size=BATCH_SIZE, num_nodes=NUM_NODES, k=NUM_EDGES_PER_VERTEX):
+    """
+    Export a model to a frozen TorchScript module for fixed input sizes
+    :param model: GraphSage or GraphClassifier, trained or freshly initialised
+    :param path: output file
+    :param batch_size: number of graphs per batch
+    :param num_nodes: number of nodes of every graph
+    :param k: number of edges per vertex
+    :return: the traced module
+    """
+    input_names, transform = graph_inputs(model)
+    example = make_example_batch(batch_size, num_nodes, k, transform=transform)
+    model = materialize(model, example)
+
+    # Trace with tensor inputs, the shapes of the example are baked into the graph
+    wrapper = TensorInputWrapper(model, input_names).eval()
+    inputs = (example.x, example.edge_index, example.batch) + tuple(example[name] for name in input_names)
+    with torch.no_grad():
+        traced = torch.jit.trace(wrapper, inputs)
+    traced = torch.jit.freeze(traced)
+
+    # Store the input sizes next to the module so that inference can pad the batches
+    meta = {
+        "model": type(model).__name__,
+        "batch_size": batch_size,
+        "num_nodes": num_nodes,
+        "k": k,
+        "inputs": input_names,
+    }
+    torch.jit.save(traced, path, _extra_files={"meta.json": json.dumps(meta)})
+
+    return traced
+
+
+def load_torchscript(path):
+    """
+    Load a module exported with export_torchscript
+    :return: (module, meta)
+    """
+    extra_files = {"meta.json": ""}
+    module = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+    meta = json.loads(extra_files["meta.json"])
+
+    return module, meta
+
+
+def export_onnx(model, path, batch_size=BATCH_SIZE, num_nodes=NUM_NODES, k=NUM_EDGES_PER_VERTEX, opset_version=17):
+    """
+    Export a GraphSage model to ONNX for fixed input sizes and check that
+    ONNX Runtime reproduces the PyTorch outputs
+    :param model: GraphSage, trained or freshly initialised
+    :param path: output file
+    :return: maximum absolute difference between the PyTorch and ONNX outputs
+    """
+    if not isinstance(model, GraphSage):
+        raise ValueError(f"ONNX export is only implemented for GraphSage, got {type(model).__name__}")
+
+    example = make_example_batch(batch_size, num_nodes, k)
+    model = materialize(model, example)
+
+    onnx_model = OnnxGraphSage(model, batch_size, num_nodes).eval()
+    with torch.no_grad():
+        torch.onnx.export(
+            onnx_model,
+            (example.x, example.edge_index),
+            path,
+            input_names=["x", "edge_index"],
+            output_names=["y"],
+            dynamic_axes={"edge_index": {1: "num_edges"}},
+            opset_version=opset_version,
+            dynamo=False,
+        )
+
+    return check_onnx_parity(model, path, example)
+
+
+def check_onnx_parity(model, path, example, atol=1e-4):
+    """
+    Compare the outputs of a model and of its ONNX export on the same batch
+    :return: maximum absolute difference between the outputs
+    """
+    from onnx_backend import OnnxPredictor
+
+    with torch.no_grad():
+        expected = model(example).numpy()
+
+    predictor = OnnxPredictor(path)
+    actual = predictor(example.x.numpy(), example.edge_index.numpy())
+
+    max_diff = float(np.max(np.abs(expected - actual)))
+    if max_diff > atol:
+        raise RuntimeError(f"ONNX outputs differ from PyTorch by {max_diff:.2e} (tolerance {atol:.0e})")
+
+    return max_diff
+
+
+if __name__ == "__main__":
+    CLASSES = ["Car", "Pedestrian", "Cyclist"]
+    MODEL_PATH = "./last.pt"
+    EXPORT_PATH = "./last.torchscript.pt"
+    ONNX_EXPORT_PATH = "./last.onnx"
+
+    model = GraphSage(hidden_dim=64, output_dim=len(CLASSES))
+    model.load_state_dict(torch.load(MODEL_PATH, map_location="cpu"))
+
+    export_torchscript(model, EXPORT_PATH)
+    print("Exported model to", EXPORT_PATH)
+
+    max_diff = export_onnx(model, ONNX_EXPORT_PATH)
+    print("Exported model to", ONNX_EXPORT_PATH, "(max abs difference %.2e)" % max_diff)
@@ -0,0 +1,232 @@
+import time
+import numpy as np
+import torch
+from torch_geometric.data import Batch
+from torch_geometric.loader import DataLoader
+
+from model import *
+from utils import cast_batch
+import tracing
+
+BACKENDS = ["eager", "compile", "torchscript", "onnx", "quantized"]
+
+
+class Predictor:
+    """
+    Maps a torch_geometric batch to class probabilities with one of the
+    inference backends. Backends traced for fixed input sizes expose their
+    batch size, partial batches are padded to it.
+    """
+    def __init__(self, fn, backend, batch_size=None):
+        self.fn = fn
+        self.backend = backend
+        self.batch_size = batch_size
+
+    def __call__(self, batch):
+        with torch.no_grad():
+            return self.fn(batch)
+
+
+def load_predictor(path, backend="eager", model_class=GraphSage, hidden_dim=64, output_dim=3):
+    """
+    Load a trained model for inference
+    :param path: state dict saved by training, or module saved by export.py
+    :param backend: one of BACKENDS
+    :param model_class: model to build for the eager and compile backends
+    :return: Predictor
+    """
+    if backend == "torchscript":
+        from export import load_torchscript
+
+        # The attributes after x, edge_index and batch are listed in the meta data (see export.graph_inputs)
+        module, meta = load_torchscript(path)
+        input_names = meta.get("inputs", [])
+        fn = lambda batch: module(batch.x, batch.edge_index, batch.batch, *(batch[name] for name in input_names))
+        return Predictor(fn, backend, meta["batch_size"])
+
+    if backend == "onnx":
+        from onnx_backend import OnnxPredictor
+
+        session = OnnxPredictor(path)
+        fn = lambda batch: torch.from_numpy(session(batch.x.numpy(), batch.edge_index.numpy()))
+        return Predictor(fn, backend, session.batch_size)
+
+    if backend == "quantized":
+        # Quantized models are saved as whole modules by quantize.py
+        model = torch.load(path, map_location="cpu", weights_only=False)
+        return Predictor(model.eval(), backend)
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}, expected one of {BACKENDS}")
+
+    model = model_class(hidden_dim=hidden_dim, output_dim=output_dim)
+    model.load_state_dict(torch.load(path, map_location="cpu"))
+    model.eval()
+
+    if backend == "compile":
+        model = torch.compile(model, dynamic=False)
+
+    return Predictor(model, backend)
+
+
+def pad_batch(batch, batch_size):
+    """
+    Pad a partial batch to batch_size graphs by repeating its last graph
+    """
+    data_list = batch.to_data_list()
+    data_list += [data_list[-1]] * (batch_size - len(data_list))
+
+    return Batch.from_data_list(data_list)
+
+
+def predict(predictor, dataset, batch_size=64):
+    """
+    Run batch inference over a dataset
+    :param predictor: Predictor returned by load_predictor
+    :param dataset: dataset or list of torch_geometric data objects
+    :param batch_size: used when the predictor does not fix its own batch size
+    :return: (predicted class ids, confidences) as tensors
+    """
+    if predictor.batch_size is not None:
+        batch_size = predictor.batch_size
+
+    loader = DataLoader(dataset=dataset, batch_size=batch_size, shuffle=False)
+
+    y_pred_all = []
+    y_conf_all = []
+    for data_batch in loader:
+        num_graphs = data_batch.num_graphs
+
+        if predictor.batch_size is not None and num_graphs < batch_size:
+            data_batch = pad_batch(data_batch, batch_size)
+        data_batch = cast_batch(data_batch)
+
+        with tracing.span("inference.batch", backend=predictor.backend, num_graphs=num_graphs):
+            y_pred = predictor(data_batch)[:num_graphs]
+
+        y_conf, y_class = y_pred.max(dim=1)
+        y_pred_all.append(y_class)
+        y_conf_all.append(y_conf)
+
+    return torch.cat(y_pred_all), torch.cat(y_conf_all)
+
+
+class CascadePredictor:
+    """
+    Two stage inference: every graph is first classified by a cheap predictor
+    on a low resolution copy built by small_transform, only the graphs whose
+    confidence is below the threshold are escalated to the full predictor
+    """
+    def __init__(self, small, full, threshold, small_transform=None):
+        self.small = small
+        self.full = full
+        self.threshold = threshold
+        if small_transform is None:
+            import transforms
+
+            small_transform = transforms.student_transform()
+
+        self.small_transform = small_transform
+
+    def low_resolution(self, dataset):
+        return [self.small_transform(dataset[idx].clone()) for idx in range(len(dataset))]
+
+    def predict(self, dataset, batch_size=64):
+        """
+        :return: (predicted class ids, confidences, early exit mask) as tensors
+        """
+        with tracing.span("inference.cascade.low_resolution"):
+            low_resolution = self.low_resolution(dataset)
+
+        y_class, y_conf = predict(self.small, low_resolution, batch_size)
+        exited = y_conf >= self.threshold
+        tracing.count("inference.cascade.early_exits", int(exited.sum()))
+
+        escalated = torch.nonzero(~exited).flatten()
+        if len(escalated) > 0:
+            y_class_full, y_conf_full = predict(self.full, [dataset[int(idx)] for idx in escalated], batch_size)
+            y_class[escalated] = y_class_full
+            y_conf[escalated] = y_conf_full
+
+        return y_class, y_conf, exited
+
+
+def calibrate_threshold(small_class, small_conf, full_class, y_true, max_accuracy_drop=0.0):
+    """
+    Lowest confidence threshold, i.e. most early exits, for which the cascade
+    loses at most max_accuracy_drop accuracy with respect to the full model
+    :return: (threshold, cascade accuracy, fraction of early exits)
+    """
+    small_correct = (small_class == y_true).numpy()
+    full_correct = (full_class == y_true).numpy()
+    small_conf = small_conf.numpy()
+    target = full_correct.mean() - max_accuracy_drop
+
+    # Exiting the k most confident graphs, for every k
+    order = np.argsort(-small_conf, kind="stable")
+    correct = np.concatenate([[0], np.cumsum(small_correct[order])]) + \
+              np.concatenate([np.cumsum(full_correct[order][::-1])[::-1], [0]])
+    accuracy = correct / len(y_true)
+
+    # Only cut between different confidences, equal ones exit together
+    valid = np.concatenate([[True], small_conf[order][1:] < small_conf[order][:-1], [True]])
+
+    num_exits = max(k for k in range(len(y_true) + 1) if valid[k] and accuracy[k] >= target)
+    threshold = small_conf[order][num_exits - 1] if num_exits > 0 else np.inf
+
+    return float(threshold), accuracy[num_exits], num_exits / len(y_true)
+
+
+def calibrate_cascade(small, full, dataset, small_transform=None, max_accuracy_drop=0.0, batch_size=64):
+    """
+    Build a CascadePredictor with its threshold calibrated on a held-out dataset
+    """
+    cascade = CascadePredictor(small, full, np.inf, small_transform)
+
+    small_class, small_conf = predict(small, cascade.low_resolution(dataset), batch_size)
+    full_class, _ = predict(full, dataset, batch_size)
+    y_true = torch.cat([dataset[idx].y for idx in range(len(dataset))])
+
+    cascade.threshold, accuracy, exit_rate = calibrate_threshold(small_class, small_conf, full_class, y_true, max_accuracy_drop)
+    print('Calibrated threshold %.4f | accuracy %.4f | early exits %.1f%%' % (cascade.threshold, accuracy, exit_rate * 100))
+
+    return cascade
+
+
+def cascade_report(cascade, dataset, batch_size=64):
+    """
+    Compare the cascade with the full predictor alone, end to end (building
+    the low resolution graphs included)
+    """
+    y_true = torch.cat([dataset[idx].y for idx in range(len(dataset))])
+
+    start_time = time.perf_counter()
+    full_class, _ = predict(cascade.full, dataset, batch_size)
+    time_full = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    cascade_class, _, exited = cascade.predict(dataset, batch_size)
+    time_cascade = time.perf_counter() - start_time
+
+    acc_full = (full_class == y_true).float().mean().item()
+    acc_cascade = (cascade_class == y_true).float().mean().item()
+
+    print('Early exits: %d of %d (%.1f%%)' % (exited.sum().item(), len(exited), exited.float().mean().item() * 100))
+    print('Full model: accuracy %.4f | %.2f sec' % (acc_full, time_full))
+    print('Cascade:    accuracy %.4f | %.2f sec | speed-up %.2fx' % (acc_cascade, time_cascade, time_full / time_cascade))
+
+    return exited.float().mean().item(), acc_cascade - acc_full, time_full / time_cascade
+
+
+if __name__ == "__main__":
+    from datasets.kitti import Dataset as KittiDataset
+
+    DATASET_PATH = '/Users/mattiaevangelisti/Documents/KITTI/processed'
+    MODEL_PATH = './last.torchscript.pt'
+
+    dataset = KittiDataset(DATASET_PATH)
+    predictor = load_predictor(MODEL_PATH, backend="torchscript", output_dim=len(dataset.classes))
+
+    start_time = time.time()
+    y_pred, y_conf = predict(predictor, dataset)
+    print('Inference on %d samples complete in %.2f sec' % (len(y_pred), time.time() - start_time))
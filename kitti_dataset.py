@@ -2,6 +2,7 @@ import os
 import open3d as o3d
 import numpy as np
 import imageio
+import projection
 
 path_to_point_cloud = '/Volumes/Z8 2/3D-Object-Detection/cropped/000000.bin'
 
@@ -92,19 +93,11 @@ def align_img_and_pc(img_dir, pc_dir, calib_dir):
     # print reflectances.shape, pts3d.shape, pts2d_normed.shape
     # assert reflectances.shape[0] == pts3d.shape[1] == pts2d_normed.shape[1]
 
-    rows, cols = img.shape[:2]
+    # Keep the points that fall inside the image and sample their colour
+    r, c, inside = projection.pixel_indices(pts2d_normed[:2].T, img.shape)
+    colors = img[r[inside], c[inside], :3]
 
-    points = []
-    for i in range(pts2d_normed.shape[1]):
-        c = int(np.round(pts2d_normed[0, i]))
-        r = int(np.round(pts2d_normed[1, i]))
-        if c < cols and r < rows and r > 0 and c > 0:
-            color = img[r, c, :]
-            point = [pts3d[0, i], pts3d[1, i], pts3d[2, i], reflectances[i], color[0], color[1], color[2],
-                     pts2d_normed[0, i], pts2d_normed[1, i]]
-            points.append(point)
-
-    points = np.array(points)
+    points = np.column_stack([pts3d[:3, inside].T, reflectances[inside], colors, pts2d_normed[:2, inside].T])
     return points
 
 
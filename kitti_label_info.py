@@ -4,8 +4,15 @@ import os
 # path to the label folder
 LABEL_ROOT = '/Volumes/Z8 2/3D-Object-Detection/training/label_2'
 
+# catalog built by catalog.py, answers without opening the label files
+CATALOG_PATH = '/Volumes/Z8 2/3D-Object-Detection/processed/catalog.npz'
+
 
 def type_of_objects():
+    if os.path.exists(CATALOG_PATH):
+        import catalog
+
+        return catalog.class_counts(catalog.load_catalog(CATALOG_PATH))
 
     label_stat = {}
 
@@ -1,5 +1,7 @@
 from preprocess import kitti as preprocess_kitti
-import os 
+from preprocess import shards
+import argparse
+import os
 
 DATASET_PATH = "/tmp_workspace/KITTI/"
 DATASET_TRAIN_PATH = os.path.join(DATASET_PATH, "training")
@@ -8,13 +10,23 @@ SAVE_PATH = os.path.join(DATASET_PATH, "processed")
 
 
 def main():
+    parser = argparse.ArgumentParser(description="Preprocess the KITTI training set, whole or one shard at a time")
+    parser.add_argument("--shard", type=shards.parse_shard, default=None, help="i/N, preprocess only shard i of N")
+    parser.add_argument("--merge", type=int, default=None, metavar="N", help="merge the N preprocessed shards")
+    parser.add_argument("--local", type=int, default=None, metavar="N", help="preprocess N shards as local processes and merge them")
+    args = parser.parse_args()
+
     # Create the save path
     os.makedirs(SAVE_PATH, exist_ok=True)
 
-    # Process the training dataset
-    preprocess_kitti.preprocess(DATASET_TRAIN_PATH, SAVE_PATH)
+    if args.merge is not None:
+        shards.merge(SAVE_PATH, args.merge)
+    elif args.local is not None:
+        shards.preprocess_local(DATASET_TRAIN_PATH, SAVE_PATH, args.local)
+    else:
+        # Process the training dataset
+        preprocess_kitti.preprocess(DATASET_TRAIN_PATH, SAVE_PATH, shard=args.shard)
 
 
 if __name__ == '__main__':
     main()
-    
\ No newline at end of file
@@ -1,30 +1,123 @@
-import datetime
+import copy
 import random
 import time
 import torch
-import matplotlib
 import numpy as np
-import pandas as pd
-import seaborn as sn
 from tqdm import tqdm
 from torch import optim
-from matplotlib import pyplot as plt
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+from torch_geometric.data import Batch
 from torch_geometric.loader import DataLoader
 from sklearn import metrics as sk_metrics
-from sklearn.model_selection import train_test_split
 from model import *
-from dataset import Dataset
-from datasets.kitti import Dataset as KittiDataset
-from datasets.modelnet import Dataset as ModelNetDataset
-from skorch import NeuralNetClassifier
-from sklearn.model_selection import GridSearchCV
+from distributed import all_reduce_mean
+from utils import cast_batch
+import resources
+import tracing
+
+# The dataset modules, pandas, matplotlib, sklearn.model_selection and the
+# quantization tooling are imported by the functions that use them, so that
+# importing this module for train() stays fast
 
 import warnings
 warnings.filterwarnings("ignore")
 
 SEED = 42
 
-def train(model, num_epochs, dataset, device, scheduler=None, batch_size=64, weight_decay=1e-2, dtype=torch.float32):
+def split_dataset(dataset):
+    """
+    Split a dataset in train, validation and test sets (70/15/15). The splits
+    are views on the dataset, so its transforms keep being applied on access.
+    The datasets whose items are parts of a larger sample (groups, e.g. the
+    frame of every cluster of datasets/kitti_scene.py) are split by group,
+    so that no sample is seen in two splits.
+    """
+    from sklearn.model_selection import train_test_split
+
+    groups = getattr(dataset, 'groups', None)
+    if groups is not None and len(groups):
+        groups = np.asarray(groups)
+        group_ids = np.unique(groups)
+        groups_train, groups_test = train_test_split(group_ids, test_size=0.15, random_state=42, shuffle=True)
+        groups_train, groups_valid = train_test_split(groups_train, test_size=0.15, random_state=42, shuffle=True)
+
+        indices_train = np.flatnonzero(np.isin(groups, groups_train))
+        indices_valid = np.flatnonzero(np.isin(groups, groups_valid))
+        indices_test = np.flatnonzero(np.isin(groups, groups_test))
+    else:
+        indices = np.arange(len(dataset))
+        indices_train, indices_test = train_test_split(indices, test_size=0.15, random_state=42, shuffle=True)
+        indices_train, indices_valid = train_test_split(indices_train, test_size=0.15, random_state=42, shuffle=True)
+
+    dataset_train = dataset.index_select(indices_train)
+    dataset_valid = dataset.index_select(indices_valid)
+    dataset_test = dataset.index_select(indices_test)
+
+    # Augmentations only apply to the train split
+    eval_transform = getattr(dataset, 'eval_transform', None)
+    if eval_transform is not None:
+        dataset_valid.transform = eval_transform
+        dataset_test.transform = eval_transform
+
+    return dataset_train, dataset_valid, dataset_test
+
+def make_loader(dataset, batch_size, device, shuffle=False, sampler=None, num_workers=0):
+    """
+    DataLoader that builds the batches in num_workers persistent worker
+    processes and prefetches them into pinned memory for accelerators
+    """
+    if num_workers == 0:
+        return DataLoader(dataset=dataset, batch_size=batch_size, shuffle=shuffle, sampler=sampler)
+
+    return DataLoader(dataset=dataset, batch_size=batch_size, shuffle=shuffle, sampler=sampler,
+                      num_workers=num_workers, persistent_workers=True, prefetch_factor=4,
+                      pin_memory=device.type != 'cpu', worker_init_fn=resources.dataloader_worker_init)
+
+def distillation_dataset(teacher, dataset, student_transform, batch_size=64, device="cpu"):
+    """
+    Copy of an in-memory dataset with the graphs rebuilt by student_transform,
+    each carrying the class probabilities of the teacher on the full graph
+    (soft_target). The datasets building their graphs on access (e.g.
+    datasets/kitti_crops.py) are refused, the soft targets would be lost.
+    """
+    # The soft targets are attached to the graphs held in dataset.data, returned as they are by get()
+    data = getattr(dataset, 'data', None)
+    if not isinstance(data, list) or len(data) != len(dataset) or dataset.transform is not None:
+        raise TypeError(f"{type(dataset).__module__}.{type(dataset).__name__} builds its graphs on access, "
+                        f"distillation needs a dataset holding them in memory (datasets/kitti.py, datasets/modelnet.py)")
+
+    device = torch.device(device)
+    teacher = teacher.to(device).eval()
+
+    soft_targets = []
+    with torch.no_grad():
+        for data_batch in DataLoader(dataset, batch_size=batch_size):
+            soft_targets.append(teacher(cast_batch(data_batch.to(device))).cpu())
+    soft_targets = torch.cat(soft_targets)
+
+    student_dataset = copy.copy(dataset)
+    student_dataset.data = []
+    for idx in range(len(dataset)):
+        data = student_transform(dataset[idx].clone())
+        data.soft_target = soft_targets[idx:idx + 1]
+        student_dataset.data.append(data)
+
+    return student_dataset
+
+def distillation_loss(y_pred, soft_target, temperature):
+    """
+    KL divergence between the teacher and student probabilities softened by
+    the temperature, scaled by temperature^2 to keep the gradient magnitude.
+    The models end with a softmax, so the logits are recovered as log(p).
+    """
+    log_student = F.log_softmax(torch.log(y_pred.clamp_min(1e-8)) / temperature, dim=1)
+    teacher = F.softmax(torch.log(soft_target.clamp_min(1e-8)) / temperature, dim=1)
+
+    return F.kl_div(log_student, teacher, reduction='batchmean') * temperature ** 2
+
+def train(model, num_epochs, dataset, device, scheduler=None, batch_size=64, weight_decay=1e-2, dtype=torch.float32, checkpoint_path=None, num_workers=0,
+          distill_temperature=None, distill_alpha=0.5):
     # Save the start time of the training
     very_start_time = time.time()
 
@@ -43,6 +136,40 @@ def train(model, num_epochs, dataset, device, scheduler=None, batch_size=64, wei
     # Set the model
     model = model.to(device)
 
+    # Distributed data parallel mode, the process group is set up by distributed.py
+    distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+    is_main_process = not distributed or torch.distributed.get_rank() == 0
+
+    dataset_train, dataset_valid, dataset_test = split_dataset(dataset)
+
+    # torch gets the cores left by the DataLoader workers
+    resources_plan = resources.configure("train", num_workers)
+
+    if is_main_process:
+        resources.report(resources_plan)
+        print("Training set size:", len(dataset_train))
+        print("Validation set size:", len(dataset_valid))
+        print("Test set size:", len(dataset_test))
+        print("Sample from the dataset:", dataset_train[0])
+
+    # Every process trains on its own shard of the train split
+    train_sampler = DistributedSampler(dataset_train, shuffle=True, seed=SEED) if distributed else None
+
+    train_loader = make_loader(dataset_train, batch_size, device, shuffle=train_sampler is None, sampler=train_sampler, num_workers=num_workers)
+    valid_loader = make_loader(dataset_valid, batch_size, device, shuffle=True, num_workers=num_workers)
+    test_loader = make_loader(dataset_test, batch_size, device, shuffle=True)
+
+    # Materialise the lazy modules before the optimizer and DDP see the parameters
+    example = cast_batch(Batch.from_data_list([dataset_train[0]]), dtype)
+    model.eval()
+    with torch.no_grad():
+        model(example.to(device))
+
+    # Keep a handle on the bare model for evaluation and checkpoints
+    eval_model = model
+    if distributed:
+        model = DistributedDataParallel(model)
+
     # Set the loss function, optimizer and scheduler
     loss_fn = nn.CrossEntropyLoss(weight=dataset.get_class_weights().to(device))
     #loss_fn = nn.NLLLoss(weight=dataset.get_class_weights().to(device))
@@ -58,24 +185,14 @@ def train(model, num_epochs, dataset, device, scheduler=None, batch_size=64, wei
         lr_scheduler = None
 
     best_acc_value = 0.0
-
-    dataset_train, dataset_test = train_test_split(dataset, test_size=0.15, random_state=42, shuffle=True)
-    dataset_train, dataset_valid = train_test_split(dataset_train, test_size=0.15, random_state=42, shuffle=True)
-
-    print("Training set size:", len(dataset_train))
-    print("Validation set size:", len(dataset_valid))
-    print("Test set size:", len(dataset_test))
-    print("Sample from the dataset:", dataset_train[0])
-
-    train_loader = DataLoader(dataset=dataset_train, batch_size=batch_size, shuffle=True)
-    valid_loader = DataLoader(dataset=dataset_valid, batch_size=batch_size, shuffle=True)
-    test_loader = DataLoader(dataset=dataset_test, batch_size=batch_size, shuffle=True)
+    checkpoint_saved = False
 
     train_loss_list = []
     valid_loss_list = []
 
-    print("Begin training...")
-    for epoch in tqdm(range(1, num_epochs + 1)):
+    if is_main_process:
+        print("Begin training...")
+    for epoch in tqdm(range(1, num_epochs + 1), disable=not is_main_process):
         y_true_all = []
         y_pred_all = []
         y_conf_all = []
@@ -83,38 +200,48 @@ def train(model, num_epochs, dataset, device, scheduler=None, batch_size=64, wei
         running_train_loss = 0.0
         running_val_loss = 0.0
 
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)
+
         model.train()
-        for data_batch in train_loader:
-            data_batch.x = data_batch.x.to(dtype)
-            x = data_batch.to(device)
-            #x.x = x.x.to(dtype)
+        with tracing.span("train.epoch", epoch=epoch):
+            for data_batch in train_loader:
+                with tracing.span("train.batch"):
+                    # Cast after the transfer, the batch crosses the bus in its storage dtypes
+                    x = cast_batch(data_batch.to(device, non_blocking=True), dtype)
+
+                    y_pred = model(x)
+                    train_loss = loss_fn(y_pred, x.y)
 
-            y_pred = model(x)
-            train_loss = loss_fn(y_pred, x.y)
+                    # Distillation mode, mix in the soft targets of the teacher
+                    if distill_temperature is not None:
+                        train_loss = distill_alpha * distillation_loss(y_pred, x.soft_target, distill_temperature) + \
+                                     (1 - distill_alpha) * train_loss
 
-            optimizer.zero_grad()
-            train_loss.backward()
-            optimizer.step()
+                    optimizer.zero_grad()
+                    train_loss.backward()
+                    optimizer.step()
 
-            running_train_loss += train_loss.item()
+                    running_train_loss += train_loss.item()
 
         if lr_scheduler is not None:
             if scheduler == 'ReduceLROnPlateau':
-                lr_scheduler.step(train_loss)
+                # Average the loss over the processes so that every scheduler takes the same step
+                lr_scheduler.step(all_reduce_mean(train_loss.item()) if distributed else train_loss)
             else:
                 lr_scheduler.step()
 
         train_loss_value = running_train_loss / len(train_loader)
         train_loss_list.append(train_loss_value)
 
-        if epoch % 5 == 0:
-            with torch.no_grad():
-                model.eval()
+        # Validate every 5 epochs and after the last one
+        if (epoch % 5 == 0 or epoch == num_epochs) and is_main_process:
+            with torch.no_grad(), tracing.span("train.validate", epoch=epoch):
+                eval_model.eval()
                 for data_batch in valid_loader:
-                    x = data_batch.to(device)
-                    x.x = x.x.to(dtype)
+                    x = cast_batch(data_batch.to(device), dtype)
                     
-                    y_pred = model(x)
+                    y_pred = eval_model(x)
                     val_loss = loss_fn(y_pred, x.y)
                     running_val_loss += val_loss.item()
                     
@@ -129,28 +256,38 @@ def train(model, num_epochs, dataset, device, scheduler=None, batch_size=64, wei
 
             # Save the model if the accuracy is the best
             if best_acc_value < acc_value:
-                # save_model()
                 best_acc_value = acc_value
 
+                if checkpoint_path is not None:
+                    torch.save(eval_model.state_dict(), checkpoint_path)
+                    checkpoint_saved = True
+
             tqdm.write(f"Completed training epoch {epoch:02d} | " +
                 f"Train loss {train_loss_value:.4f} | " +
                 f"Valid loss {val_loss_value:.4f} | " +
                 f"Accuracy {acc_value:.4f}")
 
+    # Only the main process reports
+    if not is_main_process:
+        return best_acc_value
+
+    # No validation beat an accuracy of 0, the final model is the checkpoint
+    if checkpoint_path is not None and not checkpoint_saved:
+        torch.save(eval_model.state_dict(), checkpoint_path)
+
     # Print total training time
     print('Training complete in %.2f sec' % (time.time() - very_start_time))
 
     # Test the model
-    with torch.no_grad():
-        model.eval()
+    with torch.no_grad(), tracing.span("train.test"):
+        eval_model.eval()
         y_true_all = []
         y_pred_all = []
         y_conf_all = []
         for data_batch in test_loader:
-            x = data_batch.to(device)
-            x.x = x.x.to(dtype)
+            x = cast_batch(data_batch.to(device), dtype)
 
-            y_pred = model(x)
+            y_pred = eval_model(x)
 
             y_pred_all.extend(
                 y_pred.argmax(dim=1, keepdim=True)
@@ -173,6 +310,10 @@ def train(model, num_epochs, dataset, device, scheduler=None, batch_size=64, wei
         print('Test Precision is: %.4f' % precision_value_test)
         print('Test F1 Score is: %.4f' % f1_value_test)
 
+    # Time per stage, with TRACE=1
+    if tracing.is_enabled():
+        tracing.report()
+
     # plt.close()
 
     # plot the training and validation loss
@@ -187,6 +328,36 @@ def train(model, num_epochs, dataset, device, scheduler=None, batch_size=64, wei
 
     return best_acc_value
 
+def distill(teacher, student, dataset, num_epochs, device, num_points=500, k=3, temperature=4.0, alpha=0.5, batch_size=64, checkpoint_path=None):
+    """
+    Train a compact student on smaller graphs (num_points nodes, k neighbours)
+    with the soft targets of a trained teacher, then report the accuracy lost
+    and the throughput gained on the test split
+    """
+    from quantize import evaluate, benchmark
+    import transforms
+
+    student_dataset = distillation_dataset(teacher, dataset, transforms.student_transform(num_points, k), batch_size, device)
+
+    train(student, num_epochs, student_dataset, device, batch_size=batch_size, checkpoint_path=checkpoint_path,
+          distill_temperature=temperature, distill_alpha=alpha)
+
+    # Same test split for both, the splits only depend on the dataset length
+    teacher, student = teacher.cpu(), student.cpu()
+    dataset_test = split_dataset(dataset)[2]
+    student_dataset_test = split_dataset(student_dataset)[2]
+
+    acc_teacher = evaluate(teacher, dataset_test, batch_size)
+    acc_student = evaluate(student, student_dataset_test, batch_size)
+    throughput_teacher = batch_size / benchmark(teacher, dataset_test, batch_size)
+    throughput_student = batch_size / benchmark(student, student_dataset_test, batch_size)
+
+    print('Teacher accuracy: %.4f | %8.1f graphs/sec' % (acc_teacher, throughput_teacher))
+    print('Student accuracy: %.4f | %8.1f graphs/sec' % (acc_student, throughput_student))
+    print('Accuracy lost: %.4f | Throughput gain: %.2fx' % (acc_teacher - acc_student, throughput_student / throughput_teacher))
+
+    return acc_teacher - acc_student, throughput_student / throughput_teacher
+
 def grid_search(epochs, dataset, device, classes, model_class):
     # define hyperparameters to search
     param_grid = {
@@ -196,6 +367,8 @@ def grid_search(epochs, dataset, device, classes, model_class):
         'weight_decay': [0.1, 0.01, 0.001]
     }
 
+    import pandas as pd
+
     # initialize the results dataframe
     results = pd.DataFrame(columns=list(param_grid.keys()) + ['accuracy'])
 
@@ -228,6 +401,8 @@ if __name__ == "__main__":
     random.seed(SEED)
     np.random.seed(SEED)
     torch.manual_seed(SEED)
+
+    import matplotlib
     matplotlib.use('TkAgg')
     # open log.txt in append mode
 
@@ -236,12 +411,16 @@ if __name__ == "__main__":
     device = torch.device('mps')
 
     if True:
+        from datasets.kitti import Dataset as KittiDataset
+
         DATASET_PATH = '/Users/mattiaevangelisti/Documents/KITTI/processed'
         dataset = KittiDataset(DATASET_PATH)
         classes = dataset.classes
         print(classes)
     
     else:
+        from datasets.modelnet import Dataset as ModelNetDataset
+
         DATASET_PATH = '/tmp_workspace/modelnet10_hdf5_2048'
         dataset = ModelNetDataset(DATASET_PATH)
         classes = dataset.classes
@@ -252,7 +431,17 @@ if __name__ == "__main__":
 
     print("The model will be running on", device, "device\n")
 
-    grid_search(10, dataset, device, classes, model_class)
+    DISTILL = False
+    if DISTILL:
+        # Distill a trained grid search winner into a small student for real time inference
+        TEACHER_PATH = './last.pt'
+        teacher = model_class(hidden_dim=256, output_dim=len(classes))
+        teacher.load_state_dict(torch.load(TEACHER_PATH, map_location="cpu"))
+        student = model_class(hidden_dim=32, output_dim=len(classes))
+
+        distill(teacher, student, dataset, 50, device, num_points=500, k=3)
+    else:
+        grid_search(10, dataset, device, classes, model_class)
 
     #best_params = {'scheduler': 'ReduceLROnPlateau', 'batch_size': 32, 'hidden_nodes': 32}
     #model = GraphSage(hidden_dim=best_params['hidden_nodes'], output_dim=len(classes))
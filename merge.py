@@ -1,3 +1,4 @@
+import argparse
 import h5py
 import numpy as np
 
@@ -5,22 +6,117 @@ import numpy as np
 DATASET_PATH_1 = '/tmp_workspace/3d/modelnet10_hdf5_2048/train.h5'
 DATASET_PATH_2 = '/tmp_workspace/3d/modelnet10_hdf5_2048/train1.h5'
 
-# Load 1st Part of the Dataset
-f1 = h5py.File(DATASET_PATH_1, 'r')
+# Rows per chunk of the output datasets
+CHUNK_ROWS = 64
 
-# Load 2nd Part of the Dataset
-f2 = h5py.File(DATASET_PATH_2, 'r')
+# Upper bound of the memory used by one block read from the inputs
+MAX_BLOCK_BYTES = 64 * 1024 * 1024
 
-# Merge the two datasets
-data = np.concatenate((f1['data'][:], f2['data'][:]), axis=0)
-label = np.concatenate((f1['label'][:], f2['label'][:]), axis=0)
 
-# Close the files
-f1.close()
-f2.close()
+class ChunkWriter:
+    """
+    Appends rows to an HDF5 dataset in writes aligned with its chunks, so that
+    no compressed chunk is written twice
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.chunk_rows = dataset.chunks[0]
+        self.offset = 0
+        self.buffer = []
+        self.buffered_rows = 0
 
-# Save the merged dataset
-f = h5py.File(DATASET_PATH_1.replace('train0', 'train'), 'w')
-f.create_dataset('data', data=data)
-f.create_dataset('label', data=label)
-f.close()
+    def write(self, rows):
+        self.buffer.append(rows)
+        self.buffered_rows += rows.shape[0]
+
+        if self.buffered_rows >= self.chunk_rows:
+            self.flush(whole_chunks=True)
+
+    def flush(self, whole_chunks=False):
+        if self.buffered_rows == 0:
+            return
+
+        rows = np.concatenate(self.buffer, axis=0)
+        num_rows = rows.shape[0] - rows.shape[0] % self.chunk_rows if whole_chunks else rows.shape[0]
+
+        self.dataset[self.offset:self.offset + num_rows] = rows[:num_rows]
+        self.offset += num_rows
+
+        self.buffer = [rows[num_rows:]]
+        self.buffered_rows = rows.shape[0] - num_rows
+
+
+def input_blocks(dataset, max_block_bytes=MAX_BLOCK_BYTES):
+    """
+    Yield the rows of an HDF5 dataset in blocks aligned with its chunks
+    """
+    num_rows = dataset.shape[0]
+    row_bytes = max(1, int(np.prod(dataset.shape[1:], dtype=np.int64)) * dataset.dtype.itemsize)
+    chunk_rows = dataset.chunks[0] if dataset.chunks is not None else 1
+
+    # As many whole chunks as fit in the memory budget
+    block_rows = max(1, max_block_bytes // (row_bytes * chunk_rows)) * chunk_rows
+
+    for start in range(0, num_rows, block_rows):
+        yield dataset[start:min(start + block_rows, num_rows)]
+
+
+def merge(input_paths, output_path, chunk_rows=CHUNK_ROWS, compression="gzip", compression_opts=4,
+          max_block_bytes=MAX_BLOCK_BYTES):
+    """
+    Concatenate the datasets of HDF5 files along their first axis, streaming
+    them chunk by chunk so that the inputs may be larger than memory. With a
+    single input, rewrites it with the given chunk shape and compression.
+    :param input_paths: files with the same datasets (e.g. 'data' and 'label')
+    :param output_path: merged file
+    :param chunk_rows: rows per chunk of the output datasets
+    :param compression: h5py compression filter, None to store uncompressed
+    :param compression_opts: compression level
+    """
+    inputs = [h5py.File(path, 'r') for path in input_paths]
+
+    try:
+        names = [name for name in inputs[0].keys() if all(name in f for f in inputs)]
+
+        with h5py.File(output_path, 'w') as out:
+            for name in names:
+                row_shape = inputs[0][name].shape[1:]
+                dtype = inputs[0][name].dtype
+                num_rows = sum(f[name].shape[0] for f in inputs)
+
+                for f in inputs:
+                    if f[name].shape[1:] != row_shape:
+                        raise ValueError(f"Dataset {name} of {f.filename} has rows of shape {f[name].shape[1:]}, expected {row_shape}")
+
+                dataset = out.create_dataset(
+                    name,
+                    shape=(num_rows,) + row_shape,
+                    dtype=dtype,
+                    chunks=(min(chunk_rows, max(num_rows, 1)),) + row_shape,
+                    compression=compression,
+                    compression_opts=compression_opts if compression == "gzip" else None,
+                )
+
+                writer = ChunkWriter(dataset)
+                for f in inputs:
+                    for rows in input_blocks(f[name], max_block_bytes):
+                        writer.write(rows)
+                writer.flush()
+
+                print(f"{name}: {num_rows} rows of shape {row_shape}")
+    finally:
+        for f in inputs:
+            f.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge or compact HDF5 datasets chunk by chunk")
+    parser.add_argument("inputs", nargs="*", default=[DATASET_PATH_1, DATASET_PATH_2])
+    parser.add_argument("--output", default=DATASET_PATH_1.replace('train.h5', 'train_merged.h5'))
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    parser.add_argument("--compression", default="gzip", help="gzip, lzf or none")
+    parser.add_argument("--level", type=int, default=4, help="gzip compression level")
+    args = parser.parse_args()
+
+    compression = None if args.compression == "none" else args.compression
+    merge(args.inputs, args.output, args.chunk_rows, compression, args.level)
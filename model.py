@@ -1,15 +1,21 @@
+import torch
 from torch import nn
 from torch_geometric import nn as gnn
+from torch_geometric.utils import scatter
 from torch.functional import F
 from torch.cuda.amp import autocast
     
 class GraphClassifier(nn.Module):
-    def __init__(self, hidden_dim, output_dim):
+    def __init__(self, hidden_dim, output_dim, normalize=True):
         super(GraphClassifier, self).__init__()
 
-        self.gnn1 = gnn.GCNConv(-1, hidden_dim)
-        self.gnn2 = gnn.GCNConv(hidden_dim, hidden_dim)
-        self.gnn3 = gnn.GCNConv(hidden_dim, hidden_dim)
+        # With normalize=False the graphs carry the normalized adjacency
+        # precomputed by transforms.GCNNorm (gcn_edge_index, gcn_edge_weight)
+        self.normalize = normalize
+
+        self.gnn1 = gnn.GCNConv(-1, hidden_dim, normalize=normalize)
+        self.gnn2 = gnn.GCNConv(hidden_dim, hidden_dim, normalize=normalize)
+        self.gnn3 = gnn.GCNConv(hidden_dim, hidden_dim, normalize=normalize)
 
         self.classifier = nn.Sequential(
             nn.Linear(hidden_dim, output_dim),
@@ -17,17 +23,21 @@ class GraphClassifier(nn.Module):
         )
     
     def forward(self, x):
-        x, edge_index, batch = x.x, x.edge_index, x.batch
+        if self.normalize:
+            edge_index, edge_weight = x.edge_index, None
+        else:
+            edge_index, edge_weight = x.gcn_edge_index, x.gcn_edge_weight
+        x, batch = x.x, x.batch
 
         # Embedding
-        x = self.gnn1(x, edge_index)
+        x = self.gnn1(x, edge_index, edge_weight)
         x = F.leaky_relu(x)
-        x = self.gnn2(x, edge_index)
+        x = self.gnn2(x, edge_index, edge_weight)
         x = F.leaky_relu(x)
-        x = self.gnn3(x, edge_index)
+        x = self.gnn3(x, edge_index, edge_weight)
         x = F.leaky_relu(x)
 
-        x = gnn_global_mean_pool(x, batch)
+        x = gnn.global_mean_pool(x, batch)
 
         x = self.classifier(x)
         
@@ -35,13 +45,13 @@ class GraphClassifier(nn.Module):
 
 class GraphSage(nn.Module):
     '''GraphSAGE'''
-    def __init__(self, hidden_dim, output_dim):
+    def __init__(self, hidden_dim, output_dim, num_features=3):
         super(GraphSage, self).__init__()
 
-        # Normalization
+        # Normalization, of x, y, z and the optional intensity and RGB features
         #self.norm = gnn.GraphNorm(3)
 
-        self.norm = gnn.BatchNorm(3)
+        self.norm = gnn.BatchNorm(num_features)
 
         # GraphSAGE
         self.conv1 = gnn.SAGEConv(-1, hidden_dim)
@@ -71,4 +81,187 @@ class GraphSage(nn.Module):
 
         x = self.classifier(x)
 
-        return x
\ No newline at end of file
+        return x
+
+class HierarchicalGraphSage(nn.Module):
+    '''GraphSAGE with a set abstraction step between the two convolutions'''
+    def __init__(self, hidden_dim, output_dim, num_features=3):
+        super(HierarchicalGraphSage, self).__init__()
+
+        # Normalization
+        self.norm = gnn.BatchNorm(num_features)
+
+        # GraphSAGE, the second layer runs on the centroids only
+        self.conv1 = gnn.SAGEConv(-1, hidden_dim)
+        self.conv2 = gnn.SAGEConv(hidden_dim, hidden_dim//4)
+
+        self.classifier = nn.Sequential(
+            nn.Linear(hidden_dim//4, hidden_dim//4),
+            nn.LeakyReLU(),
+            nn.Linear(hidden_dim//4, output_dim),
+            nn.Softmax(dim=1)
+        )
+
+    def forward(self, x):
+        # The downsampling is precomputed by transforms.SetAbstraction
+        data = x
+        x, edge_index, batch = data.x, data.edge_index, data.batch
+
+        # Normalization
+        x = self.norm(x)
+
+        # Embedding of all the nodes
+        x = self.conv1(x, edge_index)
+        x = F.leaky_relu(x)
+
+        # Set abstraction: max pool every cluster into its centroid
+        num_centroids = data.centroid_index.size(0)
+        mapping = torch.empty(x.size(0), dtype=torch.long, device=x.device)
+        mapping[data.centroid_index] = torch.arange(num_centroids, device=x.device)
+
+        x = scatter(x, mapping[data.cluster_index], dim=0, dim_size=num_centroids, reduce='max')
+
+        # Embedding of the centroids
+        x = self.conv2(x, mapping[data.coarse_edge_index])
+        x = F.leaky_relu(x)
+
+        # Pooling
+        x = gnn.global_max_pool(x, batch[data.centroid_index])
+
+        x = self.classifier(x)
+
+        return x
+
+
+def knn_blockwise(x, batch, k, max_block_elements=2**22):
+    '''
+    kNN graph in feature space of the graphs of a batch, each node connected
+    to its k nearest nodes (itself included) of the same graph. The distances
+    are computed for blocks of rows, so that at most max_block_elements of
+    them are held at once instead of the full N x N matrix of every graph.
+    :return: edge_index from the neighbours to the centres, as in EdgeConv
+    '''
+    # A single graph without batch vector
+    if batch is None:
+        batch = torch.zeros(x.size(0), dtype=torch.long, device=x.device)
+
+    counts = torch.bincount(batch)
+    ptr = torch.cat([counts.new_zeros(1), counts.cumsum(0)])
+
+    # Graphs of the same size are processed together as a dense [B, N, F] tensor
+    if bool((counts == counts[0]).all()):
+        groups = [(0, counts.size(0), int(counts[0]))]
+    else:
+        groups = [(i, i + 1, int(counts[i])) for i in range(counts.size(0))]
+
+    # Flat (neighbour, centre) pairs of every group, the graphs smaller than k have fewer neighbours per node
+    neighbors = []
+    centers = []
+    for first, last, num_nodes in groups:
+        if num_nodes == 0:
+            continue
+
+        start, end = int(ptr[first]), int(ptr[last])
+        dense = x[start:end].view(last - first, num_nodes, -1)
+        squared_norm = (dense * dense).sum(dim=-1)
+        offsets = torch.arange(last - first, device=x.device).view(-1, 1, 1) * num_nodes + start
+        num_neighbors = min(k, num_nodes)
+
+        blocks = []
+        block_rows = max(1, max_block_elements // ((last - first) * num_nodes))
+        for row in range(0, num_nodes, block_rows):
+            rows = dense[:, row:row + block_rows]
+
+            # Squared euclidean distances of the rows to all the nodes of their graph
+            distances = squared_norm[:, row:row + block_rows, None] - 2 * rows @ dense.transpose(1, 2) + squared_norm[:, None, :]
+            blocks.append(distances.topk(num_neighbors, dim=-1, largest=False).indices)
+
+        # Back to node ids of the batch
+        neighbors.append((torch.cat(blocks, dim=1) + offsets).reshape(-1))
+        centers.append(torch.arange(start, end, device=x.device).repeat_interleave(num_neighbors))
+
+    if not neighbors:
+        return torch.empty(2, 0, dtype=torch.long, device=x.device)
+
+    return torch.stack([torch.cat(neighbors), torch.cat(centers)])
+
+
+class DGCNN(nn.Module):
+    '''Dynamic graph CNN, the kNN graph is rebuilt in feature space at every EdgeConv'''
+    def __init__(self, hidden_dim, output_dim, k=10, num_features=3):
+        super(DGCNN, self).__init__()
+
+        self.k = k
+
+        # Normalization
+        self.norm = gnn.BatchNorm(num_features)
+
+        # EdgeConv, the messages are computed from [x_i, x_j - x_i]
+        self.conv1 = gnn.EdgeConv(nn.Sequential(nn.Linear(2 * num_features, hidden_dim), nn.LeakyReLU()), aggr='max')
+        self.conv2 = gnn.EdgeConv(nn.Sequential(nn.Linear(2 * hidden_dim, hidden_dim//4), nn.LeakyReLU()), aggr='max')
+
+        self.classifier = nn.Sequential(
+            nn.Linear(hidden_dim//4, hidden_dim//4),
+            nn.LeakyReLU(),
+            nn.Linear(hidden_dim//4, output_dim),
+            nn.Softmax(dim=1)
+        )
+
+    def forward(self, x):
+        x, batch = x.x, x.batch
+
+        # Normalization
+        x = self.norm(x)
+
+        # Embedding, the graphs are not differentiated through
+        edge_index = knn_blockwise(x.detach(), batch, self.k)
+        x = self.conv1(x, edge_index)
+        edge_index = knn_blockwise(x.detach(), batch, self.k)
+        x = self.conv2(x, edge_index)
+
+        # Pooling
+        x = gnn.global_max_pool(x, batch)
+
+        x = self.classifier(x)
+
+        return x
+
+
+class PointSegmentation(nn.Module):
+    '''GraphSAGE classifying every node, e.g. the points of the clusters of datasets/kitti_scene.py'''
+    def __init__(self, hidden_dim, output_dim, num_features=4):
+        super(PointSegmentation, self).__init__()
+
+        # Normalization, of x, y, z and the intensity
+        self.norm = gnn.BatchNorm(num_features)
+
+        # GraphSAGE
+        self.conv1 = gnn.SAGEConv(-1, hidden_dim)
+        self.conv2 = gnn.SAGEConv(hidden_dim, hidden_dim//4)
+
+        # Every node sees its embedding and the one of its graph
+        self.classifier = nn.Sequential(
+            nn.Linear(2 * (hidden_dim//4), hidden_dim//4),
+            nn.LeakyReLU(),
+            nn.Linear(hidden_dim//4, output_dim),
+            nn.Softmax(dim=1)
+        )
+
+    def forward(self, x):
+        x, edge_index, batch = x.x, x.edge_index, x.batch
+
+        # Normalization
+        x = self.norm(x)
+
+        # Embedding
+        x = self.conv1(x, edge_index)
+        x = F.leaky_relu(x)
+        x = self.conv2(x, edge_index)
+        x = F.leaky_relu(x)
+
+        # Context of the graph, pooled and broadcast back to its nodes
+        x = torch.cat([x, gnn.global_max_pool(x, batch)[batch]], dim=1)
+
+        x = self.classifier(x)
+
+        return x
@@ -0,0 +1,36 @@
+"""
+ONNX Runtime inference backend. Only depends on numpy and onnxruntime so that
+CPU-only deployments do not need to load torch or torch_geometric.
+"""
+import numpy as np
+import onnxruntime as ort
+
+
+class OnnxPredictor:
+    """
+    Runs a model exported with export.export_onnx. The inputs are the node
+    features and the edges of batch_size graphs of num_nodes nodes each.
+    """
+    def __init__(self, path, num_threads=None):
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+
+        # The batch size is fixed at export time
+        self.batch_size = self.session.get_outputs()[0].shape[0]
+
+    def __call__(self, x, edge_index):
+        """
+        :param x: node features, float32 array of shape [batch_size * num_nodes, F]
+        :param edge_index: int array of shape [2, E]
+        :return: class probabilities, array of shape [batch_size, num_classes]
+        """
+        inputs = {
+            "x": np.ascontiguousarray(x, dtype=np.float32),
+            "edge_index": np.ascontiguousarray(edge_index, dtype=np.int64),
+        }
+
+        return self.session.run(None, inputs)[0]
@@ -0,0 +1,400 @@
+"""
+Stage-cached pipeline from the raw KITTI frames to trained and evaluated
+models. Every stage declares its inputs (paths), its parameters and its
+outputs (paths); the stages are run in the order of their dependencies, the
+independent ones concurrently, each in its own process.
+
+A stage is skipped when its fingerprint (parameters, source of the code it
+runs, fingerprints of its inputs) matches the one recorded by its last
+successful run and its outputs still exist. The inputs produced by another
+stage are fingerprinted by the fingerprint of that stage, the external ones
+(the raw dataset) by the size and modification time of their files.
+
+    python pipeline.py                  # run what is out of date
+    python pipeline.py --dry-run        # only show it
+    python pipeline.py --force preprocess
+"""
+import argparse
+import hashlib
+import importlib.util
+import inspect
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import resources
+
+DATASET_PATH = "/tmp_workspace/KITTI/"
+DATASET_TRAIN_PATH = os.path.join(DATASET_PATH, "training")
+SAVE_PATH = os.path.join(DATASET_PATH, "processed")
+RUNS_PATH = os.path.join(DATASET_PATH, "runs")
+
+# Records of the last successful run of every stage
+STATE_DIR = ".pipeline"
+
+
+class Stage:
+    """
+    A step of the pipeline, fn(inputs, outputs, **params) must be a module
+    level function so that it can be run in another process
+    :param inputs: paths read by the stage
+    :param outputs: paths written by the stage
+    :param code: modules whose source is part of the fingerprint, besides fn
+    """
+    def __init__(self, name, fn, inputs=(), outputs=(), params=None, code=()):
+        self.name = name
+        self.fn = fn
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.code = list(code)
+
+
+def hash_path(path):
+    """
+    Fingerprint of a file or directory from the size and modification time of
+    its files, reading their content would take longer than most stages
+    """
+    digest = hashlib.sha256()
+    if os.path.isfile(path):
+        stat = os.stat(path)
+        digest.update(f"{stat.st_size}:{stat.st_mtime_ns}".encode())
+        return digest.hexdigest()
+
+    for directory, dirs, files in os.walk(path):
+        dirs.sort()
+        for file_name in sorted(files):
+            file_path = os.path.join(directory, file_name)
+            stat = os.stat(file_path)
+            digest.update(f"{os.path.relpath(file_path, path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+
+    return digest.hexdigest()
+
+
+def hash_code(stage):
+    """
+    Fingerprint of the source of the stage function and of its code modules,
+    the modules are located without being imported
+    """
+    digest = hashlib.sha256(inspect.getsource(stage.fn).encode())
+    for module in stage.code:
+        with open(importlib.util.find_spec(module).origin, "rb") as f:
+            digest.update(f.read())
+
+    return digest.hexdigest()
+
+
+class Pipeline:
+    """
+    DAG of stages, the dependencies follow from the outputs of a stage being
+    the inputs of another
+    """
+    def __init__(self, stages, state_dir=STATE_DIR):
+        self.stages = {stage.name: stage for stage in stages}
+        self.state_dir = state_dir
+
+        self.producers = {}
+        for stage in stages:
+            for output in stage.outputs:
+                if output in self.producers:
+                    raise ValueError(f"{output} is an output of both {self.producers[output]} and {stage.name}")
+                self.producers[output] = stage.name
+
+        self.dependencies = {stage.name: sorted({self.producers[path] for path in stage.inputs if path in self.producers})
+                             for stage in stages}
+
+        # Topological order, also rejects cycles
+        self.order = []
+        visiting = set()
+
+        def visit(name):
+            if name in self.order:
+                return
+            if name in visiting:
+                raise ValueError(f"Cycle through stage {name}")
+            visiting.add(name)
+            for dependency in self.dependencies[name]:
+                visit(dependency)
+            visiting.discard(name)
+            self.order.append(name)
+
+        for name in self.stages:
+            visit(name)
+
+    def fingerprint(self, name, fingerprints):
+        """
+        :param fingerprints: fingerprints of the stages this one depends on
+        """
+        stage = self.stages[name]
+
+        inputs = {}
+        for path in stage.inputs:
+            if path in self.producers:
+                inputs[path] = fingerprints[self.producers[path]]
+            elif os.path.exists(path):
+                inputs[path] = hash_path(path)
+            else:
+                raise FileNotFoundError(f"Input {path} of stage {name} does not exist")
+
+        description = {"params": stage.params, "code": hash_code(stage), "inputs": inputs}
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+    def record_path(self, name):
+        return os.path.join(self.state_dir, name + ".json")
+
+    def load_record(self, name):
+        if not os.path.exists(self.record_path(name)):
+            return None
+
+        with open(self.record_path(name)) as f:
+            return json.load(f)
+
+    def is_up_to_date(self, name, fingerprint):
+        record = self.load_record(name)
+        return (record is not None and record["fingerprint"] == fingerprint
+                and all(os.path.exists(path) for path in self.stages[name].outputs))
+
+    def stale(self, force=()):
+        """
+        Stages that would run: out of date, forced, or depending on one of them
+        :return: (names of the stale stages in run order, fingerprints)
+        """
+        fingerprints = {}
+        stale = []
+        for name in self.order:
+            fingerprints[name] = self.fingerprint(name, fingerprints)
+
+            # A stage is fingerprinted by its inputs, a forced stage may
+            # produce different outputs with the same fingerprint
+            if (name in force or not self.is_up_to_date(name, fingerprints[name])
+                    or any(dependency in stale for dependency in self.dependencies[name])):
+                stale.append(name)
+
+        return stale, fingerprints
+
+    def run(self, force=(), max_workers=None, dry_run=False):
+        """
+        Run the stale stages, each as soon as the stages it depends on are done
+        :param force: names of stages to run even if up to date
+        :param max_workers: number of stages running at the same time
+        :return: dict stage name -> "cached", "done", "failed" or "skipped"
+        """
+        stale, fingerprints = self.stale(force)
+        status = {name: "cached" for name in self.order if name not in stale}
+
+        for name in self.order:
+            print(f"{name:30s} {'run' if name in stale else 'cached'}")
+
+        if dry_run or not stale:
+            return status
+
+        os.makedirs(self.state_dir, exist_ok=True)
+
+        # A fresh process for every stage, the stages set their own torch,
+        # numpy and thread pool state
+        if max_workers is None:
+            max_workers = min(len(stale), resources.available_cpus())
+        cpus = resources.available_cpus()
+
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=max_workers, mp_context=context, max_tasks_per_child=1) as executor:
+            running = {}
+            start_times = {}
+            pending = list(stale)
+
+            while pending or running:
+                # Stages whose dependencies are done, as many as there are free workers
+                ready = []
+                for name in list(pending):
+                    dependencies = [status.get(dependency) for dependency in self.dependencies[name]]
+                    if any(dependency in ("failed", "skipped") for dependency in dependencies):
+                        status[name] = "skipped"
+                        pending.remove(name)
+                        print(f"Skipping {name}, a stage it depends on failed")
+                    elif all(dependency in ("cached", "done") for dependency in dependencies):
+                        ready.append(name)
+                ready = ready[:max_workers - len(running)]
+
+                # The stages started now share the cores with the ones running
+                share = max(1, cpus // max(1, len(running) + len(ready)))
+
+                for name in ready:
+                    stage = self.stages[name]
+                    for output in stage.outputs:
+                        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+
+                    # Partially rewritten outputs must not look up to date if the stage fails
+                    if os.path.exists(self.record_path(name)):
+                        os.remove(self.record_path(name))
+
+                    print(f"Starting {name} on {share} cores")
+                    start_times[name] = time.time()
+                    running[executor.submit(run_stage, stage.fn, share, stage.inputs, stage.outputs, stage.params)] = name
+                    pending.remove(name)
+
+                if not running:
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    elapsed = time.time() - start_times[name]
+
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        status[name] = "failed"
+                        print(f"Stage {name} failed after {elapsed:.1f} sec: {e!r}")
+                        continue
+
+                    missing = [path for path in self.stages[name].outputs if not os.path.exists(path)]
+                    if missing:
+                        status[name] = "failed"
+                        print(f"Stage {name} did not write {', '.join(missing)}")
+                        continue
+
+                    status[name] = "done"
+                    with open(self.record_path(name), "w") as f:
+                        json.dump({"fingerprint": fingerprints[name], "params": self.stages[name].params,
+                                   "seconds": elapsed, "finished": time.time(), "result": result}, f, indent=2, default=str)
+                    print(f"Finished {name} in {elapsed:.1f} sec")
+
+        return status
+
+
+def run_stage(fn, cpus, inputs, outputs, params):
+    """
+    Run a stage in its worker process, on its share of the cores: the pools
+    and thread limits of the stage are planned on cpus (see resources.py)
+    """
+    os.environ[resources.CPUS_ENV] = str(cpus)
+
+    return fn(inputs, outputs, **params)
+
+
+def dataset_path(cache_path):
+    """
+    Dataset folder of a cache written by datasets/kitti.py (see utils.cache_path)
+    """
+    return cache_path[:cache_path.rindex(".v")]
+
+
+def run_preprocess(inputs, outputs, **params):
+    import shutil
+    import utils
+    from preprocess import kitti as preprocess_kitti
+
+    # Graphs of an earlier run, the manifest of merged shards and the cache
+    # would be loaded instead of the new graphs. The catalog stays valid.
+    save_path = outputs[0]
+    for folder in ["X", "y", "crops"]:
+        shutil.rmtree(os.path.join(save_path, folder), ignore_errors=True)
+    for path in [os.path.join(save_path, "manifest.json"), utils.cache_path(os.path.normpath(save_path))]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    stats_total = preprocess_kitti.preprocess(inputs[0], outputs[0], **params)
+    return {"num_objects": len(stats_total.get("classes", []))}
+
+
+def run_materialize(inputs, outputs):
+    """
+    Decode the graphs into the pickle cache loaded by the dataset
+    """
+    from datasets.kitti import Dataset as KittiDataset
+
+    # A stale cache would be loaded instead of the new graphs
+    if os.path.exists(outputs[0]):
+        os.remove(outputs[0])
+
+    dataset = KittiDataset(inputs[0])
+    return {"num_graphs": len(dataset), "classes": list(dataset.classes)}
+
+
+def run_train(inputs, outputs, model_name, hidden_dim, epochs, batch_size, device="cpu"):
+    import model
+    from datasets.kitti import Dataset as KittiDataset
+    from main_train import train
+
+    dataset = KittiDataset(dataset_path(inputs[0]))
+    network = getattr(model, model_name)(hidden_dim=hidden_dim, output_dim=len(dataset.classes))
+
+    best_accuracy = train(network, epochs, dataset, device, batch_size=batch_size, checkpoint_path=outputs[0])
+    return {"best_valid_accuracy": float(best_accuracy)}
+
+
+def run_evaluate(inputs, outputs, model_name, hidden_dim, batch_size=64):
+    """
+    Accuracy of a checkpoint on the test split used by training
+    """
+    import model
+    from datasets.kitti import Dataset as KittiDataset
+    from inference import load_predictor, predict
+    from main_train import split_dataset
+
+    checkpoint_path, cache_path = inputs
+    dataset = KittiDataset(dataset_path(cache_path))
+    _, _, dataset_test = split_dataset(dataset)
+
+    predictor = load_predictor(checkpoint_path, "eager", getattr(model, model_name), hidden_dim, len(dataset.classes))
+    y_class, y_conf = predict(predictor, dataset_test, batch_size)
+    y_true = [data.y.item() for data in dataset_test]
+
+    metrics = {"model": model_name, "hidden_dim": hidden_dim, "num_test": len(y_true),
+               "accuracy": float((y_class.numpy() == y_true).mean())}
+    with open(outputs[0], "w") as f:
+        json.dump(metrics, f, indent=2)
+
+    return metrics
+
+
+def kitti_pipeline(dataset_path=DATASET_TRAIN_PATH, save_path=SAVE_PATH, runs_path=RUNS_PATH, models=None, epochs=50, batch_size=64):
+    """
+    Preprocessing, dataset cache, then training and evaluation of every model,
+    the models are trained concurrently
+    :param models: list of (model class name, hidden dim)
+    """
+    if models is None:
+        models = [("GraphSage", 64), ("GraphClassifier", 64)]
+
+    import utils
+
+    cache_path = utils.cache_path(os.path.normpath(save_path))
+
+    stages = [
+        Stage("preprocess", run_preprocess, inputs=[dataset_path], outputs=[save_path],
+              params={"k": 10}, code=["preprocess.kitti", "utils", "projection"]),
+        Stage("materialize", run_materialize, inputs=[save_path], outputs=[cache_path],
+              code=["datasets.kitti"]),
+    ]
+
+    for model_name, hidden_dim in models:
+        run_name = f"{model_name}_{hidden_dim}"
+        checkpoint_path = os.path.join(runs_path, run_name + ".pt")
+        metrics_path = os.path.join(runs_path, run_name + ".json")
+
+        stages.append(Stage(f"train_{run_name}", run_train, inputs=[cache_path], outputs=[checkpoint_path],
+                            params={"model_name": model_name, "hidden_dim": hidden_dim, "epochs": epochs, "batch_size": batch_size},
+                            code=["main_train", "model", "transforms", "utils", "datasets.kitti"]))
+        stages.append(Stage(f"evaluate_{run_name}", run_evaluate, inputs=[checkpoint_path, cache_path], outputs=[metrics_path],
+                            params={"model_name": model_name, "hidden_dim": hidden_dim},
+                            code=["inference", "model", "main_train", "utils", "datasets.kitti"]))
+
+    return Pipeline(stages, state_dir=os.path.join(runs_path, STATE_DIR))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the out of date stages of the KITTI pipeline")
+    parser.add_argument("--force", nargs="*", default=[], help="stages to run even if up to date")
+    parser.add_argument("--workers", type=int, default=None, help="stages running at the same time")
+    parser.add_argument("--epochs", type=int, default=50)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    pipeline = kitti_pipeline(epochs=args.epochs)
+    status = pipeline.run(args.force, args.workers, args.dry_run)
+
+    if any(value == "failed" for value in status.values()):
+        raise SystemExit(1)
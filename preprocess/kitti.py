@@ -1,8 +1,10 @@
 import os
 import numpy as np
 import utils
+import projection
+import resources
+import tracing
 import matplotlib.pyplot as plt
-import pickle
 from tqdm import tqdm
 import multiprocessing
 
@@ -10,6 +12,9 @@ DEBUG = False
 
 NUM_VERTEXES_PER_SAMPLE = 500
 NUM_EDGES_PER_VERTEX = 5
+MAX_NEIGHBORS = 16
+MIN_POINTS = 300
+SEED = 42
 
 def draw_box_3d(ax, bbox):
     """
@@ -33,10 +38,10 @@ def draw_box_3d(ax, bbox):
     for edge in edges:
         ax.plot([x[edge[0]], x[edge[1]]], [y[edge[0]], y[edge[1]]], [z[edge[0]], z[edge[1]]], 'r')
 
-def load_velodyne(bin_path):
+def load_velodyne(bin_path, intensity=False):
     obj = np.fromfile(bin_path, dtype=np.float32).reshape(-1, 4)
-    # ignore reflectivity info
-    return obj[:,:3]
+    # ignore reflectivity info, unless used as a feature
+    return obj if intensity else obj[:,:3]
 
 def load_labels(file_path, tr_velo_to_cam, matrix_rectification):
     """Extracts relevant information from label file
@@ -145,13 +150,10 @@ def parse_calib(file_path):
 
     return calib_feature_dict, matrix_tr_velo_to_cam, R_cam_to_rect
 
-def preprocess_sample(point_cloud_file, label_file, calib_file, save_path, sample_idx):
-    # Load calibration
-    _, matrix_tr_velo_to_cam, R_cam_to_rect = parse_calib(calib_file)
-
-    # Load the point cloud
-    point_cloud = load_velodyne(point_cloud_file)
-
+def filter_point_cloud(point_cloud):
+    """
+    Remove the z outliers and the points far from the centre of the frame
+    """
     # Filter ouliers
     z_coords = np.array(point_cloud[:,2])
     z_coords_std = np.std(z_coords)
@@ -164,27 +166,76 @@ def preprocess_sample(point_cloud_file, label_file, calib_file, save_path, sampl
     mask = (z_coords >= lower_threshold) & (z_coords <= upper_threshold)
 
     point_cloud = point_cloud[mask]
-    z_coords = z_coords[mask]
 
     # Remove points that are too far away
-    center = np.mean(point_cloud, axis=0)
-    distance = np.sqrt(np.sum((point_cloud - center)**2, axis=1))
+    center = np.mean(point_cloud[:,:3], axis=0)
+    distance = np.sqrt(np.sum((point_cloud[:,:3] - center)**2, axis=1))
     mask = distance < 15 # 15 meters
-    point_cloud = point_cloud[mask]
-    z_coords = z_coords[mask]
+
+    return point_cloud[mask]
+
+def preprocess_sample(point_cloud_file, label_file, calib_file, save_path, sample_idx, save_crops=False,
+                      intensity=False, image_file=None, objects_to_keep=None, feature_dtype=np.float32,
+                      radius=None, max_neighbors=MAX_NEIGHBORS):
+    """
+    Crop the objects of a frame and save their graphs. The node features are
+    x, y, z, then the intensity if intensity is set, then the RGB colour in
+    [0, 1] sampled from image_file if given (black outside the image).
+    objects_to_keep holds the indices of the objects of the label file to
+    process, selected on the catalog. By default the objects with fewer
+    than MIN_POINTS points are discarded after cropping, the selected ones
+    only if empty. The features are
+    saved as feature_dtype and the edges as uint16 (see utils.compact_graph).
+    The graph is the kNN graph of the points, or their radius graph capped
+    to max_neighbors if a radius is given.
+    """
+    # Seed per frame, so that the resampling does not depend on the worker or shard processing the frame
+    np.random.seed(SEED + sample_idx)
+
+    # Load calibration
+    calib, matrix_tr_velo_to_cam, R_cam_to_rect = parse_calib(calib_file)
+
+    # Load the point cloud
+    with tracing.span("preprocess.load"):
+        point_cloud = load_velodyne(point_cloud_file, intensity)
+
+    # Filter ouliers and far away points
+    with tracing.span("preprocess.filter"):
+        point_cloud = filter_point_cloud(point_cloud)
+
+    # Colour the points with the camera image
+    if image_file is not None:
+        with tracing.span("preprocess.color"):
+            image = plt.imread(image_file)
+            matrix_proj_2 = np.array(calib["calib/matrix_proj_2"]).reshape(4, 4)
+            colors, _ = projection.color_point_cloud(point_cloud, image, matrix_tr_velo_to_cam, R_cam_to_rect, matrix_proj_2)
+
+            # PNG images are read as floats in [0, 1], JPEG ones as uint8
+            if colors.dtype == np.uint8:
+                colors = colors / 255
+
+            point_cloud = np.hstack([point_cloud, colors.astype(np.float32)])
 
     # Load the 3d object labels
-    objects = load_labels(label_file, matrix_tr_velo_to_cam, R_cam_to_rect)
+    with tracing.span("preprocess.labels"):
+        objects = load_labels(label_file, matrix_tr_velo_to_cam, R_cam_to_rect)
     object_classes = objects["classes"]
     object_boxes = objects["box_3d"]
 
     stats = {
         "num_points": [],
-        "classes": []
+        "classes": [],
+        "dropped_classes": [],
+        "objects": []
     }
 
     # For each object in the point cloud
     for j in range(len(object_classes)):
+        # Skip the objects discarded by the catalog predicate before cropping them
+        if objects_to_keep is not None and j not in objects_to_keep:
+            stats["dropped_classes"].append(object_classes[j])
+            continue
+
         # Get the class id and name
         class_name = object_classes[j]
 
@@ -192,33 +243,50 @@ def preprocess_sample(point_cloud_file, label_file, calib_file, save_path, sampl
         bbox_3d = object_boxes[j]
 
         # Get the point cloud inside the bounding box
-        point_cloud_in_box = utils.get_point_cloud_in_bbox3d(point_cloud, bbox_3d)
+        with tracing.span("preprocess.crop"):
+            point_cloud_in_box = utils.get_point_cloud_in_bbox3d(point_cloud, bbox_3d)
 
-        # Discard the bounding boxes with less than 500 points
+        # Discard the bounding boxes with less than MIN_POINTS points. The objects
+        # selected on the catalog are kept down to a single point, whatever the
+        # predicate, an empty box cannot be resampled
         num_points = point_cloud_in_box.shape[0]
+        min_points = MIN_POINTS if objects_to_keep is None else 1
     
-        if num_points < 300:
+        if num_points < min_points:
+            stats["dropped_classes"].append(class_name)
             continue
+
+        # Save the crop before resampling, so that loaders can resample it every epoch
+        if save_crops:
+            np.save(os.path.join(save_path, "crops", f"crop_{sample_idx}_{j}.npy"), point_cloud_in_box.astype(np.float32))
         
         # Resample the point cloud to have the same number of points
-        point_cloud_in_box = utils.resample_point_cloud(point_cloud_in_box, k=3000)
+        with tracing.span("preprocess.resample"):
+            point_cloud_in_box = utils.resample_point_cloud(point_cloud_in_box, k=3000)
 
         # Create the graph
-        G = utils.knn_graph_old(point_cloud_in_box, k=NUM_EDGES_PER_VERTEX)
+        with tracing.span("preprocess.knn" if radius is None else "preprocess.radius", num_points=point_cloud_in_box.shape[0]):
+            if radius is None:
+                x, edge_index, edge_attr = utils.knn_graph_arrays(point_cloud_in_box, k=NUM_EDGES_PER_VERTEX)
+            else:
+                x, edge_index, edge_attr = utils.radius_graph_arrays(point_cloud_in_box, radius, max_neighbors)
+            x, edge_index, edge_attr = utils.compact_graph(x, edge_index, edge_attr, feature_dtype)
 
         # Save the graph
-        with open(os.path.join(save_path, "X", f"graph_{sample_idx}_{j}.pkl"), "wb") as f:
-            pickle.dump(G, f)
+        with tracing.span("preprocess.save"):
+            np.savez(os.path.join(save_path, "X", f"graph_{sample_idx}_{j}.npz"), x=x, edge_index=edge_index, edge_attr=edge_attr,
+                     format=utils.GRAPH_FORMAT)
 
-        # Save the label
-        with open(os.path.join(save_path, "y", f"label_{sample_idx}_{j}.txt"), "w") as f:
-            f.write(class_name)
+            # Save the label
+            with open(os.path.join(save_path, "y", f"label_{sample_idx}_{j}.txt"), "w") as f:
+                f.write(class_name)
 
         stats["num_points"].append(num_points)
         stats["classes"].append(class_name)
+        stats["objects"].append((sample_idx, j))
 
         # Plot the point cloud in 3D
-        if True:          
+        if DEBUG:
             print("Class: {}, Number of points: {}".format(class_name, num_points))
 
             fig = plt.figure()
@@ -248,48 +316,166 @@ def preprocess_sample(point_cloud_file, label_file, calib_file, save_path, sampl
     
     return stats
 
-def preprocess(path_dataset, save_path, k=10):
+def report_stats(stats_total, save_path=None, bins=10):
+    """
+    Print the objects kept and dropped per class and the histogram of the
+    number of points of the kept objects, and save the histograms per class
+    to stats.png in save_path
+    """
+    classes = np.array(stats_total.get("classes", []))
+    num_points = np.array(stats_total.get("num_points", []))
+    dropped = np.array(stats_total.get("dropped_classes", []))
+
+    print("Class                kept  dropped")
+    for class_name in sorted(set(classes) | set(dropped)):
+        print(f"{class_name:16s} {np.sum(classes == class_name):8d} {np.sum(dropped == class_name):8d}")
+
+    if len(num_points) == 0:
+        return
+
+    # Logarithmic bins, the point counts span several orders of magnitude
+    edges = np.unique(np.geomspace(num_points.min(), num_points.max() + 1, bins + 1).astype(int))
+    counts, edges = np.histogram(num_points, bins=edges)
+
+    print("Points per kept object")
+    for count, low, high in zip(counts, edges[:-1], edges[1:]):
+        print(f"  {low:7d} - {high:7d} {count:8d} " + "#" * int(50 * count / counts.max()))
+
+    if save_path is not None:
+        fig, ax = plt.subplots()
+        for class_name in sorted(set(classes)):
+            ax.hist(num_points[classes == class_name], bins=edges, alpha=0.5, label=class_name)
+        ax.set_xscale("log")
+        ax.set_xlabel("Points in the box")
+        ax.set_ylabel("Objects")
+        ax.legend()
+        fig.savefig(os.path.join(save_path, "stats.png"))
+        plt.close(fig)
+
+def preprocess(path_dataset, save_path, k=10, save_crops=False, intensity=False, rgb=False, predicate=None, catalog_path=None, num_workers=None,
+               feature_dtype=np.float32, shard=None, radius=None, max_neighbors=MAX_NEIGHBORS):
+    """
+    Crop the labelled objects of every frame and save them as graphs
+    :param predicate: function of the catalog columns returning the mask of
+                      the objects to keep, see catalog.py. The frames without
+                      any selected object are not read at all.
+    :param catalog_path: catalog used by the predicate, built if missing,
+                         defaults to catalog.npz in save_path. A shard
+                         needs it built beforehand, it covers all the frames
+                         and is shared by the shards.
+    :param num_workers: number of processes, defaults to the number of cores (see resources.py)
+    :param feature_dtype: dtype of the saved node and edge features, np.float16
+                          halves the graphs on disk and in the dataset cache
+    :param radius: build radius graphs (in meters) capped to max_neighbors
+                   neighbours per point instead of kNN graphs
+    :param shard: (i, N) to process only the frames of shard i of N, in its
+                  own folder of save_path with a manifest, see shards.py
+    """
     print("Preprocessing KITTI dataset")
 
+    # The catalog covers the whole dataset, it stays next to the merged dataset
+    if predicate is not None and catalog_path is None:
+        catalog_path = os.path.join(save_path, "catalog.npz")
+
+    # Every shard writes in its own folder, merged by shards.merge
+    if shard is not None:
+        from preprocess import shards
+
+        print("Shard %d of %d" % shard)
+        save_path = shards.shard_path(save_path, *shard)
+
     POINT_CLOUDS_PATH = os.path.join(path_dataset, "velodyne")
     LABELS_PATH = os.path.join(path_dataset, "label_2")
     CALIB_PATH = os.path.join(path_dataset, "calib")
+    IMAGES_PATH = os.path.join(path_dataset, "image_2")
 
     # Create the save path
     if not os.path.exists(os.path.join(save_path, "X")):
         os.makedirs(os.path.join(save_path, "X"))
     if not os.path.exists(os.path.join(save_path, "y")):
         os.makedirs(os.path.join(save_path, "y"))
+    if save_crops and not os.path.exists(os.path.join(save_path, "crops")):
+        os.makedirs(os.path.join(save_path, "crops"))
 
     # List all the files
     point_cloud_files = [os.path.join(POINT_CLOUDS_PATH, x) for x in os.listdir(POINT_CLOUDS_PATH)]
     label_files = [os.path.join(LABELS_PATH, x) for x in os.listdir(LABELS_PATH)]
     calib_files = [os.path.join(CALIB_PATH, x) for x in os.listdir(CALIB_PATH)]
+    image_files = [os.path.join(IMAGES_PATH, x) for x in os.listdir(IMAGES_PATH)] if rgb else [None] * len(calib_files)
 
 
     # Sort the files
     point_cloud_files.sort()
     label_files.sort()
     calib_files.sort()
+    image_files.sort(key=lambda x: x or "")
 
     # Check if the number of files is the same
-    assert len(point_cloud_files) == len(label_files) == len(calib_files)
-
-    # Parallelize the loop using multiprocessing
-    pool = multiprocessing.Pool(processes=1 if DEBUG else None)
+    assert len(point_cloud_files) == len(label_files) == len(calib_files) == len(image_files)
+
+    # Objects to keep in every frame, None to keep all of them
+    if predicate is not None:
+        import catalog as kitti_catalog
+
+        if not os.path.exists(catalog_path):
+            # Every shard would build the catalog of all the frames, concurrently
+            if shard is not None:
+                raise FileNotFoundError(f"No catalog at {catalog_path}, build it once with catalog.build_catalog "
+                                        f"before preprocessing the shards")
+            kitti_catalog.build_catalog(path_dataset, catalog_path)
+
+        selected = kitti_catalog.select(kitti_catalog.load_catalog(catalog_path), predicate)
+        objects_to_keep = {}
+        for frame, obj in zip(selected["frame"], selected["object"]):
+            objects_to_keep.setdefault(int(frame), set()).add(int(obj))
+
+        print("Selected %d objects in %d frames" % (len(selected["frame"]), len(objects_to_keep)))
+
+    # Parallelize the loop using multiprocessing, single threaded workers. The
+    # limits apply in the workers only, the caller keeps its own threads
+    resources_plan = resources.plan("preprocess", 1 if DEBUG else num_workers)
+    resources.report(resources_plan)
+    pool = multiprocessing.Pool(processes=resources_plan["processes"], initializer=resources.limit_threads, initargs=(resources_plan["threads"],))
     results = []
-    for i, (graph_file, label_file, calib_file) in enumerate(zip(point_cloud_files, label_files, calib_files)):
-        results.append(pool.apply_async(preprocess_sample, (graph_file, label_file, calib_file, save_path, i)))
+    for i, (graph_file, label_file, calib_file, image_file) in enumerate(zip(point_cloud_files, label_files, calib_files, image_files)):
+        if predicate is not None and i not in objects_to_keep:
+            continue
+        if shard is not None and not shards.in_shard(i, *shard):
+            continue
+
+        results.append(pool.apply_async(tracing.traced_call, (preprocess_sample, graph_file, label_file, calib_file, save_path, i, save_crops,
+                                                              intensity, image_file, objects_to_keep.get(i) if predicate is not None else None,
+                                                              feature_dtype, radius, max_neighbors)))
 
     stats_total = {}
 
+    frames = [i for i in range(len(point_cloud_files)) if shard is None or shards.in_shard(i, *shard)]
+
     for result in tqdm(results, desc="Progress", total=len(results)):
-        stats = result.get()
+        stats, trace = result.get()
+        tracing.merge(trace)
 
         for stat_name, value in stats.items():
             if stat_name not in stats_total:
                 stats_total[stat_name] = []
             stats_total[stat_name].extend(value)
 
+    pool.close()
+    pool.join()
+
     # Plot stats
-    # TODO
\ No newline at end of file
+    report_stats(stats_total, save_path)
+
+    if tracing.is_enabled():
+        tracing.report()
+        tracing.export_chrome_trace(os.path.join(save_path, "trace.json"))
+        print("Saved trace to", os.path.join(save_path, "trace.json"))
+
+    # Written last, its presence marks the shard as complete
+    if shard is not None:
+        shards.write_manifest(save_path, shard, frames, stats_total,
+                              {"k": k, "save_crops": save_crops, "intensity": intensity, "rgb": rgb,
+                               "feature_dtype": np.dtype(feature_dtype).name, "predicate": predicate is not None,
+                               "radius": radius, "max_neighbors": max_neighbors})
+
+    return stats_total
\ No newline at end of file
@@ -0,0 +1,240 @@
+"""
+Sharded preprocessing: the frames are partitioned in N shards, each shard is
+preprocessed on its own node into its own folder with a manifest, then the
+shards are merged into one dataset:
+
+    python main_preprocess.py --shard 0/4      # on node 0, ... --shard 3/4 on node 3
+    python main_preprocess.py --merge 4        # once all the manifests exist
+    python main_preprocess.py --local 4        # the same with 4 local processes
+
+Frame i (the index of the frame in the sorted file lists, as everywhere in
+the preprocessing) belongs to shard i % N. The graphs are named after their
+frame and object, so their names are unique across the shards, and the
+resampling is seeded per frame, so the merged dataset does not depend on N.
+"""
+import json
+import multiprocessing
+import os
+import shutil
+
+import resources
+from preprocess import kitti as preprocess_kitti
+
+MANIFEST = "manifest.json"
+
+
+def parse_shard(text):
+    """
+    "i/N" -> (i, N)
+    """
+    shard_index, num_shards = (int(value) for value in text.split("/"))
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"Shard {text} should be i/N with 0 <= i < N")
+
+    return shard_index, num_shards
+
+
+def in_shard(frame, shard_index, num_shards):
+    return frame % num_shards == shard_index
+
+
+def shard_path(save_path, shard_index, num_shards):
+    return os.path.join(save_path, f"shard_{shard_index}_of_{num_shards}")
+
+
+def write_manifest(path, shard, frames, stats_total, params):
+    """
+    List the frames of a shard and the graphs it wrote, with their class and
+    number of points, and the parameters of the preprocessing
+    """
+    samples = []
+    for (frame, obj), class_name, num_points in zip(stats_total.get("objects", []), stats_total.get("classes", []),
+                                                    stats_total.get("num_points", [])):
+        samples.append({
+            "frame": int(frame),
+            "object": int(obj),
+            "class": class_name,
+            "num_points": int(num_points),
+            "graph": os.path.join("X", f"graph_{frame}_{obj}.npz"),
+            "label": os.path.join("y", f"label_{frame}_{obj}.txt"),
+        })
+
+    manifest = {
+        "shard": shard[0],
+        "num_shards": shard[1],
+        "params": params,
+        "frames": [int(frame) for frame in frames],
+        "samples": samples,
+        "dropped_classes": list(stats_total.get("dropped_classes", [])),
+    }
+
+    # A manifest is never seen half written
+    with open(os.path.join(path, MANIFEST + ".tmp"), "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(os.path.join(path, MANIFEST + ".tmp"), os.path.join(path, MANIFEST))
+
+
+def load_manifests(save_path, num_shards):
+    """
+    Manifests of all the shards, checked to come from the same preprocessing
+    and to cover disjoint frames
+    """
+    paths = [os.path.join(shard_path(save_path, i, num_shards), MANIFEST) for i in range(num_shards)]
+    missing = [i for i, path in enumerate(paths) if not os.path.exists(path)]
+    if missing:
+        raise FileNotFoundError(f"Shards {missing} of {num_shards} are not complete, no manifest in {save_path}")
+
+    manifests = []
+    for path in paths:
+        with open(path) as f:
+            manifests.append(json.load(f))
+
+    seen_frames = set()
+    for manifest in manifests:
+        if manifest["params"] != manifests[0]["params"]:
+            raise ValueError(f"Shard {manifest['shard']} was preprocessed with {manifest['params']}, "
+                             f"shard 0 with {manifests[0]['params']}")
+        if not seen_frames.isdisjoint(manifest["frames"]):
+            raise ValueError(f"Shard {manifest['shard']} repeats frames of another shard")
+        seen_frames.update(manifest["frames"])
+
+    return manifests
+
+
+def merge(save_path, num_shards):
+    """
+    Move the graphs of all the shards into save_path/X and save_path/y, where
+    datasets/kitti.py reads them, and write the dataset index (manifest.json)
+    where every sample gets its global id, its position in the dataset. The
+    stats of every shard are kept as stats_shard_i_of_N.png and their traces
+    concatenated in trace.json. A merge that was interrupted can be run
+    again, the samples already moved are skipped.
+    :return: the merged manifest
+    """
+    merged_path = os.path.join(save_path, MANIFEST)
+    paths = [shard_path(save_path, i, num_shards) for i in range(num_shards)]
+
+    # Interrupted while removing the shard folders, the dataset is complete
+    if os.path.exists(merged_path):
+        with open(merged_path) as f:
+            merged = json.load(f)
+
+        if merged.get("num_shards") == num_shards:
+            for path in paths:
+                if os.path.exists(path):
+                    shutil.rmtree(path)
+            print("Dataset of %d shards already merged in %s" % (num_shards, save_path))
+            return merged
+
+    manifests = load_manifests(save_path, num_shards)
+
+    folders = ["X", "y"] + (["crops"] if manifests[0]["params"]["save_crops"] else [])
+    for folder in folders:
+        os.makedirs(os.path.join(save_path, folder), exist_ok=True)
+
+    samples = []
+    moved = 0
+    for manifest in manifests:
+        path = shard_path(save_path, manifest["shard"], num_shards)
+
+        for sample in manifest["samples"]:
+            files = [sample["graph"], sample["label"]]
+            if "crops" in folders:
+                files.append(os.path.join("crops", f"crop_{sample['frame']}_{sample['object']}.npy"))
+
+            for file_name in files:
+                source = os.path.join(path, file_name)
+                destination = os.path.join(save_path, file_name)
+
+                # Moved by a previous merge
+                if not os.path.exists(source) and os.path.exists(destination):
+                    continue
+                if os.path.exists(destination):
+                    raise FileExistsError(f"{destination} already exists and is not from shard {manifest['shard']}")
+                os.replace(source, destination)
+                moved += 1
+
+            samples.append({**sample, "shard": manifest["shard"]})
+
+    # The ids follow the sorted file names, the order in which datasets/kitti.py lists an unsharded dataset
+    samples.sort(key=lambda sample: sample["graph"])
+    for sample_id, sample in enumerate(samples):
+        sample["id"] = sample_id
+
+    # Keep the stats of every shard, and concatenate their traces (one process id per shard)
+    events = []
+    for manifest in manifests:
+        path = shard_path(save_path, manifest["shard"], num_shards)
+
+        if os.path.exists(os.path.join(path, "stats.png")):
+            os.replace(os.path.join(path, "stats.png"),
+                       os.path.join(save_path, f"stats_shard_{manifest['shard']}_of_{num_shards}.png"))
+
+        if os.path.exists(os.path.join(path, "trace.json")):
+            with open(os.path.join(path, "trace.json")) as f:
+                events.extend(json.load(f)["traceEvents"])
+
+    if events:
+        with open(os.path.join(save_path, "trace.json"), "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+        print("Saved the traces of the shards to", os.path.join(save_path, "trace.json"))
+
+    merged = {
+        "num_shards": num_shards,
+        "params": manifests[0]["params"],
+        "frames": sorted(frame for manifest in manifests for frame in manifest["frames"]),
+        "samples": samples,
+        "dropped_classes": [name for manifest in manifests for name in manifest["dropped_classes"]],
+    }
+
+    # Written last, its presence marks the merge as complete
+    with open(merged_path + ".tmp", "w") as f:
+        json.dump(merged, f, indent=1)
+    os.replace(merged_path + ".tmp", merged_path)
+
+    # The shard folders only hold their manifest now
+    for path in paths:
+        shutil.rmtree(path)
+
+    print("Merged %d samples of %d frames from %d shards (%d files moved)" % (len(samples), len(merged["frames"]), num_shards, moved))
+    preprocess_kitti.report_stats({"classes": [sample["class"] for sample in samples],
+                                   "num_points": [sample["num_points"] for sample in samples],
+                                   "dropped_classes": merged["dropped_classes"]}, save_path)
+
+    return merged
+
+
+def preprocess_local(path_dataset, save_path, num_shards, num_workers=None, **kwargs):
+    """
+    Run the N shards as N local processes standing in for the nodes, then
+    merge them. The keyword arguments go to preprocess, a predicate has to be
+    a module level function to reach the processes.
+    :param num_workers: pool size of every shard, defaults to its share of the cores
+    """
+    # The shards share one catalog, built once before them
+    if kwargs.get("predicate") is not None:
+        import catalog as kitti_catalog
+
+        if kwargs.get("catalog_path") is None:
+            kwargs["catalog_path"] = os.path.join(save_path, "catalog.npz")
+        if not os.path.exists(kwargs["catalog_path"]):
+            os.makedirs(save_path, exist_ok=True)
+            kitti_catalog.build_catalog(path_dataset, kwargs["catalog_path"], num_workers)
+
+    context = multiprocessing.get_context("spawn")
+    processes = [context.Process(target=preprocess_kitti.preprocess, args=(path_dataset, save_path),
+                                 kwargs={**kwargs, "num_workers": num_workers, "shard": (i, num_shards)})
+                 for i in range(num_shards)]
+
+    # Every shard plans its pool on its share of the cores, as on its own node
+    with resources.cpu_share(num_shards):
+        for process in processes:
+            process.start()
+    for process in processes:
+        process.join()
+
+    failed = [i for i, process in enumerate(processes) if process.exitcode != 0]
+    if failed:
+        raise RuntimeError(f"Shards {failed} of {num_shards} failed")
+
+    return merge(save_path, num_shards)
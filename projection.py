@@ -0,0 +1,69 @@
+import numpy as np
+
+
+def project_points(points, tr_velo_to_cam, r_rect, p):
+    """
+    Project velodyne points into the camera image
+    :param points: point cloud [N, >=3], only the coordinates are used
+    :param tr_velo_to_cam: 4x4 velodyne to camera transform
+    :param r_rect: 4x4 rectifying rotation
+    :param p: 3x4 (or 4x4 padded) projection matrix of the camera
+    :return: pixel coordinates [N, 2] and the mask of the points in front of the camera
+    """
+    homogeneous = np.hstack([points[:, :3], np.ones((points.shape[0], 1), dtype=points.dtype)])
+
+    # Camera reference frame, then image plane
+    points_cam = homogeneous @ (np.asarray(r_rect) @ np.asarray(tr_velo_to_cam)).T
+    in_front = points_cam[:, 2] >= 0
+
+    points_img = points_cam @ np.asarray(p)[:3].T
+    with np.errstate(divide='ignore', invalid='ignore'):
+        uv = points_img[:, :2] / points_img[:, 2:3]
+
+    return uv, in_front
+
+
+def pixel_indices(uv, image_shape, mask=None):
+    """
+    Round pixel coordinates to the nearest pixel and check they fall inside the image
+    :param mask: points to consider, e.g. the ones in front of the camera
+    :return: rows, columns and the mask of the points inside the image
+    """
+    rows, cols = image_shape[:2]
+
+    if mask is None:
+        mask = np.ones(uv.shape[0], dtype=bool)
+
+    # Points outside the mask and at the camera plane have inf or nan coordinates
+    mask = mask & np.isfinite(uv).all(axis=1)
+    uv = np.where(mask[:, None], uv, -1)
+    c = np.round(uv[:, 0]).astype(np.int64)
+    r = np.round(uv[:, 1]).astype(np.int64)
+
+    inside = mask & (c > 0) & (c < cols) & (r > 0) & (r < rows)
+
+    return r, c, inside
+
+
+def sample_colors(image, uv, mask):
+    """
+    Look up the colour of the image at the projected points
+    :return: colours [N, C], zero outside the image, and the mask of the coloured points
+    """
+    r, c, inside = pixel_indices(uv, image.shape, mask)
+
+    colors = np.zeros((uv.shape[0],) + image.shape[2:], dtype=image.dtype)
+    colors[inside] = image[r[inside], c[inside]]
+
+    return colors, inside
+
+
+def color_point_cloud(points, image, tr_velo_to_cam, r_rect, p):
+    """
+    RGB colour of every point of a point cloud, from the camera image
+    :return: colours [N, 3] and the mask of the points seen by the camera
+    """
+    uv, in_front = project_points(points, tr_velo_to_cam, r_rect, p)
+    colors, inside = sample_colors(image, uv, in_front)
+
+    return colors[:, :3], inside
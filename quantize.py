@@ -0,0 +1,164 @@
+import copy
+import time
+import numpy as np
+import torch
+from torch import nn
+from torch.ao import quantization
+from torch_geometric.loader import DataLoader
+from torch_geometric.nn.dense.linear import Linear as GeometricLinear
+from sklearn import metrics as sk_metrics
+
+from model import *
+from utils import cast_batch
+
+CALIBRATION_SIZE = 512
+BATCH_SIZES = [1, 16, 64, 128]
+
+
+def to_torch_linear(model):
+    """
+    Replace the torch_geometric Linear layers (used inside SAGEConv and
+    GCNConv) by equivalent torch.nn.Linear layers, the only ones the torch
+    quantization tooling knows about. The lazy modules must be materialised.
+    """
+    for name, module in model.named_children():
+        if isinstance(module, GeometricLinear):
+            linear = nn.Linear(module.in_channels, module.out_channels, bias=module.bias is not None)
+            linear.weight.data.copy_(module.weight.data)
+            if module.bias is not None:
+                linear.bias.data.copy_(module.bias.data)
+            setattr(model, name, linear)
+        else:
+            to_torch_linear(module)
+
+    return model
+
+
+def wrap_linear(model, qconfig):
+    """
+    Surround every nn.Linear with quantize/dequantize stubs, the message
+    passing and pooling in between stay in float32
+    """
+    for name, module in model.named_children():
+        if isinstance(module, nn.Linear):
+            wrapper = quantization.QuantWrapper(module)
+            wrapper.qconfig = qconfig
+            setattr(model, name, wrapper)
+        else:
+            wrap_linear(module, qconfig)
+
+    return model
+
+
+def quantize_model(model, mode="dynamic", calibration_dataset=None, batch_size=64):
+    """
+    Post-training INT8 quantization of the linear layers of a trained model
+    :param model: materialised GraphSage or GraphClassifier
+    :param mode: "dynamic" (weights only, activations quantized on the fly) or
+                 "static" (activation ranges calibrated on calibration_dataset)
+    :param calibration_dataset: held-out graphs used for static calibration
+    :return: quantized copy of the model
+    """
+    model = to_torch_linear(copy.deepcopy(model)).eval()
+
+    if mode == "dynamic":
+        return quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+    if mode != "static":
+        raise ValueError(f"Unknown quantization mode {mode}")
+
+    if calibration_dataset is None:
+        raise ValueError("Static quantization needs a calibration dataset")
+
+    # Insert observers around the linear layers
+    qconfig = quantization.get_default_qconfig(torch.backends.quantized.engine)
+    model = wrap_linear(model, qconfig)
+    quantization.prepare(model, inplace=True)
+
+    # Calibrate the activation ranges
+    with torch.no_grad():
+        for data_batch in DataLoader(calibration_dataset, batch_size=batch_size):
+            model(cast_batch(data_batch))
+
+    return quantization.convert(model, inplace=True)
+
+
+def evaluate(model, dataset, batch_size=64):
+    """
+    Accuracy of a model on a dataset
+    """
+    y_true_all = []
+    y_pred_all = []
+
+    model.eval()
+    with torch.no_grad():
+        for data_batch in DataLoader(dataset, batch_size=batch_size):
+            y_pred = model(cast_batch(data_batch))
+            y_pred_all.extend(y_pred.argmax(dim=1).cpu().numpy())
+            y_true_all.extend(data_batch.y.flatten().cpu().numpy())
+
+    return sk_metrics.accuracy_score(y_true_all, y_pred_all)
+
+
+def benchmark(model, dataset, batch_size, repeats=10):
+    """
+    Median latency of a model on the first batch of a dataset
+    """
+    data_batch = cast_batch(next(iter(DataLoader(dataset, batch_size=batch_size))))
+
+    times = []
+    with torch.no_grad():
+        model(data_batch)
+        for _ in range(repeats):
+            start_time = time.perf_counter()
+            model(data_batch)
+            times.append(time.perf_counter() - start_time)
+
+    return np.median(times)
+
+
+def compare(float_model, quantized_model, dataset, batch_sizes=BATCH_SIZES):
+    """
+    Report the accuracy delta and the speed-up per batch size of a quantized model
+    """
+    acc_float = evaluate(float_model, dataset)
+    acc_quantized = evaluate(quantized_model, dataset)
+
+    print('Float32 accuracy: %.4f' % acc_float)
+    print('INT8 accuracy: %.4f (delta %+.4f)' % (acc_quantized, acc_quantized - acc_float))
+
+    speedups = {}
+    for batch_size in batch_sizes:
+        time_float = benchmark(float_model, dataset, batch_size)
+        time_quantized = benchmark(quantized_model, dataset, batch_size)
+        speedups[batch_size] = time_float / time_quantized
+
+        print('Batch size %4d | float32 %8.2f ms | int8 %8.2f ms | speed-up %.2fx' %
+              (batch_size, time_float * 1000, time_quantized * 1000, speedups[batch_size]))
+
+    return acc_quantized - acc_float, speedups
+
+
+if __name__ == "__main__":
+    from datasets.kitti import Dataset as KittiDataset
+    from main_train import split_dataset
+
+    DATASET_PATH = '/Users/mattiaevangelisti/Documents/KITTI/processed'
+    MODEL_PATH = './last.pt'
+    QUANTIZED_MODEL_PATH = './last.int8.pt'
+
+    dataset = KittiDataset(DATASET_PATH)
+    dataset_train, dataset_valid, dataset_test = split_dataset(dataset)
+
+    model = GraphSage(hidden_dim=64, output_dim=len(dataset.classes))
+    model.load_state_dict(torch.load(MODEL_PATH, map_location="cpu"))
+    model.eval()
+
+    # Calibrate on part of the validation split, never seen by the optimizer
+    calibration_dataset = dataset_valid[:CALIBRATION_SIZE]
+    quantized_model = quantize_model(model, "static", calibration_dataset)
+
+    compare(model, quantized_model, dataset_test)
+
+    torch.save(quantized_model, QUANTIZED_MODEL_PATH)
+    print("Saved quantized model to", QUANTIZED_MODEL_PATH)
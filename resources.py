@@ -0,0 +1,181 @@
+"""
+Central resource configuration: how many processes every stage starts and
+how many threads (BLAS, OpenMP, torch) each of them uses, so that a pool of
+processes each running a multi-threaded BLAS, or torch using every core next
+to the DataLoader workers, does not oversubscribe the machine.
+
+The cores of a process are the ones it may run on (its affinity, as set by
+taskset or a batch scheduler), or the CPUS environment variable when set. A
+parent running several jobs at once gives each of them its share this way,
+e.g. the concurrent pipeline stages or the local shards.
+
+    plan = resources.configure("train", num_workers=2)
+    resources.report(plan)
+
+Worker processes apply the limits of the plan in their initializer:
+
+    multiprocessing.Pool(plan["processes"], initializer=resources.limit_threads, initargs=(plan["threads"],))
+"""
+import contextlib
+import os
+import sys
+
+CPUS_ENV = "CPUS"
+
+# Read by the BLAS and OpenMP runtimes when they are loaded
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "BLIS_NUM_THREADS",
+                   "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS"]
+
+STAGES = ["preprocess", "decode", "train", "inference"]
+
+
+def available_cpus():
+    """
+    Cores this process may use
+    """
+    if os.environ.get(CPUS_ENV):
+        return max(1, int(os.environ[CPUS_ENV]))
+
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def plan(stage, num_workers=None, cpus=None):
+    """
+    Processes and threads of a stage, the threads of all its processes fit in
+    the cores
+    :param stage: one of STAGES
+    :param num_workers: worker processes asked by the caller (pool or
+                        DataLoader workers), None for the default of the stage
+    :return: dict with the cores, the worker processes, the threads of every
+             worker and the threads of the main process
+    """
+    if cpus is None:
+        cpus = available_cpus()
+
+    if stage in ("preprocess", "decode"):
+        # Independent frames or files, one single threaded process per core
+        processes = min(num_workers or cpus, cpus)
+        threads = max(1, cpus // processes)
+        main_threads = 1
+    elif stage == "train":
+        # Every DataLoader worker takes a core, torch the remaining ones
+        processes = num_workers or 0
+        threads = 1
+        main_threads = max(1, cpus - processes)
+    elif stage == "inference":
+        processes = 0
+        threads = 1
+        main_threads = cpus
+    else:
+        raise ValueError(f"Unknown stage {stage}, expected one of {STAGES}")
+
+    return {"stage": stage, "cpus": cpus, "processes": processes, "threads": threads, "main_threads": main_threads}
+
+
+def limit_threads(num_threads):
+    """
+    Limit the thread pools of this process, and through the environment those
+    of the processes it starts. Used as the initializer of worker processes.
+    """
+    for name in THREAD_ENV_VARS:
+        os.environ[name] = str(num_threads)
+
+    # The runtimes already loaded, e.g. inherited by a forked worker, ignore the environment
+    try:
+        from threadpoolctl import threadpool_limits
+
+        threadpool_limits(num_threads)
+    except ImportError:
+        pass
+
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(num_threads)
+
+
+def dataloader_worker_init(worker_id):
+    """
+    worker_init_fn of the DataLoaders, one thread per worker
+    """
+    limit_threads(1)
+
+
+def configure(stage, num_workers=None):
+    """
+    Plan a stage and limit the threads of this process accordingly
+    :return: the plan, see plan()
+    """
+    stage_plan = plan(stage, num_workers)
+    limit_threads(stage_plan["main_threads"])
+
+    return stage_plan
+
+
+def share_cpus(num_jobs):
+    """
+    Give each of num_jobs concurrent child processes an equal share of the
+    cores, through the environment they inherit
+    :return: cores of every job
+    """
+    cpus = max(1, available_cpus() // num_jobs)
+    os.environ[CPUS_ENV] = str(cpus)
+
+    return cpus
+
+
+@contextlib.contextmanager
+def cpu_share(num_jobs):
+    """
+    share_cpus for the processes started within the block only
+    """
+    previous = os.environ.get(CPUS_ENV)
+    try:
+        yield share_cpus(num_jobs)
+    finally:
+        if previous is None:
+            os.environ.pop(CPUS_ENV, None)
+        else:
+            os.environ[CPUS_ENV] = previous
+
+
+def effective():
+    """
+    Threads actually configured in this process: torch intra and inter op
+    threads, and the thread pools of the loaded BLAS and OpenMP libraries
+    """
+    result = {"cpus": available_cpus(), "env": {name: os.environ.get(name) for name in THREAD_ENV_VARS}}
+
+    if "torch" in sys.modules:
+        torch = sys.modules["torch"]
+        result["torch_threads"] = torch.get_num_threads()
+        result["torch_interop_threads"] = torch.get_num_interop_threads()
+
+    try:
+        from threadpoolctl import threadpool_info
+
+        result["libraries"] = [{"library": info["internal_api"], "threads": info["num_threads"]} for info in threadpool_info()]
+    except ImportError:
+        result["libraries"] = []
+
+    return result
+
+
+def report(stage_plan=None):
+    """
+    Print the plan of a stage and the effective parallelism of this process
+    :return: effective()
+    """
+    result = effective()
+
+    if stage_plan is not None:
+        total = stage_plan["processes"] * stage_plan["threads"] + stage_plan["main_threads"]
+        print(f"Resources {stage_plan['stage']}: {stage_plan['cpus']} cores | {stage_plan['processes']} worker processes "
+              f"x {stage_plan['threads']} threads + {stage_plan['main_threads']} main threads ({total} threads)")
+
+    libraries = ", ".join(f"{library['library']} {library['threads']}" for library in result["libraries"]) or "-"
+    print(f"Effective: torch {result.get('torch_threads', '-')} threads "
+          f"(inter op {result.get('torch_interop_threads', '-')}) | {libraries}")
+
+    return result
@@ -0,0 +1,49 @@
+import pytest
+import torch
+
+import export
+from inference import load_predictor
+from model import GraphClassifier, GraphSage
+
+BATCH_SIZE = 4
+NUM_NODES = 50
+
+
+@pytest.mark.parametrize("model", [GraphSage(hidden_dim=16, output_dim=3),
+                                   GraphClassifier(hidden_dim=16, output_dim=3, normalize=True),
+                                   GraphClassifier(hidden_dim=16, output_dim=3, normalize=False)],
+                         ids=["GraphSage", "GraphClassifier", "GraphClassifier-precomputed"])
+def test_torchscript_matches_eager(tmp_path, model):
+    torch.manual_seed(0)
+    path = str(tmp_path / "model.torchscript.pt")
+    export.export_torchscript(model, path, BATCH_SIZE, NUM_NODES)
+
+    # A new batch, so that nothing of the example is baked into the comparison
+    _, transform = export.graph_inputs(model)
+    batch = export.make_example_batch(BATCH_SIZE, NUM_NODES, transform=transform)
+    with torch.no_grad():
+        expected = model(batch)
+
+    predictor = load_predictor(path, "torchscript")
+    torch.testing.assert_close(predictor(batch), expected, atol=1e-5, rtol=1e-4)
+
+
+def test_torchscript_records_graph_inputs(tmp_path):
+    path = str(tmp_path / "model.torchscript.pt")
+    export.export_torchscript(GraphClassifier(hidden_dim=16, output_dim=3, normalize=False), path, BATCH_SIZE, NUM_NODES)
+
+    _, meta = export.load_torchscript(path)
+    assert meta["inputs"] == ["gcn_edge_index", "gcn_edge_weight"]
+
+
+def test_onnx_matches_eager(tmp_path):
+    pytest.importorskip("onnxruntime")
+
+    torch.manual_seed(0)
+    model = GraphSage(hidden_dim=16, output_dim=3)
+    path = str(tmp_path / "model.onnx")
+    assert export.export_onnx(model, path, BATCH_SIZE, NUM_NODES) < 1e-4
+
+    # Parity on another batch than the one the export was checked on
+    batch = export.make_example_batch(BATCH_SIZE, NUM_NODES)
+    assert export.check_onnx_parity(model, path, batch) < 1e-4
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+import torch
+from scipy.spatial import cKDTree
+from torch_geometric.data import Data
+
+import transforms
+import utils
+
+
+def random_cloud(num_points=400, seed=0):
+    return np.random.default_rng(seed).uniform(0, 1, (num_points, 3)).astype(np.float32)
+
+
+def test_knn_graph_arrays_links_the_nearest_points():
+    points = random_cloud()
+    _, edge_index, _ = utils.knn_graph_arrays(points, k=5)
+
+    # Edges [neighbour, centre], the neighbours of every centre are its 5 nearest points
+    _, indices = cKDTree(points).query(points, k=6)
+    neighbors = edge_index[0].astype(np.int64).reshape(-1, 5)
+    np.testing.assert_array_equal(edge_index[1].reshape(-1, 5), np.arange(len(points))[:, None].repeat(5, axis=1))
+    np.testing.assert_array_equal(np.sort(neighbors, axis=1), np.sort(indices[:, 1:], axis=1))
+
+
+def test_knn_graph_arrays_matches_knn_graph_transform():
+    points = random_cloud()
+    x, edge_index, edge_attr = utils.knn_graph_arrays(points, k=5)
+    online = transforms.KNNGraph(k=5)(Data(pos=torch.from_numpy(points)))
+
+    np.testing.assert_array_equal(x, online.x.numpy())
+    np.testing.assert_array_equal(edge_index.astype(np.int64), online.edge_index.numpy())
+    np.testing.assert_allclose(edge_attr, online.edge_attr.numpy(), rtol=1e-5)
+
+
+def test_knn_graph_matches_knn_graph_arrays():
+    points = random_cloud()
+    data = utils.knn_graph(points, 0, k=5)
+    _, edge_index, edge_attr = utils.knn_graph_arrays(points, k=5)
+
+    np.testing.assert_array_equal(data.edge_index.numpy(), edge_index.astype(np.int64))
+    np.testing.assert_allclose(data.edge_attr.numpy(), edge_attr)
+
+
+def test_graphs_of_an_older_format_are_refused(tmp_path):
+    from datasets.kitti import decode_graph
+
+    x, edge_index, edge_attr = utils.knn_graph_arrays(random_cloud(50), k=5)
+    np.savez(tmp_path / "old.npz", x=x, edge_index=edge_index, edge_attr=edge_attr)
+    np.savez(tmp_path / "new.npz", x=x, edge_index=edge_index, edge_attr=edge_attr, format=utils.GRAPH_FORMAT)
+
+    with pytest.raises(ValueError):
+        decode_graph(str(tmp_path / "old.npz"))
+    np.testing.assert_array_equal(decode_graph(str(tmp_path / "new.npz"))[1], edge_index)
+
+
+def test_radius_neighbors_matches_kd_tree():
+    points = random_cloud(2000)
+    centers, neighbors, distances = utils.radius_neighbors(points, 0.08)
+
+    pairs = cKDTree(points).query_pairs(0.08, output_type="ndarray")
+    expected = np.concatenate([pairs, pairs[:, ::-1]])
+
+    found = np.stack([centers, neighbors], axis=1)
+    assert len(found) == len(expected)
+    np.testing.assert_array_equal(np.unique(found, axis=0), np.unique(expected, axis=0))
+    np.testing.assert_allclose(distances, np.linalg.norm(points[centers] - points[neighbors], axis=1), rtol=1e-5)
+
+
+def test_radius_neighbors_keeps_the_closest_max_neighbors():
+    points = random_cloud(2000)
+    centers, neighbors, distances = utils.radius_neighbors(points, 0.1, max_neighbors=4)
+
+    # The capped neighbours of every point are its closest ones within the radius
+    tree = cKDTree(points)
+    for i in range(0, len(points), 97):
+        found = neighbors[centers == i]
+        d, indices = tree.query(points[i], k=5, distance_upper_bound=0.1)
+        expected = indices[1:][np.isfinite(d[1:])]
+        np.testing.assert_array_equal(np.sort(found), np.sort(expected))
+
+
+def test_radius_neighbors_of_an_empty_cloud():
+    centers, neighbors, distances = utils.radius_neighbors(np.empty((0, 3), dtype=np.float32), 0.5, 16)
+    assert len(centers) == len(neighbors) == len(distances) == 0
+
+
+def test_radius_graph_arrays_matches_radius_graph_transform():
+    points = random_cloud()
+    x, edge_index, edge_attr = utils.radius_graph_arrays(points, 0.1, max_neighbors=8)
+    online = transforms.RadiusGraph(0.1, max_neighbors=8)(Data(pos=torch.from_numpy(points)))
+
+    np.testing.assert_array_equal(x, online.x.numpy())
+    np.testing.assert_array_equal(edge_index.astype(np.int64), online.edge_index.numpy())
+    np.testing.assert_allclose(edge_attr, online.edge_attr.numpy(), rtol=1e-5)
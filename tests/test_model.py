@@ -0,0 +1,65 @@
+import pytest
+import torch
+
+from model import knn_blockwise
+
+
+def dense_knn(x, batch, k):
+    """
+    Reference kNN graph (self loops included) from the full distance matrix of every graph
+    """
+    neighbors, centers = [], []
+    for graph in batch.unique():
+        nodes = torch.nonzero(batch == graph).flatten()
+        distances = torch.cdist(x[nodes], x[nodes])
+        indices = distances.topk(min(k, len(nodes)), dim=-1, largest=False).indices
+        neighbors.append(nodes[indices].reshape(-1))
+        centers.append(nodes.repeat_interleave(indices.size(1)))
+
+    return torch.stack([torch.cat(neighbors), torch.cat(centers)])
+
+
+def edge_set(edge_index):
+    return set(map(tuple, edge_index.t().tolist()))
+
+
+@pytest.mark.parametrize("sizes", [[12, 3], [3, 12, 1, 7], [20, 20, 20], [4]])
+def test_knn_blockwise_matches_dense_knn(sizes):
+    torch.manual_seed(0)
+    batch = torch.repeat_interleave(torch.arange(len(sizes)), torch.tensor(sizes))
+    x = torch.randn(len(batch), 8)
+
+    # Small blocks, so that the graphs are split in several blocks of rows
+    edge_index = knn_blockwise(x, batch, k=5, max_block_elements=64)
+
+    assert edge_set(edge_index) == edge_set(dense_knn(x, batch, k=5))
+
+
+def test_knn_blockwise_without_batch():
+    torch.manual_seed(0)
+    x = torch.randn(30, 3)
+
+    assert edge_set(knn_blockwise(x, None, k=4)) == edge_set(dense_knn(x, torch.zeros(30, dtype=torch.long), k=4))
+
+
+def test_knn_blockwise_matches_torch_cluster():
+    pytest.importorskip("torch_cluster")
+    from torch_geometric.nn import knn_graph
+
+    torch.manual_seed(0)
+    batch = torch.repeat_interleave(torch.arange(3), torch.tensor([12, 3, 9]))
+    x = torch.randn(len(batch), 8)
+
+    assert edge_set(knn_blockwise(x, batch, k=5)) == edge_set(knn_graph(x, 5, batch, loop=True))
+
+
+@pytest.mark.parametrize("hidden_dim", [32, 30])
+def test_point_segmentation_outputs_one_row_per_node(hidden_dim):
+    from torch_geometric.data import Batch, Data
+
+    from model import PointSegmentation
+
+    graphs = [Data(x=torch.randn(n, 4), edge_index=torch.randint(n, (2, 3 * n))) for n in (10, 7)]
+    model = PointSegmentation(hidden_dim, 4).eval()
+
+    assert model(Batch.from_data_list(graphs)).shape == (17, 4)
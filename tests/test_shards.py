@@ -0,0 +1,34 @@
+import numpy as np
+
+from benchmarks import synthetic_kitti
+from datasets.kitti import Dataset
+from preprocess import kitti as preprocess_kitti
+from preprocess import shards
+
+# More than 10 frames, so that the sorted file names do not follow the frame order
+NUM_FRAMES = 12
+NUM_SHARDS = 3
+
+
+def test_merged_shards_match_unsharded(tmp_path):
+    path_dataset = synthetic_kitti.generate(str(tmp_path / "training"), NUM_FRAMES, num_points=20000)
+
+    preprocess_kitti.preprocess(path_dataset, str(tmp_path / "full"), num_workers=1)
+    for i in range(NUM_SHARDS):
+        preprocess_kitti.preprocess(path_dataset, str(tmp_path / "sharded"), num_workers=1, shard=(i, NUM_SHARDS))
+    merged = shards.merge(str(tmp_path / "sharded"), NUM_SHARDS)
+
+    # The ids are the positions of the samples in the unsharded dataset
+    full_graphs = sorted(path.name for path in (tmp_path / "full" / "X").iterdir())
+    samples = sorted(merged["samples"], key=lambda sample: sample["id"])
+    assert [sample["graph"].split("/")[-1] for sample in samples] == full_graphs
+
+    full = Dataset(str(tmp_path / "full"), num_workers=1)
+    sharded = Dataset(str(tmp_path / "sharded"), num_workers=1)
+
+    assert len(full) == len(sharded) == len(full_graphs)
+    assert list(full.classes) == list(sharded.classes)
+    for full_data, sharded_data in zip(full, sharded):
+        assert full_data.y.item() == sharded_data.y.item()
+        np.testing.assert_array_equal(full_data.x.numpy(), sharded_data.x.numpy())
+        np.testing.assert_array_equal(full_data.edge_index.numpy(), sharded_data.edge_index.numpy())
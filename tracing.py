@@ -0,0 +1,200 @@
+"""
+Lightweight tracing: timed spans and counters, exported as a Chrome trace
+(chrome://tracing or https://ui.perfetto.dev) and as a per-stage summary.
+
+Tracing is off unless the TRACE environment variable is set (or enable() is
+called); a disabled span is a shared no-op context manager.
+
+    with tracing.span("knn", num_points=3000):
+        ...
+    tracing.count("objects_kept/Car")
+
+Work done in pool workers is traced by running it through traced_call, which
+returns the events of the call with its result, and merged in the parent:
+
+    result, trace = pool.apply_async(tracing.traced_call, (fn, *args)).get()
+    tracing.merge(trace)
+"""
+import contextlib
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+
+ENV_VAR = "TRACE"
+
+_enabled = os.environ.get(ENV_VAR, "0") not in ("", "0")
+_events = []
+_counters = defaultdict(float)
+_lock = threading.Lock()
+_noop = contextlib.nullcontext()
+
+
+def enable():
+    """
+    Turn tracing on, also for the processes started afterwards
+    """
+    global _enabled
+    _enabled = True
+    os.environ[ENV_VAR] = "1"
+
+
+def disable():
+    """
+    Turn tracing off, also for the processes started afterwards
+    """
+    global _enabled
+    _enabled = False
+    os.environ.pop(ENV_VAR, None)
+
+
+def is_enabled():
+    return _enabled
+
+
+class _Span:
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        event = {
+            "name": self.name,
+            "ph": "X",
+            "ts": self.start / 1000,
+            "dur": (end - self.start) / 1000,
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+        }
+        if self.args:
+            event["args"] = self.args
+
+        with _lock:
+            _events.append(event)
+
+        return False
+
+
+def span(name, **args):
+    """
+    Context manager timing the enclosed code as a span called name
+    """
+    if not _enabled:
+        return _noop
+
+    return _Span(name, args)
+
+
+def count(name, value=1):
+    """
+    Add value to the counter called name
+    """
+    if not _enabled:
+        return
+
+    with _lock:
+        _counters[name] += value
+
+
+def collect():
+    """
+    Take the events and counters recorded so far by this process
+    """
+    global _events, _counters
+
+    with _lock:
+        state = {"events": _events, "counters": dict(_counters)}
+        _events = []
+        _counters = defaultdict(float)
+
+    return state
+
+
+def merge(state):
+    """
+    Add the events and counters collected in another process
+    """
+    if state is None:
+        return
+
+    with _lock:
+        _events.extend(state["events"])
+        for name, value in state["counters"].items():
+            _counters[name] += value
+
+
+def traced_call(fn, *args):
+    """
+    Run fn(*args) in a worker and return (result, trace of the call). The
+    events inherited from the parent by a forked worker are discarded.
+    """
+    if not _enabled:
+        return fn(*args), None
+
+    collect()
+    result = fn(*args)
+
+    return result, collect()
+
+
+def summary():
+    """
+    Total, count and mean duration in seconds of the spans of every name,
+    and the counters
+    """
+    with _lock:
+        events = list(_events)
+        counters = dict(_counters)
+
+    stages = {}
+    for event in events:
+        stage = stages.setdefault(event["name"], {"total": 0.0, "count": 0})
+        stage["total"] += event["dur"] / 1e6
+        stage["count"] += 1
+
+    for stage in stages.values():
+        stage["mean"] = stage["total"] / stage["count"]
+
+    return {"stages": stages, "counters": counters}
+
+
+def report():
+    """
+    Print the summary, the stages with the largest total time first
+    """
+    result = summary()
+
+    print("Stage                          count     total (s)    mean (ms)")
+    for name, stage in sorted(result["stages"].items(), key=lambda item: -item[1]["total"]):
+        print(f"{name:28s} {stage['count']:7d} {stage['total']:13.3f} {stage['mean'] * 1000:12.3f}")
+
+    if result["counters"]:
+        print("Counters")
+        for name, value in sorted(result["counters"].items()):
+            print(f"  {name:28s} {value:g}")
+
+    return result
+
+
+def export_chrome_trace(path):
+    """
+    Write the events, and the final value of the counters, as Chrome trace JSON
+    """
+    with _lock:
+        events = list(_events)
+        counters = dict(_counters)
+
+    end = max((event["ts"] + event["dur"] for event in events), default=0)
+    for name, value in counters.items():
+        events.append({"name": name, "ph": "C", "ts": end, "pid": os.getpid(), "args": {"value": value}})
+
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
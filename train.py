@@ -1,25 +1,15 @@
 import torch
-import matplotlib
 import numpy as np
-import pandas as pd
-import seaborn as sn
 from tqdm import tqdm
 from torch import optim
-from matplotlib import pyplot as plt
 from torch_geometric.loader import DataLoader
 from sklearn import metrics as sk_metrics
 from model import *
-from dataset import Dataset
-from datasets.kitti import Dataset as KittiDataset
+from utils import cast_batch
 
 # CLASSES = ["bathtub", "bed", "chair", "desk", "dresser", "monitor", "night_stand", "sofa", "table", "toilet"]
 CLASSES = ["Car", "Pedestrian", "Cyclist"]
 
-import torch_geometric
-print(torch_geometric.__version__)
-import torch_geometric
-print(torch_geometric.__version__)
-
 def save_model():
     path = "./last.pt"
     torch.save(model.state_dict(), path)
@@ -37,6 +27,11 @@ def predict(model, x):
 
 # Training Function
 def train(model, num_epochs, dataset, device):
+    # Only needed for the live confusion matrix
+    import pandas as pd
+    import seaborn as sn
+    from matplotlib import pyplot as plt
+
     plt.show(block=False)
     fig = plt.figure(figsize=(10, 10))
 
@@ -77,7 +72,7 @@ def train(model, num_epochs, dataset, device):
         model.train()
 
         for data_batch in train_loader:
-            x = data_batch
+            x = cast_batch(data_batch, torch.float64)
             y_true = data_batch.y
             # for data in enumerate(train_loader, 0):
             optimizer.zero_grad()  # zero the parameter gradients
@@ -99,7 +94,7 @@ def train(model, num_epochs, dataset, device):
         with torch.no_grad():
             model.eval()
             for data_batch in valid_loader:
-                x = data_batch
+                x = cast_batch(data_batch, torch.float64)
                 y_true = data_batch.y
                 y_pred = model(x.to(device))
                 val_loss = loss_fn(y_pred.float(), y_true.to(device))
@@ -162,6 +157,11 @@ def train(model, num_epochs, dataset, device):
 
 
 if __name__ == "__main__":
+    import matplotlib
+    import torch_geometric
+    from datasets.kitti import Dataset as KittiDataset
+
+    print(torch_geometric.__version__)
     matplotlib.use('TkAgg')
     # open log.txt in append mode
 
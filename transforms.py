@@ -0,0 +1,240 @@
+import numpy as np
+import torch
+import utils
+from scipy.spatial import cKDTree
+from torch_geometric.nn.conv.gcn_conv import gcn_norm
+from torch_geometric.data import Data
+from torch_geometric.transforms import BaseTransform, Compose
+
+NUM_POINTS = 3000
+NUM_EDGES_PER_VERTEX = 5
+MAX_NEIGHBORS = 16
+
+# The random transforms draw from torch, which the DataLoader seeds differently
+# in every worker process (numpy is not reseeded and would repeat itself)
+
+
+class RandomResample(BaseTransform):
+    """
+    Resample the points of data.pos (and their features data.x, if any) to
+    num_points, repeating random points of small crops and sampling random
+    points of large ones
+    """
+    def __init__(self, num_points=NUM_POINTS):
+        self.num_points = num_points
+
+    def forward(self, data):
+        num_points = data.pos.size(0)
+
+        if num_points < self.num_points:
+            indices = torch.randint(num_points, (self.num_points - num_points,))
+            indices = torch.cat([torch.arange(num_points), indices])
+        else:
+            indices = torch.randperm(num_points)[:self.num_points]
+
+        data.pos = data.pos[indices]
+        if data.x is not None:
+            data.x = data.x[indices]
+
+        return data
+
+
+class FixedResample(BaseTransform):
+    """
+    Deterministic counterpart of RandomResample for validation and test
+    """
+    def __init__(self, num_points=NUM_POINTS):
+        self.num_points = num_points
+
+    def forward(self, data):
+        num_points = data.pos.size(0)
+
+        if num_points < self.num_points:
+            indices = torch.arange(self.num_points) % num_points
+        else:
+            indices = torch.linspace(0, num_points - 1, self.num_points).long()
+
+        data.pos = data.pos[indices]
+        if data.x is not None:
+            data.x = data.x[indices]
+
+        return data
+
+
+class RandomRotateZ(BaseTransform):
+    """
+    Rotate data.pos by a random angle about the z axis
+    """
+    def forward(self, data):
+        angle = torch.rand(1).item() * 2 * np.pi
+        cos, sin = np.cos(angle), np.sin(angle)
+
+        rotation_matrix = torch.tensor([[cos, -sin, 0],
+                                        [sin, cos, 0],
+                                        [0, 0, 1]], dtype=data.pos.dtype)
+        data.pos = data.pos @ rotation_matrix.T
+
+        return data
+
+
+class Jitter(BaseTransform):
+    """
+    Add clipped gaussian noise to data.pos
+    """
+    def __init__(self, sigma=0.01, clip=0.05):
+        self.sigma = sigma
+        self.clip = clip
+
+    def forward(self, data):
+        noise = (torch.randn_like(data.pos) * self.sigma).clamp(-self.clip, self.clip)
+        data.pos = data.pos + noise
+
+        return data
+
+
+def point_features(data):
+    """
+    Node features of a point cloud: the coordinates, then data.x if any
+    """
+    if data.x is None:
+        return data.pos
+
+    return torch.cat([data.pos, data.x.to(data.pos.dtype)], dim=1)
+
+
+class KNNGraph(BaseTransform):
+    """
+    Build the kNN graph of data.pos with a kd-tree. Every node receives the
+    messages of its k nearest neighbours, weighted by 1 / (1 + distance),
+    and the coordinates become the node features, followed by the other
+    point features (data.x, e.g. intensity, RGB) if any.
+    """
+    def __init__(self, k=NUM_EDGES_PER_VERTEX):
+        self.k = k
+
+    def forward(self, data):
+        points = data.pos.numpy()
+        num_points = points.shape[0]
+
+        # The nearest point is the point itself
+        distances, indices = cKDTree(points).query(points, k=self.k + 1)
+        distances, indices = distances[:, 1:], indices[:, 1:]
+
+        edge_index = np.stack([indices.reshape(-1), np.repeat(np.arange(num_points), self.k)])
+
+        data.x = point_features(data)
+        data.edge_index = torch.from_numpy(edge_index.astype(np.int64))
+        data.edge_attr = torch.from_numpy((1 / (1 + distances.reshape(-1))).astype(np.float32))
+        del data.pos
+
+        return data
+
+
+class RadiusGraph(BaseTransform):
+    """
+    Build the radius graph of data.pos with a cell list (utils.radius_neighbors).
+    Every node receives the messages of the nodes within radius, at most its
+    max_neighbors closest ones, weighted by 1 / (1 + distance), and the
+    coordinates become the node features, as in KNNGraph.
+    """
+    def __init__(self, radius, max_neighbors=MAX_NEIGHBORS):
+        self.radius = radius
+        self.max_neighbors = max_neighbors
+
+    def forward(self, data):
+        centers, neighbors, distances = utils.radius_neighbors(data.pos.numpy(), self.radius, self.max_neighbors)
+
+        data.x = point_features(data)
+        data.edge_index = torch.from_numpy(np.stack([neighbors, centers]))
+        data.edge_attr = torch.from_numpy((1 / (1 + distances)).astype(np.float32))
+        del data.pos
+
+        return data
+
+
+def graph_transform(k=NUM_EDGES_PER_VERTEX, radius=None, max_neighbors=MAX_NEIGHBORS):
+    """
+    KNNGraph, or RadiusGraph if a radius is given
+    """
+    if radius is not None:
+        return RadiusGraph(radius, max_neighbors)
+
+    return KNNGraph(k)
+
+
+class GraphToPoints(BaseTransform):
+    """
+    Drop the graph of a stored sample and keep its coordinates as data.pos
+    and its other node features as data.x, so that it can be resampled and
+    connected again
+    """
+    def forward(self, data):
+        if data.x.size(1) > 3:
+            return Data(pos=data.x[:, :3], x=data.x[:, 3:], y=data.y)
+
+        return Data(pos=data.x[:, :3], y=data.y)
+
+
+class GCNNorm(BaseTransform):
+    """
+    Precompute the self-loops and the symmetric degree normalization that
+    GCNConv would otherwise recompute at every forward pass. The result is
+    stored next to the original edges, for GraphClassifier(normalize=False).
+    """
+    def forward(self, data):
+        data.gcn_edge_index, data.gcn_edge_weight = gcn_norm(data.edge_index, None, data.num_nodes, add_self_loops=True)
+
+        return data
+
+
+class SetAbstraction(BaseTransform):
+    """
+    Precompute the downsampling of HierarchicalGraphSage, in the style of the
+    PointNet++ set abstraction: a farthest point subset of the nodes
+    (centroid_index), the centroid each node is pooled into (cluster_index)
+    and the kNN graph between the centroids (coarse_edge_index). All of them
+    hold node ids of the full graph, so batching offsets them like edge_index.
+    """
+    def __init__(self, ratio=0.25, k=NUM_EDGES_PER_VERTEX):
+        self.ratio = ratio
+        self.k = k
+
+    def forward(self, data):
+        points = data.x[:, :3].numpy()
+        num_centroids = max(self.k + 1, int(points.shape[0] * self.ratio))
+
+        centroids = np.sort(utils.farthest_point_sample(points, num_centroids))
+        tree = cKDTree(points[centroids])
+
+        # Every node belongs to its closest centroid
+        _, cluster = tree.query(points, k=1)
+
+        # kNN graph between the centroids, the nearest one is the centroid itself
+        _, neighbors = tree.query(points[centroids], k=self.k + 1)
+        neighbors = neighbors[:, 1:]
+        coarse_edge_index = np.stack([centroids[neighbors.reshape(-1)], np.repeat(centroids, self.k)])
+
+        data.centroid_index = torch.from_numpy(centroids)
+        data.cluster_index = torch.from_numpy(centroids[cluster])
+        data.coarse_edge_index = torch.from_numpy(coarse_edge_index)
+
+        return data
+
+
+def train_transform(num_points=NUM_POINTS, k=NUM_EDGES_PER_VERTEX, radius=None, max_neighbors=MAX_NEIGHBORS):
+    """
+    Per-epoch resampling and augmentation of the stored crops, connected by
+    a kNN graph or by a radius graph if a radius is given
+    """
+    return Compose([RandomResample(num_points), RandomRotateZ(), Jitter(), graph_transform(k, radius, max_neighbors)])
+
+
+def eval_transform(num_points=NUM_POINTS, k=NUM_EDGES_PER_VERTEX, radius=None, max_neighbors=MAX_NEIGHBORS):
+    return Compose([FixedResample(num_points), graph_transform(k, radius, max_neighbors)])
+
+
+def student_transform(num_points=500, k=3):
+    """
+    Smaller graph for a distilled student, built from a stored graph
+    """
+    return Compose([GraphToPoints(), FixedResample(num_points), KNNGraph(k)])
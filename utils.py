@@ -1,9 +1,26 @@
+import itertools
 import numpy as np
-from scipy.spatial.distance import pdist, squareform
-import networkx as nx
 import torch_geometric.data as pyg
 import torch
 
+# Dtype policy: geometry is computed in float32, the precision of the velodyne
+# scans. Graphs are stored with their node ids in the smallest integer type
+# holding them (see compact_graph), optionally with float16 features, and are
+# cast to the dtype of the model once per batch by cast_batch.
+GEOMETRY_DTYPE = np.float32
+
+# Version of the graphs saved by the preprocessing and of the dataset caches
+# built from them. 2: the k nearest points (the legacy builders linked the k
+# farthest ones) and edges [neighbour, centre], the (source, target) layout
+# of PyG and of transforms.py. Older graphs and caches are not loaded.
+GRAPH_FORMAT = 2
+
+def cache_path(path):
+    """
+    Path of the pickle cache of the dataset in path, versioned with GRAPH_FORMAT
+    """
+    return f"{path}.v{GRAPH_FORMAT}.cache"
+
 def ry_to_rz(ry):
     """
     param ry (float): yaw angle in cam coordinate system
@@ -30,21 +47,23 @@ def get_bbox3d(obj_xyz_cam, rot_y, dimensions, tr_velo_to_cam, R_cam_to_rect):
     obj_y = obj_xyz_lidar[1][0]
     obj_z = obj_xyz_lidar[2][0]
 
-    return np.array([obj_x, obj_y, obj_z, length, width, height, rot_z])
+    return np.array([obj_x, obj_y, obj_z, length, width, height, rot_z], dtype=GEOMETRY_DTYPE)
 
-def get_point_cloud_in_bbox3d(point_cloud, bbox):
+def points_in_bbox3d(point_cloud, bbox):
     """
-    Get the point cloud that is inside the bounding box
+    Mask of the points inside the bounding box, and their coordinates in the
+    frame of the box (centred on its bottom, axes parallel to its sides)
     """
 
     x, y, z, w, l, h, rz = bbox
+    point_cloud = np.asarray(point_cloud, dtype=GEOMETRY_DTYPE)
     
-    # Rotate the point cloud to make it parallel to the axes
+    # Rotate the point cloud to make it parallel to the axes, in float32 like the points
     rotation_matrix = np.array([[np.cos(rz), -np.sin(rz), 0],
                                 [np.sin(rz), np.cos(rz), 0],
-                                [0, 0, 1]])
+                                [0, 0, 1]], dtype=GEOMETRY_DTYPE)
 
-    rotated_point_cloud = np.dot(point_cloud - np.array([x, y, z]), rotation_matrix.T)
+    rotated_point_cloud = np.dot(point_cloud[:, :3] - np.array([x, y, z], dtype=GEOMETRY_DTYPE), rotation_matrix.T)
 
     # Define the boundaries of the bounding box
     x_min = -w / 2
@@ -59,7 +78,17 @@ def get_point_cloud_in_bbox3d(point_cloud, bbox):
            & (rotated_point_cloud[:, 1] >= y_min) & (rotated_point_cloud[:, 1] <= y_max) \
            & (rotated_point_cloud[:, 2] >= z_min) & (rotated_point_cloud[:, 2] <= z_max)
 
-    filtered_point_cloud = rotated_point_cloud[mask]
+    return mask, rotated_point_cloud
+
+def get_point_cloud_in_bbox3d(point_cloud, bbox):
+    """
+    Get the point cloud that is inside the bounding box, the columns after
+    the coordinates (e.g. intensity, RGB) are passed through
+    """
+    point_cloud = np.asarray(point_cloud, dtype=GEOMETRY_DTYPE)
+    mask, rotated_point_cloud = points_in_bbox3d(point_cloud, bbox)
+
+    filtered_point_cloud = np.hstack([rotated_point_cloud[mask], point_cloud[mask, 3:]])
 
     return filtered_point_cloud
 
@@ -101,43 +130,96 @@ def get_bbox3d_corners(bbox):
     rotated_corners = np.dot(corners, rotation_matrix.T)
     translated_corners = rotated_corners + np.array([x, y, z])
     
-    return translated_corners
+    return translated_corners.astype(GEOMETRY_DTYPE)
 
-def nx_to_torch_geometric(graph, label):
+def nx_to_arrays(graph):
     """
-    Convert a networkx graph to torch geometric data format
+    Convert a networkx graph (as saved by the legacy preprocessing) to numpy arrays
+    :param graph: networkx graph with 'x' node features and 'weight' edge features
+    :return: node features [N, F], edges [2, E] and edge weights [E]
     """
+    num_nodes = graph.number_of_nodes()
+    num_edges = graph.number_of_edges()
 
-    # Node features
-    x = torch.tensor([features['x'] for _, features in graph.nodes(data=True)], dtype=torch.float32)
+    # Node features, ordered by node id (the nodes are stored in insertion order)
+    nodes = np.fromiter(graph.nodes, dtype=np.int64, count=num_nodes)
+    features = np.array([features for _, features in graph.nodes(data='x')], dtype=np.float32)
+    x = np.empty_like(features)
+    x[nodes] = features
+
+    # Edges
+    edges = np.fromiter(itertools.chain.from_iterable(graph.edges()), dtype=np.int64, count=2 * num_edges)
+    edge_index = np.ascontiguousarray(edges.reshape(-1, 2).T)
 
     # Edge features
-    edge_attr = torch.tensor([features['weight'] for _, _, features in G.edges(data=True)], dtype=torch.float32)
+    edge_attr = np.fromiter((weight for _, _, weight in graph.edges(data='weight')), dtype=np.float32, count=num_edges)
 
-    # Edges
-    edge_index = torch.tensor(list(graph.edges), dtype=torch.long).t().contiguous().view(2, -1)
+    return x, edge_index, edge_attr
 
-    # Label
-    y = torch.tensor([label], dtype=torch.long)
+def index_dtype(num_nodes):
+    """
+    Smallest integer dtype holding the node ids of a graph with num_nodes nodes
+    """
+    return np.uint16 if num_nodes <= np.iinfo(np.uint16).max + 1 else np.int32
 
-    # Create a PyTorch Geometric data object.
-    data = pyg.Data(x=x, edge_index=edge_index, edge_attr=edge_attr, y=y)
+def compact_graph(x, edge_index, edge_attr, feature_dtype=np.float32):
+    """
+    Storage dtypes of a graph: node ids in index_dtype, node and edge
+    features in feature_dtype (float16 halves them on disk and in memory)
+    """
+    return (x.astype(feature_dtype, copy=False),
+            edge_index.astype(index_dtype(x.shape[0]), copy=False),
+            edge_attr.astype(feature_dtype, copy=False))
+
+def cast_batch(batch, dtype=torch.float32):
+    """
+    Cast a batch for the model, once after collation: the floating point
+    attributes to dtype and the node ids (attributes named *index) to int64
+    """
+    for key, value in batch.items():
+        if not torch.is_tensor(value):
+            continue
+
+        if "index" in key:
+            if value.dtype != torch.long:
+                batch[key] = value.long()
+        elif value.is_floating_point() and value.dtype != dtype:
+            batch[key] = value.to(dtype)
+
+    return batch
+
+def arrays_to_torch_geometric(x, edge_index, edge_attr, label=None):
+    """
+    Wrap numpy arrays in a torch geometric data object without copying them.
+    uint16 node ids are widened to int32, batching offsets them past 65535.
+    """
+    if edge_index.dtype == np.uint16:
+        edge_index = edge_index.astype(np.int32)
+
+    data = pyg.Data(x=torch.from_numpy(x), edge_index=torch.from_numpy(edge_index), edge_attr=torch.from_numpy(edge_attr))
+
+    if label is not None:
+        data.y = torch.tensor([label], dtype=torch.long)
 
     return data
 
-def point_cloud_to_torch_geometric(point_cloud, label, k):
+def nx_to_torch_geometric(graph, label):
+    """
+    Convert a networkx graph to torch geometric data format
+    """
+    return arrays_to_torch_geometric(*nx_to_arrays(graph), label)
+
+def point_cloud_to_torch_geometric(point_cloud, label, k, num_points=3000):
     """ Convert point cloud to torch geometric data format """
 
     # Resample the point cloud
-    point_cloud = resample_point_cloud(point_cloud, k)
+    point_cloud = resample_point_cloud(point_cloud, num_points)
 
     # Construct kNN graph
-    graph = knn_graph(point_cloud, k)
+    x, edge_index, edge_attr = knn_graph_arrays(point_cloud, k)
 
     # Convert the graph to torch geometric data format
-    data = nx_to_torch_geometric(graph, label)
-
-    return data
+    return arrays_to_torch_geometric(x, edge_index, edge_attr, label)
 
 
 def resample_point_cloud(point_cloud, k):
@@ -159,6 +241,24 @@ def resample_point_cloud(point_cloud, k):
 
     return point_cloud
 
+def farthest_point_sample(points, num_samples):
+    """
+    Iteratively pick the point farthest from the ones already picked
+    :param points: point cloud data
+    :param num_samples: number of points to pick
+    :return: indices of the picked points, starting with the first point
+    """
+    selected = np.empty(num_samples, dtype=np.int64)
+    selected[0] = 0
+
+    # Squared distance of every point to the closest picked point
+    distance = np.full(points.shape[0], np.inf)
+    for i in range(1, num_samples):
+        distance = np.minimum(distance, np.sum((points - points[selected[i - 1]])**2, axis=1))
+        selected[i] = np.argmax(distance)
+
+    return selected
+
 def knn_graph_old(data, k):
     """
     Construct a NetworkX graph from the given data
@@ -167,24 +267,231 @@ def knn_graph_old(data, k):
     :return: networkx graph
     """
     # Compute pairwise distance matrix
-    D = pdist(data)
-    #D = np.exp(-D)
-    D = 1/(1+D)
-    D = squareform(D)
+    D = similarity_matrix(data)
 
-    # Sort distance matrix in ascending order and get indices of points
-    idx = np.argsort(D, axis=1)
+    # Sort the similarities in descending order, the point itself (similarity 0) comes last
+    idx = np.argsort(-D, axis=1)
 
     # Construct kNN graph, use 3D coordinates as node features
+    import networkx as nx
+
     G = nx.Graph()
     for i in range(data.shape[0]):
-        for j in idx[i, 1:k+1]:
+        for j in idx[i, :k]:
             G.add_edge(i, j, weight=D[i, j])
     for i in range(data.shape[0]):
         G.nodes[i]['x'] = data[i]
 
     return G
 
+def similarity_matrix(data):
+    """
+    Pairwise similarity 1 / (1 + distance) of the points, 0 on the diagonal.
+    Computed in float32 from |a|^2 + |b|^2 - 2ab, in place, on the centred
+    points to limit the cancellation.
+    """
+    points = np.asarray(data, dtype=GEOMETRY_DTYPE)
+    points = points - points.mean(axis=0)
+
+    squared_norms = np.einsum("ij,ij->i", points, points)
+    D = points @ points.T
+    D *= -2
+    D += squared_norms[:, None]
+    D += squared_norms[None, :]
+
+    np.maximum(D, 0, out=D)
+    np.sqrt(D, out=D)
+    D += 1
+    np.reciprocal(D, out=D)
+    np.fill_diagonal(D, 0)
+
+    return D
+
+def smallest_k(D, k, block_rows=256, largest=False):
+    """
+    Indices of the k smallest entries of every row of D, in ascending order,
+    without sorting the whole rows. The rows are partitioned in blocks, so
+    that the int64 indices of argpartition never cover the whole matrix.
+    :param largest: the k largest entries instead, in descending order
+                    (e.g. the nearest points of a similarity matrix)
+    """
+    idx = np.empty((D.shape[0], k), dtype=np.int64)
+    for start in range(0, D.shape[0], block_rows):
+        block = -D[start:start + block_rows] if largest else D[start:start + block_rows]
+        block_idx = np.argpartition(block, k - 1, axis=1)[:, :k]
+        order = np.argsort(np.take_along_axis(block, block_idx, axis=1), axis=1)
+        idx[start:start + block_rows] = np.take_along_axis(block_idx, order, axis=1)
+
+    return idx
+
+def knn_graph_arrays(data, k):
+    """
+    Construct the kNN graph of the points directly as numpy arrays, the same
+    graph as transforms.KNNGraph: every point receives the messages of its k
+    nearest points, weighted by 1 / (1 + distance)
+    :param data: point cloud data, the neighbours are found on the first three columns
+    :param k: number of neighbors
+    :return: node features [N, F] float32, edges [2, N*k] (neighbour, centre)
+             in index_dtype(N) and edge weights [N*k] float32
+    """
+    D = similarity_matrix(data[:, :3])
+
+    # The k most similar points, i.e. the nearest ones, skipping the point itself
+    np.fill_diagonal(D, -np.inf)
+    idx = smallest_k(D, k, largest=True)
+
+    # Edges j -> i for every selected neighbour j of i
+    num_points = data.shape[0]
+    edge_index = np.stack([idx.reshape(-1), np.repeat(np.arange(num_points, dtype=idx.dtype), k)])
+    edge_attr = np.take_along_axis(D, idx, axis=1).reshape(-1)
+
+    return compact_graph(np.asarray(data, dtype=GEOMETRY_DTYPE), edge_index, edge_attr)
+
+def radius_neighbors(points, radius, max_neighbors=None, max_block_pairs=2**22):
+    """
+    Pairs of distinct points closer than radius, found with a cell list: the
+    points are hashed in cubic cells of side radius, sorted by cell, and
+    only the 27 cells around the cell of a point are searched, so the time
+    is linear in the number of points for a bounded density. Every pair of
+    cells is visited once (half of the offsets) and its pairs mirrored.
+    :param points: [N, 3] coordinates
+    :param max_neighbors: keep only the closest max_neighbors of every point
+    :param max_block_pairs: candidate pairs tested at once, bounds the memory
+    :return: (points i, neighbours j, distances), grouped by i and sorted by distance
+    """
+    points = np.asarray(points, dtype=GEOMETRY_DTYPE)
+    num_points = points.shape[0]
+
+    # No point, no pair (e.g. a frame filtered out entirely)
+    if num_points == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=GEOMETRY_DTYPE)
+
+    # Integer cell coordinates, hashed to a single key
+    cells = np.floor((points - points.min(axis=0)) / radius).astype(np.int64)
+    dims = cells.max(axis=0) + 1
+    keys = (cells[:, 0] * dims[1] + cells[:, 1]) * dims[2] + cells[:, 2]
+
+    # Points sorted by cell, with the first position and the size of every cell
+    order = np.argsort(keys, kind="stable")
+    cell_keys, cell_starts, cell_counts = np.unique(keys[order], return_index=True, return_counts=True)
+    cell_coordinates = cells[order[cell_starts]]
+    point_cell = np.repeat(np.arange(len(cell_keys)), cell_counts)
+    sorted_points = points[order]
+
+    centers = []
+    neighbors = []
+    distances = []
+    # (0, 0, 0) and the 13 offsets after it in lexicographic order, the others mirror them
+    for offset in itertools.product((-1, 0, 1), repeat=3):
+        if offset < (0, 0, 0):
+            continue
+
+        # Neighbouring cell of every cell in the direction of the offset, if not empty
+        neighbor_cells = cell_coordinates + offset
+        valid = np.all((neighbor_cells >= 0) & (neighbor_cells < dims), axis=1)
+        neighbor_keys = (neighbor_cells[:, 0] * dims[1] + neighbor_cells[:, 1]) * dims[2] + neighbor_cells[:, 2]
+
+        position = np.minimum(np.searchsorted(cell_keys, neighbor_keys), len(cell_keys) - 1)
+        valid &= cell_keys[position] == neighbor_keys
+
+        # Points (positions in the sorted order) whose cell has this neighbour
+        query = np.flatnonzero(valid[point_cell])
+        starts = cell_starts[position[point_cell[query]]]
+        counts = cell_counts[position[point_cell[query]]]
+
+        # Blocks of query points with at most max_block_pairs candidate pairs
+        bounds = np.searchsorted(np.cumsum(counts), np.arange(max_block_pairs, counts.sum(), max_block_pairs), side="right")
+        for block in np.split(np.arange(len(query)), bounds):
+            block_counts = counts[block]
+
+            # Every point of the block against every point of its neighbouring cell
+            i = np.repeat(query[block], block_counts)
+            j = np.arange(block_counts.sum()) - np.repeat(np.cumsum(block_counts) - block_counts, block_counts) \
+                + np.repeat(starts[block], block_counts)
+
+            difference = sorted_points[i] - sorted_points[j]
+            squared_distance = np.einsum("ij,ij->i", difference, difference)
+            # Within a cell, every pair once
+            keep = (squared_distance <= radius ** 2) & ((i < j) if offset == (0, 0, 0) else True)
+            i, j = order[i[keep]], order[j[keep]]
+            distance = np.sqrt(squared_distance[keep])
+
+            centers += [i, j]
+            neighbors += [j, i]
+            distances += [distance, distance]
+
+    centers = np.concatenate(centers)
+    neighbors = np.concatenate(neighbors)
+    distances = np.concatenate(distances)
+
+    # Group by point, closest first
+    order = np.lexsort((distances, centers))
+    centers, neighbors, distances = centers[order], neighbors[order], distances[order]
+
+    if max_neighbors is not None:
+        # Rank of every pair among the pairs of its point
+        counts = np.bincount(centers, minlength=num_points)
+        rank = np.arange(len(centers)) - np.repeat(np.cumsum(counts) - counts, counts)
+        keep = rank < max_neighbors
+        centers, neighbors, distances = centers[keep], neighbors[keep], distances[keep]
+
+    return centers, neighbors, distances
+
+def radius_graph_arrays(data, radius, max_neighbors=None):
+    """
+    Alternative topology to knn_graph_arrays, with the same layout: every
+    point is linked to the points within radius, the closest max_neighbors
+    of them if capped. Dense regions get at most max_neighbors edges per
+    point, sparse ones no edge to far away points. The same graph as
+    transforms.RadiusGraph.
+    :param data: point cloud data, the neighbours are found on the first three columns
+    :return: node features [N, F] float32, edges [2, E] (neighbour, centre)
+             in index_dtype(N) and edge weights 1 / (1 + distance) [E] float32
+    """
+    centers, neighbors, distances = radius_neighbors(data[:, :3], radius, max_neighbors)
+
+    edge_index = np.stack([neighbors, centers])
+    edge_attr = 1 / (1 + distances)
+
+    return compact_graph(np.asarray(data, dtype=GEOMETRY_DTYPE), edge_index, edge_attr)
+
+def bev_partition(points, cell_size, max_points=None, max_depth=6):
+    """
+    Partition the points in spatially coherent clusters on a bird's eye view
+    grid: every non empty cell of side cell_size (in x, y) is a cluster, and
+    the cells with more than max_points points are split in four, like a
+    quadtree, until they fit or max_depth splits were made.
+    :param points: [N, >=2] coordinates
+    :return: cluster of every point [N] int64, from 0 to the number of clusters - 1
+    """
+    points = np.asarray(points[:, :2], dtype=GEOMETRY_DTYPE)
+    if len(points) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    origin = points.min(axis=0)
+
+    # Depth and cell coordinates at that depth of every point
+    depth = np.zeros(len(points), dtype=np.int64)
+    cells = np.floor((points - origin) / cell_size).astype(np.int64)
+
+    while True:
+        # Cells hashed to a single key, the cells of different depths never collide
+        dims = cells.max(axis=0) + 1
+        keys = (depth * dims[0] + cells[:, 0]) * dims[1] + cells[:, 1]
+        _, cluster, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        if max_points is None:
+            break
+
+        # Points of the cells too large, that can still be split
+        split = (counts[cluster] > max_points) & (depth < max_depth)
+        if not split.any():
+            break
+
+        depth[split] += 1
+        cells[split] = np.floor((points[split] - origin) / (cell_size / 2 ** depth[split][:, None])).astype(np.int64)
+
+    return cluster
+
 def knn_graph(data, label, k):
     """
     Construct a kNN graph from the given data
@@ -197,27 +504,17 @@ def knn_graph(data, label, k):
     # Create x from data
     x = np.copy(data)
 
-    # Initialize edge_index
-    edge_index = np.empty((2, k*data.shape[0]), dtype=np.int64)
-
-    # Initialize edge_attr
-    edge_attr = np.empty((k*data.shape[0]), dtype=np.float32)
-
     # Compute pairwise distance matrix
-    D = pdist(data)
-    #D = np.exp(-D)
-    D = 1/(1+D)
-    D = squareform(D)
+    D = similarity_matrix(data)
 
-    # Sort distance matrix in ascending order and get indices of points
-    idx = np.argsort(D, axis=1)
+    # Indices of the k most similar, i.e. nearest, points
+    np.fill_diagonal(D, -np.inf)
+    idx = smallest_k(D, k, largest=True)
 
-    # Construct kNN graph
-    for i in range(data.shape[0]):
-        for j in range(k):
-            edge_index[0, i*k+j] = i
-            edge_index[1, i*k+j] = idx[i, j]
-            edge_attr[i*k+j] = D[i, idx[i, j]]
+    # Construct kNN graph, edges from the neighbours to the centres
+    num_points = data.shape[0]
+    edge_index = np.stack([idx.reshape(-1), np.repeat(np.arange(num_points), k)])
+    edge_attr = np.take_along_axis(D, idx, axis=1).reshape(-1)
     
     # Convert to torch tensors
     x = torch.tensor(x, dtype=torch.float32)